@@ -1,29 +1,43 @@
 #!/usr/local/bin/python3
 import json
 
-import requests
+from HttpTransport import get_default_transport
+from Instrumentation import get_instrumentation
 
 
 class ApiAuth:
-    def __init__(self, url):
+    def __init__(self, url, transport=None):
         self._url = url
+        self._transport = transport if transport is not None else get_default_transport()
         self._headers = {
             'Content-Type': 'application/x-www-form-urlencoded;charset=UTF-8'}
 
-    def authenticate(self, client_id: str, client_secret: str):
+    def request_token(self, client_id: str, client_secret: str):
         '''
-        This function authenticate the user by the client id & secret with the Workiva platform API
+        This function requests a new token by the client id & secret from the Workiva platform API
 
         :param client_id: a string value that represent the client ID
         :param client_secret: a string value that represent the client secret
 
-        :return assign the retrieved auth token to the class access_token var.
+        :return token_data: the token response, holding access_token and expires_in (seconds)
         '''
 
         data = 'client_id=' + client_id + '&client_secret=' + \
             client_secret + '&grant_type=client_credentials'
 
-        response = requests.post(
-            self._url + '/iam/v1/oauth2/token', data=data, headers=self._headers)
-        token_data = json.loads(response.text)
-        return token_data['access_token']
+        with get_instrumentation().phase('authenticate'):
+            response = self._transport.post(
+                self._url + '/iam/v1/oauth2/token', data=data, headers=self._headers)
+        return json.loads(response.text)
+
+    def authenticate(self, client_id: str, client_secret: str):
+        '''
+        This function authenticate the user by the client id & secret with the Workiva platform API
+
+        :param client_id: a string value that represent the client ID
+        :param client_secret: a string value that represent the client secret
+
+        :return assign the retrieved auth token to the class access_token var.
+        '''
+
+        return self.request_token(client_id, client_secret)['access_token']
@@ -0,0 +1,31 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def open_atomic(path, mode=0o644):
+    """
+    Binary file handle that replaces path only once the with block completes. The data goes to a temporary file
+    next to path, so a reader never sees a partial file and a failure leaves any previous file in place.
+    :param mode: permissions of the written file; mkstemp alone would leave it readable by the owner only
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as file:
+            yield file
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def write_atomic(path, data, mode=0o644):
+    """
+    Replace path with data in one step, see open_atomic
+    """
+    with open_atomic(path, mode) as file:
+        file.write(data)
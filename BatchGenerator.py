@@ -0,0 +1,206 @@
+#!/usr/local/bin/python3
+import argparse
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from ApiAuth import ApiAuth
+from AtomicFile import open_atomic
+from SchemaCache import SchemaCache
+from SchemaCompiler import CompiledSchema, SchemaCompiler
+from SchemaValidator import get_validator
+from SpreadsheetsApi import SpreadsheetsApi
+from TokenProvider import TokenProvider
+from XMLTemplate import XMLTemplate
+
+# Per-worker state, set once by _init_worker so every job in the worker reuses the same schema and API client
+_worker_schema = None
+_worker_template = None
+_worker_spreadsheets_api = None
+_worker_validator = None
+
+
+def _init_worker(model_data, api_url, client_id, client_secret, schema_path=None):
+    global _worker_schema, _worker_template, _worker_spreadsheets_api, _worker_validator
+    _worker_schema = CompiledSchema.from_dict(model_data)
+    # Compiled once per worker, every job only fills in its values
+    _worker_template = XMLTemplate(_worker_schema)
+    if api_url and client_id and client_secret:
+        # Backed by the shared token file, so all workers use one token and only one of them refreshes it when it
+        # expires during a long batch
+        _worker_spreadsheets_api = SpreadsheetsApi(
+            api_url, TokenProvider(ApiAuth(api_url), client_id, client_secret, refresh_margin=600))
+    if schema_path:
+        # The parent already fetched every import, so the worker compiles its validator from the local store only
+        _worker_validator = get_validator(schema_path, _worker_schema.get_key(), SchemaCache.from_env(offline=True))
+
+
+def _output_name(job_name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', job_name)
+
+
+def _load_job_values(job):
+    if 'values' in job:
+        return job['values']
+    if 'values_file' in job:
+        with open(job['values_file'], encoding='utf-8') as file:
+            return json.load(file)
+    if 'spreadsheet_id' in job and 'sheet_id' in job:
+        if _worker_spreadsheets_api is None:
+            raise ValueError('Job reads a sheet but no API credentials were given to the batch')
+        return _worker_spreadsheets_api.get_sheet_data(job['spreadsheet_id'], job['sheet_id'], job.get('region', ':'))
+    raise ValueError('Job needs *values*, *values_file* or *spreadsheet_id* and *sheet_id*')
+
+
+def _job_name(job, position):
+    return job.get('name') or job.get('spreadsheet_id') or f'job-{position + 1}'
+
+
+def _run_job(job, name, output_path, compress):
+    '''
+    Generate one XML document. Runs inside a worker process; any failure is reported in the result instead of
+    being raised so one bad fund does not stop the batch.
+    '''
+    started = time.perf_counter()
+    try:
+        values = _load_job_values(job)
+        # Moved into place once complete, so a failed job never leaves a truncated filing behind nor touches an
+        # earlier one
+        with open_atomic(output_path) as output_file:
+            _worker_template.write(output_file, values, compress=compress)
+    except Exception as error:
+        return {'name': name, 'status': 'error', 'error': f'{type(error).__name__}: {error}',
+                'seconds': time.perf_counter() - started}
+
+    result = {'name': name, 'status': 'ok', 'output': output_path}
+    if _worker_validator is not None:
+        errors = _worker_validator.validate_file(output_path)
+        result['valid'] = not errors
+        result['validation_errors'] = errors
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def load_manifest(manifest_path):
+    '''
+    A manifest is a JSON list of jobs, or an object with a *jobs* list. Each job has a *name* and either
+    *spreadsheet_id* + *sheet_id* (optionally *region*), an inline *values* map or a *values_file* JSON map. Names
+    must give distinct file names; a job without a name is named after its spreadsheet or its manifest position.
+    '''
+    with open(manifest_path, encoding='utf-8') as file:
+        manifest = json.load(file)
+    return manifest['jobs'] if isinstance(manifest, dict) else manifest
+
+
+class BatchGenerator:
+    '''
+    Generates one XML document per job across a process pool. The schema is compiled once in the parent and handed
+    to each worker at start-up, so workers never parse XSD or download imports.
+    '''
+
+    def __init__(self, compiled_schema, api_url=None, client_id=None, client_secret=None, max_workers=None,
+                 output_dir='batch_output', compress=False, verbose=True, validate_schema_path=None):
+        '''
+        :param client_id: (optional) client the workers read sheets as, each through its own TokenProvider
+        '''
+        self._compiled_schema = compiled_schema
+        self._api_url = api_url
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._max_workers = max_workers
+        self._output_dir = output_dir
+        self._compress = compress
+        self._verbose = verbose
+        self._validate_schema_path = validate_schema_path
+
+    def run(self, jobs):
+        '''
+        :param jobs: list of job dicts, see load_manifest
+        :return: summary dict with totals, wall time and one result per job in manifest order
+        '''
+        names = [_job_name(job, position) for position, job in enumerate(jobs)]
+        extension = '.xml.gz' if self._compress else '.xml'
+        output_paths = [os.path.join(self._output_dir, _output_name(name) + extension) for name in names]
+        # Jobs writing the same file would overwrite each other, e.g. 'Fund A' and 'Fund_A'
+        duplicates = sorted({path for path in output_paths if output_paths.count(path) > 1})
+        if duplicates:
+            raise ValueError('Jobs share output files, give them distinct names: ' + ', '.join(duplicates))
+
+        os.makedirs(self._output_dir, exist_ok=True)
+        started = time.perf_counter()
+        results = [None] * len(jobs)
+        if self._validate_schema_path:
+            # Fails early on a broken schema and leaves every import in the local store for the workers
+            get_validator(self._validate_schema_path, self._compiled_schema.get_key())
+
+        with ProcessPoolExecutor(max_workers=self._max_workers, initializer=_init_worker,
+                                 initargs=(self._compiled_schema.to_dict(), self._api_url, self._client_id,
+                                           self._client_secret, self._validate_schema_path)) as executor:
+            futures = {executor.submit(_run_job, job, names[position], output_paths[position], self._compress): position
+                       for position, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                position = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool as error:
+                    result = {'name': names[position], 'status': 'error', 'error': f'Worker process died: {error}'}
+                results[position] = result
+                if self._verbose:
+                    print(f"{result['name']}: {result['status']} {result.get('error', result.get('output'))}")
+                    for error in result.get('validation_errors', ()):
+                        print(f"    line {error['line']} {error['path']}: {error['message']}")
+
+        failed = sum(1 for result in results if result['status'] != 'ok')
+        return {
+            'total': len(jobs),
+            'succeeded': len(jobs) - failed,
+            'failed': failed,
+            'invalid': sum(1 for result in results if result.get('valid') is False),
+            'seconds': time.perf_counter() - started,
+            'results': results,
+        }
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    from SchemaRegistry import get_default_registry
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description='Generate XML filings for every job in a manifest')
+    parser.add_argument('manifest', help='JSON manifest of spreadsheet/sheet pairs or local value maps')
+    parser.add_argument('--schema', help='root XSD, instead of looking up --report-type in the schema registry')
+    parser.add_argument('--report-type', default=os.getenv('REPORT_TYPE', 'FunduszInwestycyjny'))
+    parser.add_argument('--report-version', default=os.getenv('REPORT_VERSION'), help='the latest when omitted')
+    parser.add_argument('--output-dir', default='batch_output')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--gzip', action='store_true', help='write .xml.gz files')
+    parser.add_argument('--validate', action='store_true', help='validate every document against the schema')
+    parser.add_argument('--summary', help='write the JSON summary to this file')
+    args = parser.parse_args()
+
+    batch_jobs = load_manifest(args.manifest)
+    api_url = os.getenv('API_URL')
+    client_id = client_secret = None
+    if any('spreadsheet_id' in job for job in batch_jobs):
+        client_id, client_secret = os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET')
+        # Fails early on bad credentials and leaves the token in the shared cache for the workers
+        TokenProvider(ApiAuth(api_url), client_id, client_secret, refresh_margin=600).get_token()
+
+    schema_path = args.schema or get_default_registry().get_schema_path(args.report_type, args.report_version)
+    try:
+        summary = BatchGenerator(SchemaCompiler(schema_path).load_or_compile(), api_url, client_id, client_secret,
+                                 max_workers=args.workers, output_dir=args.output_dir, compress=args.gzip,
+                                 validate_schema_path=schema_path if args.validate else None).run(batch_jobs)
+    except ValueError as error:
+        parser.error(str(error))
+    print(f"{summary['succeeded']}/{summary['total']} generated in {summary['seconds']:.2f}s")
+    if args.validate:
+        print(f"{summary['invalid']} failed schema validation")
+    if args.summary:
+        with open(args.summary, 'w') as summary_file:
+            json.dump(summary, summary_file, indent=1)
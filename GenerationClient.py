@@ -0,0 +1,133 @@
+#!/usr/local/bin/python3
+import argparse
+import http.client
+import json
+import os
+import socket
+import sys
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self._socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._socket_path)
+
+
+class GenerationClient:
+    '''
+    Thin client of GenerationService. Only the standard library is imported, so a call costs little more than
+    the round trip to the already warm service.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=8700, socket_path=None, timeout=600, token=None):
+        '''
+        :param host: host of the service's HTTP API
+        :param port: port of the service's HTTP API
+        :param socket_path: (optional) Unix socket the service listens on, used instead of host and port
+        :param timeout: seconds to wait for a response; waiting jobs can take as long as the job itself
+        :param token: (optional) the service token, needed over TCP
+        '''
+        self._host = host
+        self._port = port
+        self._socket_path = socket_path
+        self._timeout = timeout
+        self._token = token
+
+    def _request(self, method, path, body=None):
+        if self._socket_path:
+            connection = _UnixHTTPConnection(self._socket_path, self._timeout)
+        else:
+            connection = http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+        try:
+            data = json.dumps(body).encode('utf-8') if body is not None else None
+            headers = {'Content-Type': 'application/json'}
+            if self._token:
+                headers['Authorization'] = 'Bearer ' + self._token
+            connection.request(method, path, body=data, headers=headers)
+            response = connection.getresponse()
+            result = json.loads(response.read() or b'{}')
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise RuntimeError(f"Service answered {response.status}: {result.get('error')}")
+        return result
+
+    def submit(self, job, wait=True):
+        '''
+        :param job: the job dict, see GenerationService.submit
+        :param wait: return once the job has finished instead of as soon as it was queued
+
+        :return job: the job status dict
+        '''
+        return self._request('POST', '/jobs', dict(job, wait=wait))
+
+    def get_job(self, job_id):
+        return self._request('GET', '/jobs/' + job_id)
+
+    def get_health(self):
+        return self._request('GET', '/health')
+
+    def get_stats(self):
+        return self._request('GET', '/stats')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Submit jobs to a running generation service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=int(os.getenv('GENERATION_SERVICE_PORT', '8700')))
+    parser.add_argument('--socket', default=os.getenv('GENERATION_SERVICE_SOCKET'))
+    parser.add_argument('--token', default=os.getenv('GENERATION_SERVICE_TOKEN'))
+    parser.add_argument('--schema', help='root XSD, the service default when neither it nor --report-type is given')
+    parser.add_argument('--report-type', help='registered report type, see SchemaRegistry')
+    parser.add_argument('--report-version', help='version of the report type, the latest when omitted')
+    parser.add_argument('--no-wait', action='store_true', help='return as soon as the job is queued')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = commands.add_parser('generate', help='generate the XML from a filled-in sheet')
+    generate_parser.add_argument('spreadsheet_id')
+    generate_parser.add_argument('sheet_id')
+    generate_parser.add_argument('--output', default='XML_from_schema.xml', help='path in the service output directory')
+    generate_parser.add_argument('--region', default=':')
+    generate_parser.add_argument('--incremental', action='store_true')
+    generate_parser.add_argument('--no-validate', action='store_true')
+    generate_parser.add_argument('--matrix', help='also write the filled-in sheet matrix to this CSV, in the service '
+                                                  'output directory')
+
+    export_parser = commands.add_parser('export', help='write the schema to a new spreadsheet')
+    export_parser.add_argument('spreadsheet_name')
+    export_parser.add_argument('--sheet-name', default='Schema Sheet')
+
+    status_parser = commands.add_parser('status', help='show a submitted job')
+    status_parser.add_argument('job_id')
+
+    commands.add_parser('health', help='check the service is up')
+    commands.add_parser('stats', help='show the service instrumentation report')
+    args = parser.parse_args()
+
+    client = GenerationClient(args.host, args.port, args.socket, token=args.token)
+    schema = {'schema_path': args.schema, 'report_type': args.report_type, 'version': args.report_version}
+    if args.command == 'generate':
+        output = client.submit({
+            'type': 'generate', 'spreadsheet_id': args.spreadsheet_id, 'sheet_id': args.sheet_id,
+            'output_path': args.output, 'region': args.region, 'incremental': args.incremental,
+            'validate': not args.no_validate, 'matrix_path': args.matrix, **schema,
+        }, wait=not args.no_wait)
+    elif args.command == 'export':
+        output = client.submit({'type': 'export', 'spreadsheet_name': args.spreadsheet_name,
+                                'sheet_name': args.sheet_name, **schema}, wait=not args.no_wait)
+    elif args.command == 'status':
+        output = client.get_job(args.job_id)
+    elif args.command == 'health':
+        output = client.get_health()
+    else:
+        output = client.get_stats()
+
+    json.dump(output, sys.stdout, indent=1)
+    print()
+    if output.get('status') == 'error':
+        sys.exit(1)
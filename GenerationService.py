@@ -0,0 +1,330 @@
+#!/usr/local/bin/python3
+import argparse
+import hmac
+import json
+import os
+import signal
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+
+from Instrumentation import get_instrumentation
+from Pipeline import Pipeline
+from SchemaRegistry import get_default_registry
+
+JOB_TYPES = ('generate', 'export')
+MAX_FINISHED_JOBS = 1000
+DEFAULT_OUTPUT_DIR = 'service_output'
+MAX_REQUEST_BYTES = 64 * 1024
+
+
+class GenerationService:
+    '''
+    Long-running generation daemon. One process keeps compiled schemas, the schema cache, validators and access
+    tokens in memory, and runs generate and export jobs submitted over a local HTTP API:
+
+      POST /jobs          submit a job; with "wait": true the response is sent once it has finished
+      GET  /jobs/<id>     job status and result
+      GET  /health        liveness and queue depth
+      GET  /stats         instrumentation report of the process
+
+    Jobs run on max_workers threads; at most max_queue jobs wait behind them, further ones are refused with 503.
+    Jobs only read the default schema and the registered ones, and only write below output_dir. Requests must be
+    JSON; over TCP they also need the service token, see make_server.
+    '''
+
+    def __init__(self, spreadsheets_api, token_provider=None, max_workers=4, max_queue=64,
+                 default_schema_path='FunduszInwestycyjny_v1-6.xsd', schema_registry=None,
+                 output_dir=DEFAULT_OUTPUT_DIR):
+        '''
+        :param spreadsheets_api: the SpreadsheetsApi every job reads and writes sheets with
+        :param token_provider: (optional) the TokenProvider behind spreadsheets_api, warmed up by each job
+        :param max_workers: jobs running at the same time
+        :param max_queue: jobs waiting for a worker before new ones are refused
+        :param default_schema_path: root XSD of jobs that name neither a schema nor a report type
+        :param schema_registry: (optional) SchemaRegistry resolving report types and keeping compiled schemas
+        :param output_dir: directory the output and matrix paths of jobs are relative to, and confined to
+        '''
+        self._spreadsheets_api = spreadsheets_api
+        self._token_provider = token_provider
+        self._max_workers = max_workers
+        self._max_queue = max_queue
+        self._default_schema_path = default_schema_path
+        self._schema_registry = schema_registry if schema_registry is not None else get_default_registry()
+        self._output_dir = os.path.realpath(output_dir)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._pipelines = {}  # schema path -> Pipeline, which holds the compiled schema between jobs
+        self._jobs = OrderedDict()  # job id -> job dict, oldest first
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _get_pipeline(self, schema_path):
+        with self._lock:
+            pipeline = self._pipelines.get(schema_path)
+            if pipeline is None:
+                pipeline = self._pipelines[schema_path] = Pipeline(
+                    self._spreadsheets_api, self._token_provider, schema_path,
+                    schema_compiler=self._schema_registry.get_entry(schema_path))
+        return pipeline
+
+    def _get_schema_path(self, request):
+        if request.get('schema_path'):
+            schema_path = request['schema_path']
+            if schema_path != self._default_schema_path and \
+                    schema_path not in self._schema_registry.get_schema_paths():
+                raise ValueError(f'{schema_path} is neither the default schema nor a registered one')
+            return schema_path
+        if request.get('report_type'):
+            return self._schema_registry.get_schema_path(request['report_type'], request.get('version'))
+        return self._default_schema_path
+
+    def _get_output_path(self, path, field):
+        '''
+        :param field: name of the request field path came from, for the error message
+        :return: path resolved below the output directory, which it may not leave
+        '''
+        if not isinstance(path, str) or not path:
+            raise ValueError(f'*{field}* must be a non-empty path')
+        output_path = os.path.realpath(os.path.join(self._output_dir, path))
+        if os.path.commonpath([output_path, self._output_dir]) != self._output_dir or output_path == self._output_dir:
+            raise ValueError(f'{path} is outside the output directory')
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        return output_path
+
+    def submit(self, request):
+        '''
+        :param request: a dict with *type* 'generate' (*spreadsheet_id*, *sheet_id*, optional *output_path*,
+        *region*, *incremental*, *validate*, *matrix_path*, both paths relative to the output directory) or
+        'export' (*spreadsheet_name*, optional *sheet_name*), and either an optional *schema_path*, the default or a
+        registered one, or a *report_type* with an optional *version*, the latest when omitted
+
+        :return job: the job dict, its *future* set when it was queued; None when the queue is full
+        '''
+
+        if not isinstance(request, dict):
+            raise ValueError('A job must be a JSON object')
+        if request.get('type') not in JOB_TYPES:
+            raise ValueError('Job *type* must be one of ' + ', '.join(JOB_TYPES))
+        if request['type'] == 'generate' and not (request.get('spreadsheet_id') and request.get('sheet_id')):
+            raise ValueError('A generate job needs *spreadsheet_id* and *sheet_id*')
+        if request['type'] == 'export' and not request.get('spreadsheet_name'):
+            raise ValueError('An export job needs *spreadsheet_name*')
+        schema_path = self._get_schema_path(request)
+        output_paths = {
+            'output_path': self._get_output_path(request.get('output_path', 'XML_from_schema.xml'), 'output_path'),
+            'matrix_path': None if request.get('matrix_path') is None else
+            self._get_output_path(request['matrix_path'], 'matrix_path'),
+        }
+
+        with self._lock:
+            if self._pending >= self._max_queue + self._max_workers:
+                return None
+            self._pending += 1
+            job = {'id': uuid.uuid4().hex, 'type': request['type'], 'status': 'queued', 'submitted': time.time()}
+            self._jobs[job['id']] = job
+            while len(self._jobs) > MAX_FINISHED_JOBS and next(iter(self._jobs.values()))['status'] in ('ok', 'error'):
+                self._jobs.popitem(last=False)
+        job['future'] = self._executor.submit(self._run, job, dict(request, **output_paths), schema_path)
+        return job
+
+    def _run(self, job, request, schema_path):
+        job['status'] = 'running'
+        started = time.perf_counter()
+        try:
+            pipeline = self._get_pipeline(schema_path)
+            if request['type'] == 'generate':
+                result = pipeline.generate_xml(
+                    request['spreadsheet_id'], request['sheet_id'],
+                    output_path=request['output_path'],
+                    region=request.get('region', ':'),
+                    incremental=bool(request.get('incremental')),
+                    validate=request.get('validate', True),
+                    matrix_path=request['matrix_path'])
+            else:
+                spreadsheet_id, sheet_id = pipeline.export_schema(request['spreadsheet_name'],
+                                                                  request.get('sheet_name', 'Schema Sheet'))
+                result = {'spreadsheet_id': spreadsheet_id, 'sheet_id': sheet_id}
+        except Exception as error:
+            job['error'] = f'{type(error).__name__}: {error}'
+            job['status'] = 'error'
+        else:
+            job['result'] = result
+            job['status'] = 'ok'
+        finally:
+            job['seconds'] = time.perf_counter() - started
+            with self._lock:
+                self._pending -= 1
+            get_instrumentation().count('service_jobs_' + job['status'])
+
+    def warm_up(self, schema_path=None):
+        '''
+        Authenticate and load the schema and its validator before the first job asks for them
+        '''
+        self._get_pipeline(schema_path or self._default_schema_path).warm_up()
+
+    def get_job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return None if job is None else {key: value for key, value in job.items() if key != 'future'}
+
+    def get_health(self):
+        with self._lock:
+            health = {'status': 'ok', 'pending': self._pending, 'schemas': sorted(self._pipelines)}
+        health['registry'] = self._schema_registry.get_stats()
+        return health
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def make_server(self, host='127.0.0.1', port=8700, socket_path=None, token=None):
+        '''
+        :param host: interface the HTTP API listens on, local only by default
+        :param port: TCP port of the HTTP API
+        :param socket_path: (optional) serve the API on this Unix socket instead of TCP
+        :param token: secret every request must send as *Authorization: Bearer <token>*. Required over TCP, which
+        any local process and any web page open in a local browser can reach; the Unix socket is only accessible
+        to its owner.
+
+        :return server: a socketserver ready for serve_forever
+        '''
+
+        handler = _make_handler(self, token)
+        if socket_path is None:
+            if not token:
+                raise ValueError('Serving over TCP needs a token, or serve on a Unix socket')
+            server = ThreadingHTTPServer((host, port), handler)
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = _UnixHTTPServer(socket_path, handler)
+            os.chmod(socket_path, 0o600)
+        server.daemon_threads = True
+        return server
+
+
+class _UnixHTTPServer(ThreadingUnixStreamServer):
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)  # BaseHTTPRequestHandler expects a (host, port) client address
+
+
+def _make_handler(service, token=None):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _authorized(self):
+            if not token:
+                return True
+            if hmac.compare_digest(self.headers.get('Authorization', '').encode('utf-8'),
+                                   ('Bearer ' + token).encode('utf-8')):
+                return True
+            self._send(401, {'error': 'Missing or wrong service token'})
+            return False
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            if self.path == '/health':
+                return self._send(200, service.get_health())
+            if self.path == '/stats':
+                return self._send(200, get_instrumentation().report())
+            if self.path.startswith('/jobs/'):
+                job = service.get_job(self.path[len('/jobs/'):])
+                return self._send(200, job) if job is not None else self._send(404, {'error': 'Unknown job'})
+            self._send(404, {'error': 'Not found'})
+
+        def _refuse(self, status, message):
+            # The body is left unread, so the connection cannot carry another request
+            self.close_connection = True
+            self._send(status, {'error': message})
+
+        def do_POST(self):
+            if not self._authorized():
+                self.close_connection = True
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                return self._refuse(400, 'Invalid Content-Length')
+            if length < 0 or length > MAX_REQUEST_BYTES:
+                return self._refuse(413, f'Jobs are limited to {MAX_REQUEST_BYTES} bytes')
+            body = self.rfile.read(length)
+            if self.path != '/jobs':
+                return self._send(404, {'error': 'Not found'})
+            # A web page can only post JSON after a CORS preflight, which this server never grants
+            if self.headers.get_content_type() != 'application/json':
+                return self._send(415, {'error': 'Jobs must be posted as application/json'})
+            try:
+                request = json.loads(body or b'{}')
+                job = service.submit(request)
+            except ValueError as error:  # includes malformed JSON
+                return self._send(400, {'error': str(error)})
+            if job is None:
+                return self._send(503, {'error': 'Job queue is full'})
+
+            if request.get('wait'):
+                job['future'].result()
+                return self._send(200, service.get_job(job['id']))
+            self._send(202, service.get_job(job['id']))
+
+    return Handler
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    from ApiAuth import ApiAuth
+    from SpreadsheetsApi import SpreadsheetsApi
+    from TokenProvider import TokenProvider
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description='Serve generate and export jobs from a warm process')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=int(os.getenv('GENERATION_SERVICE_PORT', '8700')))
+    parser.add_argument('--socket', default=os.getenv('GENERATION_SERVICE_SOCKET'),
+                        help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--token', default=os.getenv('GENERATION_SERVICE_TOKEN'),
+                        help='secret clients must send, required over TCP')
+    parser.add_argument('--output-dir', default=os.getenv('GENERATION_SERVICE_OUTPUT_DIR', DEFAULT_OUTPUT_DIR),
+                        help='directory jobs write their documents to')
+    parser.add_argument('--schema', default='FunduszInwestycyjny_v1-6.xsd', help='default root XSD')
+    parser.add_argument('--workers', type=int, default=4, help='jobs running at the same time')
+    parser.add_argument('--max-queue', type=int, default=64, help='jobs waiting before new ones are refused')
+    args = parser.parse_args()
+    if not (args.socket or args.token):
+        parser.error('serving over TCP needs --token or GENERATION_SERVICE_TOKEN, otherwise use --socket')
+
+    api_url = os.getenv('API_URL')
+    token_provider = TokenProvider(ApiAuth(api_url), os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET'))
+    service = GenerationService(SpreadsheetsApi(api_url, token_provider), token_provider, max_workers=args.workers,
+                                max_queue=args.max_queue, default_schema_path=args.schema, output_dir=args.output_dir)
+    server = service.make_server(args.host, args.port, args.socket, args.token)
+    service.warm_up()
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+
+    print('Serving on ' + (args.socket or f'http://{args.host}:{args.port}'))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
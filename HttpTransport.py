@@ -0,0 +1,153 @@
+import email.utils
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from Instrumentation import get_instrumentation
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+RETRYABLE_STATUS_CODES = frozenset([500, 502, 503, 504])
+
+
+def _parse_retry_after(value):
+    '''
+    Retry-After is either a number of seconds or an HTTP date
+    '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class HttpTransport:
+    '''
+    Shared HTTP layer for the API clients and schema downloads: one pooled keep-alive requests.Session per host,
+    connect/read timeouts on every call, and retries with exponential backoff and full jitter. Idempotent methods
+    are retried on connection errors and 5xx responses; any method is retried on 429, honouring Retry-After.
+    '''
+
+    def __init__(self, connect_timeout=5.0, read_timeout=60.0, max_retries=4, backoff_base=0.5, backoff_max=30.0,
+                 pool_size=10):
+        self._timeout = (connect_timeout, read_timeout)
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._pool_size = pool_size
+        self._sessions = {}
+        self._sessions_pid = os.getpid()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        '''
+        Build a transport from HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT and HTTP_MAX_RETRIES environment variables
+        '''
+        return cls(
+            connect_timeout=float(os.getenv('HTTP_CONNECT_TIMEOUT', '5')),
+            read_timeout=float(os.getenv('HTTP_READ_TIMEOUT', '60')),
+            max_retries=int(os.getenv('HTTP_MAX_RETRIES', '4')),
+        )
+
+    def _get_session(self, url):
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+        with self._lock:
+            if self._sessions_pid != os.getpid():
+                # Pooled sockets must not be shared with a forked child
+                self._sessions = {}
+                self._sessions_pid = os.getpid()
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size, max_retries=0)
+                session.mount(parts.scheme + '://', adapter)
+                self._sessions[host] = session
+        return session
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self._backoff_max, self._backoff_base * (2 ** attempt)))
+
+    def request(self, method, url, **kwargs):
+        '''
+        :param method: HTTP method name
+        :param url: absolute URL
+        :param kwargs: passed on to requests.Session.request; a timeout given here overrides the default
+        :return: the last requests.Response; connection errors are raised once retries are exhausted
+        '''
+        method = method.upper()
+        idempotent = method in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', self._timeout)
+        session = self._get_session(url)
+        instrumentation = get_instrumentation()
+
+        attempt = 0
+        while True:
+            if attempt:
+                instrumentation.count('http_retries')
+            instrumentation.count('http_requests')
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                instrumentation.count('http_errors')
+                if not idempotent or attempt >= self._max_retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+
+            body = response.request.body
+            if body:
+                instrumentation.count('http_bytes_sent', len(body))
+            instrumentation.count('http_bytes_received', len(response.content))
+            if attempt >= self._max_retries:
+                return response
+            if response.status_code == 429:
+                delay = _parse_retry_after(response.headers.get('Retry-After'))
+                time.sleep(min(self._backoff_max, delay) if delay is not None else self._backoff(attempt))
+            elif response.status_code in RETRYABLE_STATUS_CODES and idempotent:
+                time.sleep(self._backoff(attempt))
+            else:
+                return response
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def get_default_transport():
+    '''
+    Process-wide transport configured from the environment, created on first use
+    '''
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = HttpTransport.from_env()
+    return _default_transport
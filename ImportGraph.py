@@ -0,0 +1,391 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urljoin
+
+from lxml import etree
+
+from Instrumentation import get_instrumentation
+from LazySchemaDocument import LazySchemaDocument
+from SchemaCache import get_default_cache
+from SchemaIndex import ComponentIndex, TYPE_KINDS, XSD_NAMESPACE, XSD_TAG_PREFIX, split_qname
+
+IMPORT_TAG = XSD_TAG_PREFIX + 'import'
+ELEMENT_TAG = XSD_TAG_PREFIX + 'element'
+GROUP_TAG = XSD_TAG_PREFIX + 'group'
+DERIVATION_TAGS = (XSD_TAG_PREFIX + 'extension', XSD_TAG_PREFIX + 'restriction')
+# Subtrees that add no child elements, so neither SchemaWalker2 nor SchemaCompiler look up references inside them
+NON_STRUCTURAL_TAGS = {XSD_TAG_PREFIX + suffix
+                       for suffix in ('simpleType', 'attribute', 'attributeGroup', 'annotation')}
+# A parsed lxml tree plus its component index takes roughly this many times the size of the XSD source
+PARSED_DOCUMENT_FACTOR = 10
+
+
+def find_import_tags(schema_root):
+    """
+    import elements can only be found on the top-level. No need to dive into the tree
+    """
+    return [child for child in schema_root if child.tag == IMPORT_TAG]
+
+
+class ImportedSchema:
+    """
+    One node of the import graph: a namespace, where it was loaded from and its parsed tree, or its
+    LazySchemaDocument when loaded lazily (root is None then)
+    """
+    def __init__(self, namespace, location, root, document=None, index=None):
+        """
+        :param index: (optional) ComponentIndex of root, built on first get_index when not given
+        """
+        self.namespace = namespace
+        self.location = location
+        self.root = root
+        self.document = document
+        self._index = index if index is not None else document
+
+    def get_index(self):
+        """
+        :return: the top-level components of the document, with ComponentIndex's find()
+        """
+        if self._index is None:
+            self._index = ComponentIndex(self.root)
+        return self._index
+
+    def get_imports(self):
+        """
+        :return: attributes of the xsd:import statements of the document
+        """
+        if self.document is not None:
+            return self.document.get_imports()
+        return [import_tag.attrib for import_tag in find_import_tags(self.root)]
+
+
+def _iter_references(component):
+    """
+    :return: (namespace, local name, kinds) of every component the element structure of component refers to:
+    element types and refs, group refs and derivation bases
+    """
+    if component.tag in NON_STRUCTURAL_TAGS:
+        return
+    stack = [component]
+    while stack:
+        element = stack.pop()
+        tag = element.tag
+        if tag == ELEMENT_TAG:
+            if element.get('type') is not None:
+                yield split_qname(element, element.get('type')) + (TYPE_KINDS,)
+            if element.get('ref') is not None:
+                yield split_qname(element, element.get('ref')) + (('element',),)
+        elif tag == GROUP_TAG and element.get('ref') is not None:
+            yield split_qname(element, element.get('ref')) + (('group',),)
+        elif tag in DERIVATION_TAGS and element.get('base') is not None:
+            yield split_qname(element, element.get('base')) + (TYPE_KINDS,)
+        stack.extend(child for child in element if isinstance(child.tag, str) and child.tag not in NON_STRUCTURAL_TAGS)
+
+
+def _component_key(namespace, component):
+    return namespace, component.tag[len(XSD_TAG_PREFIX):], component.get('name')
+
+
+class ImportGraph:
+    """
+    Closure of xsd:import statements reachable from a root schema. Each namespace appears once; edges keep every
+    import relationship, including cycles between mutually importing schemas.
+    """
+    def __init__(self, root_namespace):
+        self._root_namespace = root_namespace
+        self._schemas = {}
+        self._edges = {root_namespace: []}
+
+    def add_schema(self, imported_schema):
+        self._schemas[imported_schema.namespace] = imported_schema
+        self._edges.setdefault(imported_schema.namespace, [])
+
+    def add_edge(self, from_namespace, to_namespace):
+        self._edges.setdefault(from_namespace, []).append(to_namespace)
+
+    def get(self, namespace):
+        return self._schemas.get(namespace)
+
+    def get_edges(self):
+        return self._edges
+
+    def __iter__(self):
+        return iter(self._schemas.values())
+
+    def __len__(self):
+        return len(self._schemas)
+
+    def to_dict(self):
+        return {
+            'root': self._root_namespace,
+            'schemas': {schema.namespace: schema.location for schema in self._schemas.values()},
+            'imports': self._edges,
+        }
+
+
+class DependencyGraph:
+    """
+    Components reachable from the report root through element types, element and group refs and derivation
+    bases, keyed by (namespace, kind, name), and which of them refers to which. Built by
+    ImportResolver.resolve_reachable together with the ImportGraph of just the documents it fetched.
+    """
+    def __init__(self, import_graph):
+        self._import_graph = import_graph
+        self._edges = {}  # component key -> keys of the components it refers to
+        self._missing = []  # (component key, key of a reference that was not found)
+
+    def add_component(self, key):
+        """
+        :return: True when the component was not in the graph yet
+        """
+        if key in self._edges:
+            return False
+        self._edges[key] = []
+        return True
+
+    def add_edge(self, from_key, to_key):
+        self._edges[from_key].append(to_key)
+
+    def add_missing(self, from_key, key):
+        self._missing.append((from_key, key))
+
+    def get_import_graph(self):
+        return self._import_graph
+
+    def get_components(self):
+        return list(self._edges)
+
+    def get_edges(self):
+        return self._edges
+
+    def get_missing(self):
+        return self._missing
+
+    def get_namespaces(self):
+        return sorted({namespace for namespace, _, _ in self._edges}, key=lambda namespace: namespace or '')
+
+    def __len__(self):
+        return len(self._edges)
+
+    def to_dict(self):
+        return {
+            'namespaces': self.get_namespaces(),
+            'components': [list(key) for key in self._edges],
+            'edges': [[list(from_key), list(to_key)]
+                      for from_key, to_keys in self._edges.items() for to_key in to_keys],
+            'missing': [[list(from_key), list(key)] for from_key, key in self._missing],
+        }
+
+
+class SchemaDocumentPool:
+    """
+    Parsed schema documents and their component indexes keyed by content hash, so schemas that import the same
+    namespace document (e.g. several versions of a report) parse and index it once. Keeps the max_documents most
+    recently used documents, fewer when their estimated size exceeds max_bytes. Trees are only read after parsing,
+    so they are shared between threads.
+    """
+    def __init__(self, max_documents=64, max_bytes=None):
+        self._max_documents = max_documents
+        self._max_bytes = max_bytes
+        self._documents = OrderedDict()  # sha256 -> xsd:schema root
+        self._sizes = {}  # sha256 -> estimated bytes of the parsed document
+        self._size = 0
+        self._indexes = {}  # id of a pooled root -> (root, ComponentIndex)
+        self._lock = threading.Lock()
+
+    def parse(self, content):
+        """
+        :return: xsd:schema root of the document with this content, parsed on first use
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        with self._lock:
+            root = self._documents.get(digest)
+            if root is not None:
+                self._documents.move_to_end(digest)
+                get_instrumentation().count('schema_document_pool_hits')
+                return root
+
+        root = etree.fromstring(content)
+        with self._lock:
+            if digest not in self._documents:
+                self._documents[digest] = root
+                self._sizes[digest] = len(content) * PARSED_DOCUMENT_FACTOR
+                self._size += self._sizes[digest]
+            root = self._documents[digest]
+            # The document just parsed stays even when it alone is larger than max_bytes
+            while len(self._documents) > 1 and (len(self._documents) > self._max_documents or
+                                                self._max_bytes is not None and self._size > self._max_bytes):
+                evicted_digest, evicted_root = self._documents.popitem(last=False)
+                self._size -= self._sizes.pop(evicted_digest)
+                self._indexes.pop(id(evicted_root), None)
+        return root
+
+    def get_estimated_size(self):
+        """
+        :return: approximate bytes held by the pooled documents and their indexes
+        """
+        with self._lock:
+            return self._size
+
+    def get_index(self, root):
+        """
+        :return: ComponentIndex of root, built once for roots returned by parse
+        """
+        with self._lock:
+            entry = self._indexes.get(id(root))
+            if entry is not None and entry[0] is root:
+                return entry[1]
+
+        index = ComponentIndex(root)
+        with self._lock:
+            if any(pooled_root is root for pooled_root in self._documents.values()):
+                index = self._indexes.setdefault(id(root), (root, index))[1]
+        return index
+
+
+class ImportResolver:
+    """
+    Discovers the whole xsd:import closure of a schema breadth-first and fetches independent documents concurrently
+    on a bounded thread pool. A namespace is fetched once no matter how many schemas import it, and a namespace that
+    is already known is never queued again, so cyclic imports terminate.
+    """
+    def __init__(self, schema_cache=None, max_workers=8, verbose=False, document_pool=None, lazy=False):
+        """
+        :param document_pool: SchemaDocumentPool to share parsed documents with other resolvers
+        :param lazy: index imported documents as LazySchemaDocuments instead of parsing them whole
+        """
+        self._schema_cache = schema_cache if schema_cache is not None else get_default_cache()
+        self._max_workers = max_workers
+        self._verbose = verbose
+        self._document_pool = document_pool
+        self._lazy = lazy
+
+    def _load(self, namespace, location):
+        content = self._schema_cache.get(location)
+        if self._lazy:
+            return ImportedSchema(namespace, location, None, LazySchemaDocument(content))
+        if self._document_pool is not None:
+            root = self._document_pool.parse(content)
+            return ImportedSchema(namespace, location, root, index=self._document_pool.get_index(root))
+        return ImportedSchema(namespace, location, etree.fromstring(content))
+
+    def resolve(self, schema_root, base_location=None):
+        """
+        :param schema_root: xsd:schema element of the root document
+        :param base_location: path or URL of the root document, used to resolve relative schemaLocation values
+        :return: ImportGraph of every namespace reachable through imports
+        """
+        root_namespace = schema_root.get('targetNamespace')
+        graph = ImportGraph(root_namespace)
+        requested = {root_namespace}
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            pending = set()
+
+            def schedule(parent_namespace, parent_location, import_tags):
+                for import_tag in import_tags:
+                    namespace = import_tag.get('namespace')
+                    location = import_tag.get('schemaLocation')
+                    graph.add_edge(parent_namespace, namespace)
+                    if namespace in requested or location is None:
+                        continue
+                    requested.add(namespace)
+                    if parent_location is not None:
+                        location = urljoin(parent_location, location)
+                    pending.add(executor.submit(self._load, namespace, location))
+
+            schedule(root_namespace, base_location, find_import_tags(schema_root))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    imported_schema = future.result()
+                    graph.add_schema(imported_schema)
+                    if self._verbose:
+                        print(f'Resolved import {imported_schema.namespace} from {imported_schema.location}')
+                    schedule(imported_schema.namespace, imported_schema.location, imported_schema.get_imports())
+
+        return graph
+
+    def resolve_reachable(self, schema_root, base_location=None, start_elements=None):
+        """
+        Fetch only the imported documents the report needs: starting from start_elements, follow element types,
+        element and group refs and derivation bases, and fetch a namespace the first time a reference leads into
+        it. Namespaces referenced in the same round are fetched concurrently. Imports nothing refers to are never
+        downloaded.
+
+        :param schema_root: xsd:schema element of the root document
+        :param base_location: path or URL of the root document, used to resolve relative schemaLocation values
+        :param start_elements: top-level components of schema_root to start from; by default its last global
+        element, the report root
+        :return: DependencyGraph; its get_import_graph() holds the fetched documents only
+        """
+        root_namespace = schema_root.get('targetNamespace')
+        graph = ImportGraph(root_namespace)
+        dependencies = DependencyGraph(graph)
+        indexes = {root_namespace: ComponentIndex(schema_root)}  # namespace -> index of every loaded document
+        locations = {}  # namespace -> schemaLocation, from the imports of every loaded document
+
+        def add_imports(parent_namespace, parent_location, import_tags):
+            for import_tag in import_tags:
+                namespace = import_tag.get('namespace')
+                location = import_tag.get('schemaLocation')
+                graph.add_edge(parent_namespace, namespace)
+                if location is not None and namespace not in locations:
+                    if parent_location is not None:
+                        location = urljoin(parent_location, location)
+                    locations[namespace] = location
+
+        if start_elements is None:
+            start_elements = [child for child in schema_root if child.tag == ELEMENT_TAG][-1:]
+        pending = []  # (key, component) whose references are still to be followed
+        for element in start_elements:
+            key = _component_key(root_namespace, element)
+            if dependencies.add_component(key):
+                pending.append((key, element))
+
+        def follow(from_key, namespace, name, kinds):
+            component = indexes[namespace].find(name, kinds)
+            if component is None:
+                dependencies.add_missing(from_key, (namespace, kinds[0], name))
+                return
+            key = _component_key(namespace, component)
+            dependencies.add_edge(from_key, key)
+            if dependencies.add_component(key):
+                pending.append((key, component))
+
+        add_imports(root_namespace, base_location, find_import_tags(schema_root))
+        deferred = []  # references into namespaces that are not loaded yet
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while pending or deferred:
+                while pending:
+                    from_key, component = pending.pop()
+                    for namespace, name, kinds in _iter_references(component):
+                        if namespace == XSD_NAMESPACE:
+                            continue
+                        if namespace in indexes:
+                            follow(from_key, namespace, name, kinds)
+                        else:
+                            deferred.append((from_key, namespace, name, kinds))
+
+                fetched = {namespace for _, namespace, _, _ in deferred if namespace in locations}
+                for future in [executor.submit(self._load, namespace, locations[namespace]) for namespace in fetched]:
+                    imported_schema = future.result()
+                    graph.add_schema(imported_schema)
+                    indexes[imported_schema.namespace] = imported_schema.get_index()
+                    add_imports(imported_schema.namespace, imported_schema.location, imported_schema.get_imports())
+                    if self._verbose:
+                        print(f'Resolved import {imported_schema.namespace} from {imported_schema.location}')
+
+                references, deferred = deferred, []
+                for from_key, namespace, name, kinds in references:
+                    if namespace in indexes:
+                        follow(from_key, namespace, name, kinds)
+                    elif namespace in locations:
+                        deferred.append((from_key, namespace, name, kinds))  # imported by a document fetched just now
+                    else:
+                        dependencies.add_missing(from_key, (namespace, kinds[0], name))
+
+        get_instrumentation().count('schema_imports_skipped', len(set(locations) - set(indexes)))
+        return dependencies
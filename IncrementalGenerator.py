@@ -0,0 +1,150 @@
+import gzip
+import hashlib
+import json
+import os
+
+from AtomicFile import write_atomic
+from XMLBuilder import XMLBuilder
+from Instrumentation import get_instrumentation
+from ModelTraversal import ModelTraversal
+from SheetValueIndex import SheetValueIndex
+
+STATE_VERSION = 2
+
+
+class IncrementalGenerator:
+    """
+    Regenerates an XML document from sheet values, re-rendering only the subtrees whose values changed since the
+    previous run. Next to the output a state file keeps the values that run used, and for every fragment (see
+    XMLBuilder.write_xml_fragments) the value keys it read and its place in the document. Unchanged fragments are
+    copied from the previous document as bytes. The state is discarded, and the document rebuilt in full, when the
+    schema model, the rendering options, the occurrences of repeated elements or the document on disk no longer
+    match it.
+    """
+    def __init__(self, compiled_schema, output_path, state_path=None, fragment_depth=2, pretty_print=True):
+        """
+        :param compiled_schema: CompiledSchema the document is generated from
+        :param output_path: document path, gzip compressed when it ends in .gz
+        :param state_path: defaults to output_path + '.state.json'
+        :param fragment_depth: depth of the reusable subtrees; deeper means smaller fragments and more of them
+        :param pretty_print: indent nested elements with tabs
+        """
+        self._compiled_schema = compiled_schema
+        self._output_path = output_path
+        self._state_path = state_path or output_path + '.state.json'
+        self._fragment_depth = fragment_depth
+        self._pretty_print = pretty_print
+        self._compress = output_path.endswith('.gz')
+
+    def generate(self, tag_text_map, visitors=()):
+        """
+        :param tag_text_map: SheetValueIndex as returned by SpreadsheetsApi.get_sheet_data, or a dict of element path
+        or name -> value
+        :param visitors: further ModelVisitors to run in the walk that renders the document, or in a walk of their
+        own when nothing needs rendering
+        :return: dict with the number of fragments, how many were rendered and reused, and whether the file was written
+        """
+        instrumentation = get_instrumentation()
+        if not isinstance(tag_text_map, SheetValueIndex):
+            tag_text_map = SheetValueIndex.from_mapping(tag_text_map)
+        values = {str(key): str(value) for key, value in tag_text_map.items()}
+        occurrences = tag_text_map.get_occurrence_signature()
+        state = self._load_state()
+        if state is not None and state.get('occurrences') != occurrences:
+            state = None  # Repeated elements were added or removed, so the fragments no longer line up
+        previous_document = self._read_document(state) if state is not None else None
+        if previous_document is None:
+            state = None
+
+        reuse = {}
+        if state is not None:
+            old_values = state['values']
+            changed = {name for name in values.keys() | old_values.keys() if values.get(name) != old_values.get(name)}
+            if not changed:
+                instrumentation.count('incremental_fragments_reused', len(state['fragments']))
+                if visitors:
+                    ModelTraversal(self._compiled_schema, tag_text_map).run(list(visitors))
+                return self._summary(len(state['fragments']), 0, False)
+            reuse = self._collect_reusable(state, previous_document, changed)
+
+        xml_builder = XMLBuilder(self._compiled_schema, tag_text_map)
+        segments = xml_builder.write_xml_fragments(self._fragment_depth, self._pretty_print, reuse, visitors)
+
+        document = []
+        layout = []
+        fragments = {}
+        for index, data, keys in segments:
+            if data is None:
+                data, keys = reuse[index]
+            else:
+                keys = sorted(keys)
+            document.append(data)
+            layout.append([index, len(data)])
+            if index is not None:
+                fragments[index] = keys
+        document = b''.join(document)
+
+        write_atomic(self._output_path, gzip.compress(document, mtime=0) if self._compress else document)
+        write_atomic(self._state_path, json.dumps({
+            'version': STATE_VERSION,
+            'model_key': self._compiled_schema.get_key(),
+            'fragment_depth': self._fragment_depth,
+            'pretty_print': self._pretty_print,
+            'digest': hashlib.sha256(document).hexdigest(),
+            'values': values,
+            'occurrences': occurrences,
+            'layout': layout,
+            'fragments': [fragments[index] for index in range(len(fragments))],
+        }).encode('utf-8'))
+
+        instrumentation.count('incremental_fragments_rendered', len(fragments) - len(reuse))
+        instrumentation.count('incremental_fragments_reused', len(reuse))
+        return self._summary(len(fragments), len(fragments) - len(reuse), True)
+
+    @staticmethod
+    def _summary(fragments, rendered, written):
+        return {'fragments': fragments, 'rendered': rendered, 'reused': fragments - rendered, 'written': written}
+
+    @staticmethod
+    def _collect_reusable(state, previous_document, changed):
+        """
+        :return: fragment index -> (previous bytes, value keys) for every fragment that read none of the changed names
+        """
+        reuse = {}
+        fragments = state['fragments']
+        offset = 0
+        for index, length in state['layout']:
+            if index is not None and changed.isdisjoint(fragments[index]):
+                reuse[index] = (previous_document[offset:offset + length], fragments[index])
+            offset += length
+        return reuse
+
+    def _load_state(self):
+        try:
+            with open(self._state_path) as state_file:
+                state = json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if state.get('version') != STATE_VERSION \
+                or state.get('model_key') != self._compiled_schema.get_key() \
+                or state.get('fragment_depth') != self._fragment_depth \
+                or state.get('pretty_print') != self._pretty_print:
+            return None
+        return state
+
+    def _read_document(self, state):
+        """
+        :return: the previous document, or None when it is missing or was changed outside of this generator
+        """
+        try:
+            with open(self._output_path, 'rb') as document_file:
+                document = document_file.read()
+            if self._compress:
+                document = gzip.decompress(document)
+        except (FileNotFoundError, OSError, EOFError):
+            return None
+
+        if hashlib.sha256(document).hexdigest() != state.get('digest'):
+            return None
+        return document
@@ -0,0 +1,151 @@
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger('instrumentation')
+
+PROFILERS = ('cprofile', 'tracemalloc')
+
+
+class Instrumentation:
+    """
+    Collects per-phase wall time and named counters (nodes visited, requests, bytes, cache hits and misses) for one
+    process. Phases with the same name are aggregated; phases may nest, so their times can overlap.
+
+    Any phase can be run under cProfile or tracemalloc by listing it in profile_phases, e.g.
+    {'parse_tree': 'cprofile', 'construct_xml': 'tracemalloc'}. Results are written to profile_dir.
+    """
+    def __init__(self, log=False, profile_phases=None, profile_dir='profiles'):
+        self._log = log
+        self._profile_phases = profile_phases or {}
+        self._profile_dir = profile_dir
+        self._phases = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        for phase_name, profiler in self._profile_phases.items():
+            if profiler not in PROFILERS:
+                raise ValueError(f'Unknown profiler {profiler} for phase {phase_name}')
+
+    @classmethod
+    def from_env(cls):
+        """
+        INSTRUMENTATION_LOG=1 logs every phase, PROFILE_PHASES="parse_tree:cprofile,construct_xml:tracemalloc"
+        selects phases to profile and PROFILE_DIR where the results go
+        """
+        profile_phases = {}
+        for item in os.getenv('PROFILE_PHASES', '').split(','):
+            if item.strip():
+                phase_name, _, profiler = item.strip().partition(':')
+                profile_phases[phase_name] = profiler or 'cprofile'
+        return cls(
+            log=os.getenv('INSTRUMENTATION_LOG', '').lower() in ('1', 'true', 'yes'),
+            profile_phases=profile_phases,
+            profile_dir=os.getenv('PROFILE_DIR', 'profiles'),
+        )
+
+    def is_logging(self):
+        return self._log
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def get_counter(self, name):
+        return self._counters.get(name, 0)
+
+    @contextmanager
+    def phase(self, name):
+        profiler = self._profile_phases.get(name)
+        started = time.perf_counter()
+        if profiler == 'cprofile':
+            # cProfile only follows the calling thread
+            profile = cProfile.Profile()
+            profile.enable()
+        elif profiler == 'tracemalloc':
+            already_tracing = tracemalloc.is_tracing()
+            if not already_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            if profiler == 'cprofile':
+                profile.disable()
+                self._dump_cprofile(name, profile)
+            elif profiler == 'tracemalloc':
+                self._dump_tracemalloc(name, tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()[1])
+                if not already_tracing:
+                    tracemalloc.stop()
+
+            with self._lock:
+                totals = self._phases.setdefault(name, {'seconds': 0.0, 'calls': 0, 'max_seconds': 0.0})
+                totals['seconds'] += seconds
+                totals['calls'] += 1
+                totals['max_seconds'] = max(totals['max_seconds'], seconds)
+            if self._log:
+                logger.info('phase %s took %.3fs', name, seconds)
+
+    def _profile_path(self, name, extension):
+        os.makedirs(self._profile_dir, exist_ok=True)
+        calls = self._phases.get(name, {}).get('calls', 0)
+        return os.path.join(self._profile_dir, f'{name}-{os.getpid()}-{calls}.{extension}')
+
+    def _dump_cprofile(self, name, profile):
+        path = self._profile_path(name, 'prof')
+        profile.dump_stats(path)
+        if self._log:
+            logger.info('cProfile of %s written to %s', name, path)
+
+    def _dump_tracemalloc(self, name, snapshot, peak_bytes):
+        path = self._profile_path(name, 'txt')
+        with open(path, 'w') as file:
+            file.write(f'peak traced memory: {peak_bytes / 1024:.1f} KiB\n')
+            for statistic in snapshot.statistics('lineno')[:25]:
+                file.write(str(statistic) + '\n')
+        if self._log:
+            logger.info('tracemalloc peak of %s was %.1f KiB, top allocations in %s', name, peak_bytes / 1024, path)
+
+    def report(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'wall_seconds': time.perf_counter() - self._started,
+                'phases': {name: dict(totals) for name, totals in self._phases.items()},
+                'counters': dict(self._counters),
+            }
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=1)
+
+    def write_json(self, path):
+        with open(path, 'w') as file:
+            file.write(self.to_json())
+
+    def log_summary(self):
+        report = self.report()
+        for name, totals in report['phases'].items():
+            logger.info('%-20s %8.3fs in %d call(s)', name, totals['seconds'], totals['calls'])
+        for name, value in sorted(report['counters'].items()):
+            logger.info('%-28s %d', name, value)
+
+
+_default_instrumentation = None
+_default_instrumentation_lock = threading.Lock()
+
+
+def get_instrumentation():
+    """
+    Process-wide instrumentation configured from the environment, created on first use
+    """
+    global _default_instrumentation
+    with _default_instrumentation_lock:
+        if _default_instrumentation is None:
+            _default_instrumentation = Instrumentation.from_env()
+    return _default_instrumentation
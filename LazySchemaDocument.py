@@ -0,0 +1,142 @@
+import threading
+from xml.parsers import expat
+
+from lxml import etree
+
+from Instrumentation import get_instrumentation
+from SchemaIndex import COMPONENT_KINDS, TYPE_KINDS, XSD_NAMESPACE
+
+_XMLNS_PREFIX = 'xmlns:'
+
+
+def _split_raw_name(raw_name):
+    if ':' in raw_name:
+        return raw_name.split(':', 1)
+    return None, raw_name
+
+
+class LazySchemaDocument:
+    """
+    Component index of a schema document that is never parsed as a whole. One expat pass, which builds no tree,
+    records the byte range and name of every top-level component and the attributes of its xsd:import statements;
+    a component is parsed only when it is first looked up. Offers the same find() as ComponentIndex.
+
+    A materialized component is parsed inside a copy of the document's xsd:schema start tag, so prefixes,
+    targetNamespace and elementFormDefault resolve as they would in the full document, and
+    component.getroottree().getroot() is an xsd:schema element.
+    """
+    def __init__(self, content):
+        self._content = content
+        self._header = b''  # prolog and xsd:schema start tag
+        self._footer = b''  # xsd:schema end tag
+        self._target_namespace = None
+        self._imports = []  # attributes of every top-level xsd:import
+        self._ranges = {}  # (kind, name) -> (start, end) byte offsets of the component
+        self._components = {}  # (kind, name) -> materialized element
+        self._lock = threading.Lock()
+        with get_instrumentation().phase('scan_schema_document'):
+            self._scan()
+        get_instrumentation().count('schema_components_indexed', len(self._ranges))
+
+    def _scan(self):
+        content = self._content
+        parser = expat.ParserCreate()
+        parser.ordered_attributes = True  # flat [name, value, ...] lists, cheaper than a dict per element
+        depth = 0
+        namespaces = {}  # prefix -> namespace declared on xsd:schema
+        open_component = None  # (kind, name) or None, and start offset of the top-level element being read
+
+        def close_component(boundary):
+            nonlocal open_component
+            if open_component is not None:
+                key, start = open_component
+                if key is not None:
+                    self._ranges[key] = (start, boundary)
+                open_component = None
+
+        def start_element(raw_name, attribute_list):
+            nonlocal depth, open_component
+            depth += 1
+            if depth > 2:
+                return
+
+            attributes = dict(zip(attribute_list[::2], attribute_list[1::2]))
+            if depth == 1:
+                self._target_namespace = attributes.get('targetNamespace')
+                for attribute, value in attributes.items():
+                    if attribute.startswith(_XMLNS_PREFIX):
+                        namespaces[attribute[len(_XMLNS_PREFIX):]] = value
+                    elif attribute == 'xmlns':
+                        namespaces[None] = value
+                return
+
+            offset = parser.CurrentByteIndex
+            if not self._header:
+                self._header = content[:offset]
+            close_component(offset)
+            prefix, kind = _split_raw_name(raw_name)
+            namespace = attributes.get('xmlns' if prefix is None else _XMLNS_PREFIX + prefix, namespaces.get(prefix))
+            key = None
+            if namespace == XSD_NAMESPACE:
+                if kind == 'import':
+                    self._imports.append(attributes)
+                elif kind in COMPONENT_KINDS and attributes.get('name') is not None:
+                    key = (kind, attributes['name'])
+            open_component = (key, offset)
+
+        def end_element(raw_name):
+            nonlocal depth
+            depth -= 1
+            if depth == 0:
+                offset = parser.CurrentByteIndex
+                close_component(offset)
+                if not self._header:
+                    self._header = content[:offset]
+                self._footer = b'</' + raw_name.encode('utf-8') + b'>'
+
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.Parse(content, True)
+
+    def _materialize(self, key):
+        start, end = self._ranges[key]
+        # The range runs up to the next top-level element, so trailing whitespace or comments come along
+        wrapper = etree.fromstring(self._header + self._content[start:end] + self._footer)
+        for child in wrapper:
+            if isinstance(child.tag, str):
+                return child
+        return None
+
+    def get_target_namespace(self):
+        return self._target_namespace
+
+    def get_imports(self):
+        """
+        :return: attribute dicts of the top-level xsd:import statements, i.e. namespace and schemaLocation
+        """
+        return self._imports
+
+    def find(self, name, kinds=TYPE_KINDS):
+        """
+        :param name: local name of the component
+        :param kinds: component kinds to look in, in order of preference
+        :return: the component element, parsed on first lookup, or None
+        """
+        for kind in kinds:
+            key = (kind, name)
+            if key not in self._ranges:
+                continue
+            with self._lock:
+                component = self._components.get(key)
+                if component is None:
+                    component = self._components[key] = self._materialize(key)
+                    get_instrumentation().count('schema_components_materialized')
+            return component
+
+        return None
+
+    def get_materialized_count(self):
+        return len(self._components)
+
+    def __len__(self):
+        return len(self._ranges)
@@ -0,0 +1,176 @@
+from Instrumentation import get_instrumentation
+from SheetValueIndex import NAME_HEADER, PATH_HEADER, VALUE_HEADER, child_path
+
+SKIP_CHILDREN = 'skip_children'
+MATRIX_HEADER = [NAME_HEADER, 'Type', 'Documentation', PATH_HEADER, VALUE_HEADER]
+
+
+def iter_occurrences(node, path, values):
+    """
+    :param values: SheetValueIndex deciding how often repeatable children occur, or None for once each
+    :return: (child, path, occurrence number) for every occurrence of every child of node, in document order.
+    Occurrences past the child's maxOccurs are left out.
+    """
+    for child in node.children:
+        occurrences = 1
+        if values is not None and child.is_repeatable():
+            occurrences = values.get_occurrences(path, child.name)
+            if child.max_occurs > 0:
+                occurrences = min(occurrences, child.max_occurs)
+        for occurrence in range(1, occurrences + 1):
+            yield child, child_path(path, child.name, occurrence), occurrence
+
+
+class ModelVisitor:
+    """
+    One consumer of a ModelTraversal walk. enter is called for every element occurrence before its children and
+    leave after them. primary is True when the occurrence and all its ancestors are first occurrences, i.e. the
+    node as it appears in the schema itself. enter may return SKIP_CHILDREN; the children are skipped when every
+    visitor of the walk asks for it, and leave is called either way.
+    """
+    def enter(self, node, path, depth, primary):
+        return None
+
+    def leave(self, node, path, depth):
+        pass
+
+    def finish(self):
+        return None
+
+
+class ModelTraversal:
+    """
+    The one walk over a CompiledSchema that the sheet matrix, the XML document, statistics and value checks are
+    produced from. Imports and extensions were resolved once when the model was compiled; the walk expands
+    repeatable elements to the occurrences the values mention and hands every element occurrence to all visitors
+    in document order, so any combination of outputs costs a single traversal.
+    """
+    def __init__(self, compiled_schema, values=None):
+        """
+        :param values: SheetValueIndex the occurrences of repeatable elements are taken from, or None to visit the
+        schema's own shape, every element once
+        """
+        self._compiled_schema = compiled_schema
+        self._values = values
+
+    def run(self, visitors, node=None):
+        """
+        :param node: SchemaNode to start from, defaults to the model root
+        :return: list of what each visitor's finish returned
+        """
+        values = self._values
+        if node is None:
+            node = self._compiled_schema.get_root()
+        stack = [(node, 0, False, node.name, True)]
+        visited = 0
+        while stack:
+            node, depth, closing, path, primary = stack.pop()
+            if closing:
+                for visitor in visitors:
+                    visitor.leave(node, path, depth)
+                continue
+
+            visited += 1
+            skip = True
+            for visitor in visitors:
+                if visitor.enter(node, path, depth, primary) != SKIP_CHILDREN:
+                    skip = False
+            stack.append((node, depth, True, path, primary))
+            if skip and visitors:
+                continue
+            children = [(child, depth + 1, False, child_key, primary and occurrence == 1)
+                        for child, child_key, occurrence in iter_occurrences(node, path, values)]
+            stack.extend(reversed(children))
+
+        get_instrumentation().count('model_nodes_visited', visited)
+        return [visitor.finish() for visitor in visitors]
+
+
+class MatrixVisitor(ModelVisitor):
+    """
+    Builds the matrix passed to the spreadsheets API: a header row, then one row per element with its name, type,
+    documentation and path. Without values it is the schema export the client fills in; with values every
+    occurrence gets a row and the Value column holds what the document was generated from.
+    """
+    def __init__(self, values=None):
+        self._values = values
+        self._matrix = [list(MATRIX_HEADER)]
+
+    def enter(self, node, path, depth, primary):
+        if self._values is None and not primary:
+            return None
+        row = [node.name, node.type_name or 'No type specified', node.documentation or 'No documentation', path]
+        if self._values is not None and node.is_leaf():
+            row.append(str(self._values.get(path, node.name, '')))
+        self._matrix.append(row)
+        return None
+
+    def finish(self):
+        return self._matrix
+
+
+class StatisticsVisitor(ModelVisitor):
+    """
+    Counts what the walk produced: elements, leaves, leaves with and without a value, repeated occurrences and
+    the deepest nesting
+    """
+    def __init__(self, values=None):
+        self._values = values
+        self._statistics = {'elements': 0, 'leaves': 0, 'filled': 0, 'empty': 0, 'repeated': 0, 'max_depth': 0}
+
+    def enter(self, node, path, depth, primary):
+        statistics = self._statistics
+        statistics['elements'] += 1
+        if not primary and path.endswith(']'):
+            statistics['repeated'] += 1
+        if depth > statistics['max_depth']:
+            statistics['max_depth'] = depth
+        if node.is_leaf():
+            statistics['leaves'] += 1
+            if self._values is not None and self._values.get(path, node.name) is not None:
+                statistics['filled'] += 1
+            else:
+                statistics['empty'] += 1
+        return None
+
+    def finish(self):
+        return self._statistics
+
+
+class ValueCheckVisitor(ModelVisitor):
+    """
+    Checks the values against the occurrence constraints of the model while the document is written: leaves that
+    are required, as are all their ancestors, but have no value, and repeated elements given more occurrences than
+    maxOccurs allows (those are left out of the document). Errors have the shape of SchemaValidator's, without a line
+    and column.
+    """
+    def __init__(self, values, max_errors=100):
+        self._values = values
+        self._max_errors = max_errors
+        self._errors = []
+        self._required = [True]  # whether the element being visited, and every ancestor, is required
+
+    def _add(self, path, message):
+        if len(self._errors) < self._max_errors:
+            self._errors.append({'line': None, 'column': None, 'path': path, 'message': message, 'level': 'ERROR'})
+
+    def enter(self, node, path, depth, primary):
+        required = self._required[-1] and node.min_occurs > 0
+        self._required.append(required)
+        if node.is_leaf():
+            if required and self._values.get(path, node.name) is None:
+                self._add(path, 'Required value is missing')
+            return None
+        for child in node.children:
+            if child.max_occurs > 1:
+                occurrences = self._values.get_occurrences(path, child.name)
+                if occurrences > child.max_occurs:
+                    self._add(child_path(path, child.name),
+                              f'{occurrences} occurrences given, at most {child.max_occurs} allowed')
+        return None
+
+    def leave(self, node, path, depth):
+        self._required.pop()
+
+    def finish(self):
+        return self._errors
@@ -0,0 +1,130 @@
+import csv
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from IncrementalGenerator import IncrementalGenerator
+from Instrumentation import get_instrumentation
+from ModelTraversal import MatrixVisitor, StatisticsVisitor, ValueCheckVisitor
+from SchemaCompiler import SchemaCompiler
+from SchemaValidator import get_validator
+from XMLBuilder import XMLBuilder
+
+
+class Pipeline:
+    '''
+    Runs the independent steps of an export or a generation side by side on a thread pool instead of one after the
+    other. Authentication and schema loading (import resolution plus compilation, or the cached model) start at
+    once; the sheet is fetched as soon as a token is available, and the XML is built when both the sheet and the
+    schema are ready. The validator compiles while the sheet is still in flight. End-to-end time approaches that of
+    the slowest dependency rather than the sum of all of them.
+    '''
+
+    def __init__(self, spreadsheets_api, token_provider=None, schema_path='FunduszInwestycyjny_v1-6.xsd',
+                 schema_compiler=None, max_workers=4):
+        '''
+        :param spreadsheets_api: the SpreadsheetsApi to read and write sheets with
+        :param token_provider: (optional) TokenProvider to fetch a token from up front; the API client otherwise
+        authenticates on its first request
+        :param schema_path: the root XSD
+        :param schema_compiler: (optional) SchemaCompiler for schema_path
+        :param max_workers: threads running pipeline steps
+        '''
+        self._spreadsheets_api = spreadsheets_api
+        self._token_provider = token_provider
+        self._schema_path = schema_path
+        self._schema_compiler = schema_compiler if schema_compiler is not None else SchemaCompiler(schema_path)
+        self._max_workers = max_workers
+
+    def _authenticate(self):
+        if self._token_provider is not None:
+            self._token_provider.get_token()
+
+    def warm_up(self):
+        '''
+        Fetch a token, load the schema and compile its validator concurrently, so later calls find them in memory
+        '''
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            token_future = executor.submit(self._authenticate)
+            compiled_schema = self._schema_compiler.load_or_compile()
+            get_validator(self._schema_path, compiled_schema.get_key())
+            token_future.result()
+
+    def generate_xml(self, spreadsheet_id, sheet_id, output_path='XML_from_schema.xml', region=':',
+                     incremental=False, validate=True, matrix_path=None):
+        '''
+        :param spreadsheet_id: the spreadsheet holding the client's values
+        :param sheet_id: the sheet holding the client's values
+        :param output_path: document path, gzip compressed when it ends in .gz
+        :param region: the sheet region to read
+        :param incremental: re-render only the parts whose values changed, see IncrementalGenerator
+        :param validate: validate the document against the schema
+        :param matrix_path: (optional) CSV file to write the sheet matrix to, every occurrence with the value the
+        document got; built in the same walk as the document
+
+        :return summary: a dict with the output path, the validation errors (None when not validated), the value
+        errors and statistics of the walk (see ValueCheckVisitor and StatisticsVisitor) and the seconds taken
+        '''
+
+        started = time.perf_counter()
+        with get_instrumentation().phase('pipeline'), ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            token_future = executor.submit(self._authenticate)
+            schema_future = executor.submit(self._schema_compiler.load_or_compile)
+
+            def fetch_sheet():
+                token_future.result()
+                return self._spreadsheets_api.get_sheet_data(spreadsheet_id, sheet_id, region)
+
+            def compile_validator():
+                return get_validator(self._schema_path, schema_future.result().get_key())
+
+            sheet_future = executor.submit(fetch_sheet)
+            validator_future = executor.submit(compile_validator) if validate else None
+
+            compiled_schema = schema_future.result()
+            sheet_values = sheet_future.result()
+            visitors = [ValueCheckVisitor(sheet_values), StatisticsVisitor(sheet_values)]
+            if matrix_path:
+                visitors.append(MatrixVisitor(sheet_values))
+            if incremental:
+                IncrementalGenerator(compiled_schema, output_path).generate(sheet_values, visitors)
+            else:
+                with open(output_path, 'wb') as output_file:
+                    XMLBuilder(compiled_schema, sheet_values).write_xml_stream(
+                        output_file, compress=output_path.endswith('.gz'), visitors=visitors)
+            value_errors, statistics = visitors[0].finish(), visitors[1].finish()
+            if matrix_path:
+                with open(matrix_path, 'w', newline='') as matrix_file:
+                    csv.writer(matrix_file).writerows(visitors[2].finish())
+
+            errors = validator_future.result().validate_file(output_path) if validate else None
+
+        return {'output': output_path, 'validation_errors': errors, 'value_errors': value_errors,
+                'statistics': statistics, 'seconds': time.perf_counter() - started}
+
+    def export_schema(self, spreadsheet_name, sheet_name='Schema Sheet'):
+        '''
+        Create a spreadsheet and write the schema matrix to it; the spreadsheet is created while the schema loads
+
+        :param spreadsheet_name: name of the new spreadsheet
+        :param sheet_name: name of the sheet the matrix is written to
+
+        :return ids: a tuple of the new spreadsheet ID and sheet ID
+        '''
+
+        with get_instrumentation().phase('pipeline'), ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            schema_future = executor.submit(self._schema_compiler.load_or_compile)
+
+            def create_sheet():
+                self._authenticate()
+                spreadsheet_id = self._spreadsheets_api.create_spreadsheet(spreadsheet_name)
+                return spreadsheet_id, self._spreadsheets_api.create_sheet(spreadsheet_id, sheet_name)
+
+            spreadsheet_id, sheet_id = executor.submit(create_sheet).result()
+            results = self._spreadsheets_api.bulk_update_range(spreadsheet_id, sheet_id,
+                                                               schema_future.result().to_matrix())
+
+        failed_regions = [result['region'] for result in results if not result['ok']]
+        if failed_regions:
+            raise RuntimeError('Writing the schema to the sheet failed for ' + ', '.join(failed_regions))
+        return spreadsheet_id, sheet_id
@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+from AtomicFile import write_atomic
+from HttpTransport import get_default_transport
+from Instrumentation import get_instrumentation
+
+DEFAULT_CACHE_DIR = '.schema_cache'
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def _is_remote(location):
+    return location.startswith('http://') or location.startswith('https://')
+
+
+class SchemaCache:
+    """
+    Persistent, content-addressed store for imported schema documents keyed by their schemaLocation.
+    Blobs live under objects/<sha256>, the index maps each location to its digest and HTTP validators.
+    Entries are revalidated once per process with ETag/Last-Modified and evicted least-recently-used first
+    once the store grows past max_bytes. In offline mode the network is never touched.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, offline=False, verbose=False,
+                 transport=None):
+        self._cache_dir = cache_dir
+        self._transport = transport if transport is not None else get_default_transport()
+        self._objects_dir = os.path.join(cache_dir, 'objects')
+        self._index_path = os.path.join(cache_dir, 'index.json')
+        self._max_bytes = max_bytes
+        self._offline = offline
+        self._verbose = verbose
+        self._lock = threading.RLock()
+        self._memory = {}  # location -> bytes already validated during this process
+        os.makedirs(self._objects_dir, exist_ok=True)
+        self._index = self._load_index()
+
+    @classmethod
+    def from_env(cls, offline=None):
+        """
+        Build a cache from SCHEMA_CACHE_DIR, SCHEMA_CACHE_MAX_MB and SCHEMA_CACHE_OFFLINE environment variables
+        :param offline: overrides SCHEMA_CACHE_OFFLINE when given
+        """
+        max_mb = os.getenv('SCHEMA_CACHE_MAX_MB')
+        if offline is None:
+            offline = os.getenv('SCHEMA_CACHE_OFFLINE', '').lower() in ('1', 'true', 'yes')
+        return cls(
+            cache_dir=os.getenv('SCHEMA_CACHE_DIR', DEFAULT_CACHE_DIR),
+            max_bytes=int(max_mb) * 1024 * 1024 if max_mb else DEFAULT_MAX_BYTES,
+            offline=offline,
+        )
+
+    def is_offline(self):
+        return self._offline
+
+    def get(self, location):
+        """
+        Return the raw bytes of the schema at location, downloading or revalidating it only when needed
+        :param location: schemaLocation of an xsd:import, either an URL or a local file path
+        :return: bytes of the schema document
+        """
+        if not _is_remote(location):
+            with open(location, 'rb') as file:
+                return file.read()
+
+        with self._lock:
+            content = self._memory.get(location)
+            if content is not None:
+                get_instrumentation().count('schema_cache_memory_hits')
+                return content
+
+            entry = self._index.get(location)
+            cached = self._read_blob(entry['digest']) if entry is not None else None
+
+        if self._offline:
+            if cached is None:
+                raise RuntimeError(f'Schema {location} is not cached and the schema cache is offline')
+            get_instrumentation().count('schema_cache_hits')
+            content = cached
+        else:
+            # The network round trip happens outside the lock so several imports can be fetched concurrently
+            with get_instrumentation().phase('schema_download'):
+                content = self._fetch(location, entry if cached is not None else None, cached)
+
+        with self._lock:
+            self._touch(location)
+            self._memory[location] = content
+        return content
+
+    def revalidate(self, locations):
+        """
+        Forget the copies of the remote locations validated earlier in this process and validate them again, so
+        a long-running process sees schemas published since it started. Local files are always read afresh.
+        """
+        remote_locations = [location for location in locations if _is_remote(location)]
+        with self._lock:
+            for location in remote_locations:
+                self._memory.pop(location, None)
+        for location in remote_locations:
+            self.get(location)
+
+    def digest(self, location):
+        """
+        Content hash of the cached copy of location, or None if it has never been fetched. No network access.
+        """
+        if not _is_remote(location):
+            with open(location, 'rb') as file:
+                return hashlib.sha256(file.read()).hexdigest()
+
+        with self._lock:
+            entry = self._index.get(location)
+            return entry['digest'] if entry is not None else None
+
+    def _fetch(self, location, entry, cached):
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = self._transport.get(location, headers=headers)
+        except requests.RequestException:
+            if cached is not None:
+                if self._verbose:
+                    print(f'Could not revalidate {location}, serving cached copy')
+                return cached
+            raise
+
+        if response.status_code == 304 and cached is not None:
+            get_instrumentation().count('schema_cache_hits')
+            if self._verbose:
+                print(f'Schema cache hit (revalidated) for {location}')
+            return cached
+        if not response.ok:
+            if cached is not None:
+                return cached
+            raise RuntimeError('Request for imported namespace did not go through')
+
+        get_instrumentation().count('schema_cache_misses')
+        if self._verbose:
+            print(f'Schema cache miss for {location}')
+        content = response.content
+        with self._lock:
+            self._store(location, content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return content
+
+    def _store(self, location, content, etag, last_modified):
+        digest = hashlib.sha256(content).hexdigest()
+        blob_path = os.path.join(self._objects_dir, digest)
+        if not os.path.exists(blob_path):
+            write_atomic(blob_path, content)
+
+        self._index[location] = {
+            'digest': digest,
+            'size': len(content),
+            'etag': etag,
+            'last_modified': last_modified,
+            'last_used': time.time(),
+        }
+        self._evict(keep=location)
+        self._save_index()
+
+    def _touch(self, location):
+        entry = self._index.get(location)
+        if entry is not None:
+            entry['last_used'] = time.time()
+            self._save_index()
+
+    def _evict(self, keep):
+        """
+        Drop least-recently-used locations until the unique blobs fit in max_bytes.
+        Blobs shared by several locations are removed only once nothing points at them.
+        """
+        sizes = {entry['digest']: entry['size'] for entry in self._index.values()}
+        total = sum(sizes.values())
+        if total <= self._max_bytes:
+            return
+
+        by_age = sorted(self._index.items(), key=lambda item: item[1]['last_used'])
+        for location, entry in by_age:
+            if total <= self._max_bytes:
+                break
+            if location == keep:
+                continue
+            del self._index[location]
+            self._memory.pop(location, None)
+            if all(other['digest'] != entry['digest'] for other in self._index.values()):
+                total -= entry['size']
+                try:
+                    os.remove(os.path.join(self._objects_dir, entry['digest']))
+                except FileNotFoundError:
+                    pass
+
+    def _read_blob(self, digest):
+        try:
+            with open(os.path.join(self._objects_dir, digest), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def _load_index(self):
+        try:
+            with open(self._index_path) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_index(self):
+        write_atomic(self._index_path, json.dumps(self._index, indent=1).encode('utf-8'))
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    """
+    Process-wide cache configured from the environment, created on first use
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = SchemaCache.from_env()
+    return _default_cache
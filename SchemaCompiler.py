@@ -0,0 +1,443 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+
+from lxml import etree
+
+from ImportGraph import ImportResolver
+from Instrumentation import get_instrumentation
+from ModelTraversal import MatrixVisitor, ModelTraversal
+from SchemaCache import get_default_cache
+from SchemaIndex import ComponentIndex, XSD_NAMESPACE, XSD_TAG_PREFIX, split_qname
+
+DEFAULT_MODEL_DIR = '.schema_models'
+MODEL_FORMAT_VERSION = 1
+UNBOUNDED = -1
+
+ELEMENT_TAG = XSD_TAG_PREFIX + 'element'
+ANNOTATION_TAG = XSD_TAG_PREFIX + 'annotation'
+DOCUMENTATION_TAG = XSD_TAG_PREFIX + 'documentation'
+COMPLEX_TYPE_TAG = XSD_TAG_PREFIX + 'complexType'
+SIMPLE_TYPE_TAG = XSD_TAG_PREFIX + 'simpleType'
+COMPLEX_CONTENT_TAG = XSD_TAG_PREFIX + 'complexContent'
+SIMPLE_CONTENT_TAG = XSD_TAG_PREFIX + 'simpleContent'
+EXTENSION_TAG = XSD_TAG_PREFIX + 'extension'
+RESTRICTION_TAG = XSD_TAG_PREFIX + 'restriction'
+SEQUENCE_TAG = XSD_TAG_PREFIX + 'sequence'
+CHOICE_TAG = XSD_TAG_PREFIX + 'choice'
+ALL_TAG = XSD_TAG_PREFIX + 'all'
+GROUP_TAG = XSD_TAG_PREFIX + 'group'
+MODEL_GROUP_TAGS = (SEQUENCE_TAG, CHOICE_TAG, ALL_TAG)
+
+
+def _parse_occurs(value, default=1):
+    if value is None:
+        return default
+    if value == 'unbounded':
+        return UNBOUNDED
+    return int(value)
+
+
+def _get_documentation(element):
+    for child in element:
+        if child.tag == ANNOTATION_TAG:
+            for annotation_child in child:
+                if annotation_child.tag == DOCUMENTATION_TAG and annotation_child.text:
+                    return annotation_child.text.strip()
+    return None
+
+
+class SchemaNode:
+    """
+    A resolved element declaration: everything needed to export the schema matrix or build an instance document
+    without going back to the XSD. Nodes produced from the same complex type share their children list.
+    """
+    __slots__ = ('name', 'namespace', 'type_name', 'documentation', 'min_occurs', 'max_occurs', 'children')
+
+    def __init__(self, name, namespace=None, type_name=None, documentation=None, min_occurs=1, max_occurs=1,
+                 children=None):
+        self.name = name
+        self.namespace = namespace
+        self.type_name = type_name
+        self.documentation = documentation
+        self.min_occurs = min_occurs
+        self.max_occurs = max_occurs
+        self.children = children if children is not None else []
+
+    def is_leaf(self):
+        return not self.children
+
+    def is_repeatable(self):
+        return self.max_occurs == UNBOUNDED or self.max_occurs > 1
+
+    def iter_preorder(self):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+
+class CompiledSchema:
+    """
+    Intermediate model of a schema and its imports, persisted as JSON keyed by a hash of every input document
+    """
+    def __init__(self, root, key, inputs, namespaces):
+        self._root = root
+        self._key = key
+        self._inputs = inputs  # location -> sha256 of every schema document the model was built from
+        self._namespaces = namespaces  # prefix -> namespace of the root schema, reused for instance documents
+
+    def get_root(self):
+        return self._root
+
+    def get_root_name(self):
+        return self._root.name
+
+    def get_key(self):
+        return self._key
+
+    def get_inputs(self):
+        return self._inputs
+
+    def get_nsmap(self):
+        return self._namespaces
+
+    def get_estimated_size(self):
+        """
+        :return: approximate bytes held by the model: every distinct node, children list and string counted once
+        """
+        seen = set()
+        size = 0
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            size += sys.getsizeof(node)
+            for value in (node.name, node.type_name, node.documentation):
+                if value is not None and id(value) not in seen:
+                    seen.add(id(value))
+                    size += sys.getsizeof(value)
+            if node.children and id(node.children) not in seen:
+                seen.add(id(node.children))
+                size += sys.getsizeof(node.children)
+                stack.extend(node.children)
+        return size
+
+    def to_matrix(self):
+        """
+        :return: The matrix intended to be passed to spreadsheets API for the client to fill in data. The header row
+        names the columns; the client fills the Value column, and copies a row with Pozycja[2] in its path to add
+        another occurrence of a repeatable element. See ModelTraversal to build it in the same walk as the document.
+        """
+        return ModelTraversal(self).run([MatrixVisitor()])[0]
+
+    def to_dict(self):
+        """
+        Children lists shared between nodes are written once to a group table and referenced by index
+        """
+        namespaces = []
+        namespace_ids = {}
+        groups = []
+        group_ids = {}
+
+        def encode_group(children):
+            group_id = group_ids.get(id(children))
+            if group_id is None:
+                group_id = len(groups)
+                group_ids[id(children)] = group_id
+                groups.append(None)
+                groups[group_id] = [encode_node(child) for child in children]
+            return group_id
+
+        def encode_node(node):
+            if node.namespace not in namespace_ids:
+                namespace_ids[node.namespace] = len(namespaces)
+                namespaces.append(node.namespace)
+            return [
+                node.name, namespace_ids[node.namespace], node.type_name, node.documentation,
+                node.min_occurs, node.max_occurs, encode_group(node.children) if node.children else -1,
+            ]
+
+        root = encode_node(self._root)
+        return {
+            'version': MODEL_FORMAT_VERSION,
+            'key': self._key,
+            'inputs': self._inputs,
+            'nsmap': self._namespaces,
+            'element_namespaces': namespaces,
+            'groups': groups,
+            'root': root,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        namespaces = data['element_namespaces']
+        encoded_groups = data['groups']
+        groups = [None] * len(encoded_groups)
+
+        def decode_group(group_id):
+            if group_id < 0:
+                return []
+            if groups[group_id] is None:
+                groups[group_id] = [decode_node(child) for child in encoded_groups[group_id]]
+            return groups[group_id]
+
+        def decode_node(encoded):
+            name, namespace_id, type_name, documentation, min_occurs, max_occurs, group_id = encoded
+            # Element and type names repeat across the model, interned they are stored once per process
+            return SchemaNode(sys.intern(name), namespaces[namespace_id],
+                              sys.intern(type_name) if type_name is not None else None, documentation,
+                              min_occurs, max_occurs, decode_group(group_id))
+
+        return cls(decode_node(data['root']), data['key'], data['inputs'], data['nsmap'])
+
+
+class SchemaCompiler:
+    """
+    Turns a root XSD plus its imports into a CompiledSchema. Compiled models are stored under model_dir; a manifest
+    per root document records which imported documents went into the model, so a warm start only hashes files
+    already on disk and never parses XSD or touches the network.
+    """
+    def __init__(self, schema_path='FunduszInwestycyjny_v1-6.xsd', schema_cache=None, model_dir=None, verbose=False,
+                 document_pool=None):
+        """
+        document_pool is an optional SchemaDocumentPool shared by compilers of schemas with common imports, so each
+        imported document is parsed and indexed once
+        """
+        self._schema_path = schema_path
+        self._document_pool = document_pool
+        self._schema_cache = schema_cache if schema_cache is not None else get_default_cache()
+        self._model_dir = model_dir or os.getenv('SCHEMA_MODEL_DIR', DEFAULT_MODEL_DIR)
+        self._verbose = verbose
+        self._reset()
+        self._last_compiled = None  # reused while the recorded inputs are unchanged, for long-running processes
+        self._lock = threading.Lock()
+
+    def _reset(self):
+        """
+        Forget what the previous compile resolved, a recompile happens because an input document changed
+        """
+        self._indexes = {}  # namespace -> ComponentIndex
+        self._schema_settings = {}  # schema root -> (target namespace, elementFormDefault is qualified)
+        self._complex_type_children = {}  # (namespace, name) -> compiled children list
+        self._types_in_progress = set()
+
+    @staticmethod
+    def _compute_key(inputs):
+        digest = hashlib.sha256()
+        for location in sorted(inputs):
+            digest.update(location.encode('utf-8'))
+            digest.update(inputs[location].encode('ascii'))
+        return digest.hexdigest()
+
+    def _manifest_path(self, root_digest):
+        return os.path.join(self._model_dir, 'manifest-' + root_digest + '.json')
+
+    def _model_path(self, key):
+        return os.path.join(self._model_dir, 'model-' + key + '.json')
+
+    def load_or_compile(self):
+        """
+        :return: CompiledSchema from memory or disk when every input document is unchanged, otherwise a freshly
+        compiled one
+        """
+        instrumentation = get_instrumentation()
+        with instrumentation.phase('load_schema'), self._lock:
+            compiled = self.load()
+            if compiled is None:
+                instrumentation.count('schema_model_misses')
+                compiled = self.compile()
+                self.save(compiled)
+            else:
+                instrumentation.count('schema_model_hits')
+        return compiled
+
+    def load(self):
+        with open(self._schema_path, 'rb') as file:
+            root_digest = hashlib.sha256(file.read()).hexdigest()
+
+        try:
+            with open(self._manifest_path(root_digest)) as file:
+                recorded_inputs = json.load(file)['inputs']
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+        current_inputs = {location: self._schema_cache.digest(location) for location in recorded_inputs}
+        if current_inputs != recorded_inputs:
+            return None
+
+        key = self._compute_key(current_inputs)
+        if self._last_compiled is not None and self._last_compiled.get_key() == key:
+            return self._last_compiled
+        try:
+            with open(self._model_path(key)) as file:
+                data = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if data.get('version') != MODEL_FORMAT_VERSION:
+            return None
+
+        if self._verbose:
+            print(f'Loaded compiled schema model {data["key"]}')
+        self._last_compiled = CompiledSchema.from_dict(data)
+        return self._last_compiled
+
+    def save(self, compiled):
+        self._last_compiled = compiled
+        os.makedirs(self._model_dir, exist_ok=True)
+        root_digest = compiled.get_inputs()[self._schema_path]
+        with open(self._model_path(compiled.get_key()), 'w') as file:
+            json.dump(compiled.to_dict(), file, ensure_ascii=False, separators=(',', ':'))
+        with open(self._manifest_path(root_digest), 'w') as file:
+            json.dump({'inputs': compiled.get_inputs(), 'model': compiled.get_key()}, file, indent=1)
+
+    def compile(self):
+        with get_instrumentation().phase('compile_schema'):
+            try:
+                return self._compile()
+            finally:
+                # The model holds no reference to the documents it was compiled from, so a kept compiler pins none
+                self._reset()
+
+    def _compile(self):
+        self._reset()
+        with open(self._schema_path, 'rb') as file:
+            root_bytes = file.read()
+        schema_root = etree.fromstring(root_bytes)
+        inputs = {self._schema_path: hashlib.sha256(root_bytes).hexdigest()}
+
+        root_declarations = [child for child in schema_root if child.tag == ELEMENT_TAG]
+        if not root_declarations:
+            raise ValueError('Schema does not declare a root element')
+
+        # As in SchemaWalker the report root is the last global element of the document. Only the imports its
+        # element structure reaches are fetched, and only those are inputs of the model.
+        self._indexes[schema_root.get('targetNamespace')] = ComponentIndex(schema_root)
+        dependency_graph = ImportResolver(self._schema_cache, verbose=self._verbose,
+                                          document_pool=self._document_pool).resolve_reachable(
+            schema_root, self._schema_path, root_declarations[-1:])
+        for imported_schema in dependency_graph.get_import_graph():
+            self._indexes[imported_schema.namespace] = imported_schema.get_index()
+            inputs[imported_schema.location] = self._schema_cache.digest(imported_schema.location)
+
+        root = self._compile_element(root_declarations[-1])
+
+        namespaces = {prefix: namespace for prefix, namespace in schema_root.nsmap.items()
+                      if prefix is not None and namespace != XSD_NAMESPACE}
+        compiled = CompiledSchema(root, self._compute_key(inputs), inputs, namespaces)
+        if self._verbose:
+            print(f'Compiled schema model {compiled.get_key()}')
+        return compiled
+
+    def _get_schema_settings(self, element):
+        schema_root = element.getroottree().getroot()
+        settings = self._schema_settings.get(schema_root)
+        if settings is None:
+            settings = (schema_root.get('targetNamespace'), schema_root.get('elementFormDefault') == 'qualified')
+            self._schema_settings[schema_root] = settings
+        return settings
+
+    def _find_component(self, element, prefixed_name, kinds):
+        namespace, local_name = split_qname(element, prefixed_name)
+        index = self._indexes.get(namespace)
+        component = index.find(local_name, kinds) if index is not None else None
+        if component is None:
+            raise ValueError(f'{prefixed_name} was not found in the imported namespaces')
+        return namespace, component
+
+    def _compile_element(self, element, min_occurs=None, max_occurs=None):
+        """
+        :param min_occurs: occurrence bounds forced by the enclosing model group, e.g. every choice branch is optional
+        """
+        if min_occurs is None:
+            min_occurs = _parse_occurs(element.get('minOccurs'))
+        if max_occurs is None:
+            max_occurs = _parse_occurs(element.get('maxOccurs'))
+
+        reference = element.get('ref')
+        if reference is not None:
+            _, declaration = self._find_component(element, reference, ('element',))
+            return self._compile_element(declaration, min_occurs, max_occurs)
+
+        target_namespace, qualified = self._get_schema_settings(element)
+        is_global = element.getparent() is not None and element.getparent().getparent() is None
+        form = element.get('form')
+        namespace = target_namespace if is_global or form == 'qualified' or (form is None and qualified) else None
+
+        node = SchemaNode(element.get('name'), namespace, element.get('type'), _get_documentation(element),
+                          min_occurs, max_occurs)
+        if node.type_name is not None:
+            node.children = self._compile_type_reference(element, node.type_name)
+        else:
+            for child in element:
+                if child.tag == COMPLEX_TYPE_TAG:
+                    node.children = self._compile_complex_type(child)
+        return node
+
+    def _compile_type_reference(self, element, type_name):
+        namespace, local_name = split_qname(element, type_name)
+        if namespace == XSD_NAMESPACE:
+            return []
+
+        type_key = (namespace, local_name)
+        children = self._complex_type_children.get(type_key)
+        if children is not None:
+            return children
+        if type_key in self._types_in_progress:
+            # Self-referencing type, the recursive occurrence is left without children
+            return []
+
+        _, type_element = self._find_component(element, type_name, ('complexType', 'simpleType'))
+        if type_element.tag == SIMPLE_TYPE_TAG:
+            children = []
+        else:
+            self._types_in_progress.add(type_key)
+            try:
+                children = self._compile_complex_type(type_element)
+            finally:
+                self._types_in_progress.discard(type_key)
+        self._complex_type_children[type_key] = children
+        return children
+
+    def _compile_complex_type(self, complex_type):
+        children = []
+        for child in complex_type:
+            if child.tag in MODEL_GROUP_TAGS or child.tag == GROUP_TAG:
+                self._compile_model_group(child, children)
+            elif child.tag == COMPLEX_CONTENT_TAG:
+                for derivation in child:
+                    if derivation.tag == EXTENSION_TAG:
+                        children.extend(self._compile_type_reference(derivation, derivation.get('base')))
+                    if derivation.tag in (EXTENSION_TAG, RESTRICTION_TAG):
+                        for particle in derivation:
+                            if particle.tag in MODEL_GROUP_TAGS or particle.tag == GROUP_TAG:
+                                self._compile_model_group(particle, children)
+            # simpleContent only adds text and attributes, there are no child elements to compile
+        return children
+
+    def _compile_model_group(self, group, children, optional=False, repeatable=False):
+        if group.tag == GROUP_TAG and group.get('ref') is not None:
+            optional = optional or _parse_occurs(group.get('minOccurs')) == 0
+            repeatable = repeatable or _parse_occurs(group.get('maxOccurs')) != 1
+            _, definition = self._find_component(group, group.get('ref'), ('group',))
+            for particle in definition:
+                if particle.tag in MODEL_GROUP_TAGS:
+                    self._compile_model_group(particle, children, optional, repeatable)
+            return
+
+        optional = optional or group.tag == CHOICE_TAG or _parse_occurs(group.get('minOccurs')) == 0
+        repeatable = repeatable or _parse_occurs(group.get('maxOccurs')) != 1
+        for particle in group:
+            if particle.tag == ELEMENT_TAG:
+                children.append(self._compile_element(
+                    particle,
+                    0 if optional else None,
+                    UNBOUNDED if repeatable else None,
+                ))
+            elif particle.tag in MODEL_GROUP_TAGS or particle.tag == GROUP_TAG:
+                self._compile_model_group(particle, children, optional, repeatable)
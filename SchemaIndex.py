@@ -0,0 +1,90 @@
+XSD_NAMESPACE = 'http://www.w3.org/2001/XMLSchema'
+XSD_TAG_PREFIX = '{' + XSD_NAMESPACE + '}'
+
+COMPONENT_KINDS = ('complexType', 'simpleType', 'element', 'group', 'attributeGroup')
+TYPE_KINDS = ('complexType', 'simpleType')
+
+
+def split_qname(element, prefixed_name):
+    """
+    Resolve a prefixed attribute value such as *etd:TTekstowy* against the namespaces in scope of element
+    :return: (namespace, local name) tuple, namespace is None when the prefix is unknown
+    """
+    if ':' in prefixed_name:
+        prefix, local_name = prefixed_name.split(':', 1)
+    else:
+        prefix, local_name = None, prefixed_name
+
+    return element.nsmap.get(prefix), local_name
+
+
+class ComponentIndex:
+    """
+    Top-level components of one schema document keyed by (kind, name), so a lookup is a single dict access and an
+    element never shadows a type of the same name
+    """
+    def __init__(self, schema_root):
+        self._target_namespace = schema_root.get('targetNamespace')
+        self._components = {}
+
+        # Global components are always direct children of xsd:schema. No need to dive into the tree
+        for child in schema_root:
+            tag = child.tag
+            if not isinstance(tag, str) or not tag.startswith(XSD_TAG_PREFIX):
+                continue
+            kind = tag[len(XSD_TAG_PREFIX):]
+            name = child.get('name')
+            if kind in COMPONENT_KINDS and name is not None:
+                self._components[(kind, name)] = child
+
+    def get_target_namespace(self):
+        return self._target_namespace
+
+    def find(self, name, kinds=TYPE_KINDS):
+        """
+        :param name: local name of the component
+        :param kinds: component kinds to look in, in order of preference
+        :return: the component element or None
+        """
+        for kind in kinds:
+            component = self._components.get((kind, name))
+            if component is not None:
+                return component
+
+        return None
+
+    def __len__(self):
+        return len(self._components)
+
+
+class SchemaIndex:
+    """
+    Component indexes of several schema documents keyed by their target namespace
+    """
+    def __init__(self):
+        self._namespaces = {}
+
+    def add(self, namespace, schema_root):
+        index = ComponentIndex(schema_root)
+        self._namespaces[namespace] = index
+        return index
+
+    def add_index(self, namespace, index):
+        """
+        :param index: a ComponentIndex, or anything else with its find(), such as a LazySchemaDocument
+        """
+        self._namespaces[namespace] = index
+        return index
+
+    def get(self, namespace):
+        return self._namespaces.get(namespace)
+
+    def __contains__(self, namespace):
+        return namespace in self._namespaces
+
+    def find(self, namespace, name, kinds=TYPE_KINDS):
+        index = self._namespaces.get(namespace)
+        if index is None:
+            return None
+
+        return index.find(name, kinds)
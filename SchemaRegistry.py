@@ -0,0 +1,197 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from ImportGraph import SchemaDocumentPool
+from Instrumentation import get_instrumentation
+from SchemaCache import get_default_cache
+from SchemaCompiler import SchemaCompiler
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DOCUMENT_POOL_SHARE = 0.25  # of max_bytes, for parsed schema documents; the rest is for compiled models
+DEFAULT_SCHEMAS = {'FunduszInwestycyjny': {'1-6': 'FunduszInwestycyjny_v1-6.xsd'}}
+
+_VERSION_PART = re.compile(r'(\d+)')
+
+
+def _version_sort_key(version):
+    """
+    '1-10' sorts after '1-9'
+    """
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in _VERSION_PART.split(version) if part]
+
+
+class _RegistryEntry:
+    """
+    What a Pipeline needs of a registered schema: its path and a load_or_compile that goes through the registry
+    """
+    def __init__(self, registry, schema_path):
+        self._registry = registry
+        self.schema_path = schema_path
+
+    def load_or_compile(self):
+        return self._registry.load(self.schema_path)
+
+
+class SchemaRegistry:
+    """
+    Maps a report type and version to its root XSD and hands out compiled schemas. A schema is compiled (or its
+    stored model loaded) on first use and then kept in memory. max_bytes is split between the models and one
+    SchemaDocumentPool, which DOCUMENT_POOL_SHARE of it goes to: the least recently used models are dropped once
+    their estimated size exceeds their share, and the pool drops its least recently used documents the same way.
+    Every compiler shares the pool, so an imported namespace common to several report versions is parsed and
+    indexed once; compilers keep no documents of their own between compiles.
+    """
+    def __init__(self, schemas=None, max_bytes=DEFAULT_MAX_BYTES, schema_cache=None, model_dir=None, verbose=False):
+        """
+        :param schemas: report type -> {version -> root XSD path}
+        :param max_bytes: estimated memory the compiled schemas and parsed schema documents kept in memory may take
+        """
+        self._schemas = {}
+        self._max_bytes = max_bytes
+        self._schema_cache = schema_cache if schema_cache is not None else get_default_cache()
+        self._model_dir = model_dir
+        self._verbose = verbose
+        self._document_pool_bytes = int(max_bytes * DOCUMENT_POOL_SHARE)
+        self._document_pool = SchemaDocumentPool(max_bytes=self._document_pool_bytes)
+        # schema path -> (SchemaCompiler, estimated bytes, CompiledSchema), least recently used first
+        self._compilers = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._path_locks = {}  # schema path -> lock held while it compiles, other schemas compile meanwhile
+        for report_type, versions in (schemas if schemas is not None else DEFAULT_SCHEMAS).items():
+            for version, schema_path in versions.items():
+                self.register(report_type, version, schema_path)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a registry from SCHEMA_REGISTRY, a JSON file of report type -> {version -> root XSD path}, and
+        SCHEMA_REGISTRY_MAX_MB environment variables
+        """
+        schemas = None
+        registry_path = os.getenv('SCHEMA_REGISTRY')
+        if registry_path:
+            with open(registry_path) as file:
+                schemas = json.load(file)
+        max_mb = os.getenv('SCHEMA_REGISTRY_MAX_MB')
+        return cls(schemas, max_bytes=int(max_mb) * 1024 * 1024 if max_mb else DEFAULT_MAX_BYTES)
+
+    def register(self, report_type, version, schema_path):
+        with self._lock:
+            self._schemas.setdefault(report_type, {})[str(version)] = schema_path
+
+    def get_report_types(self):
+        with self._lock:
+            return sorted(self._schemas)
+
+    def get_versions(self, report_type):
+        """
+        :return: the registered versions of report_type, oldest first
+        """
+        with self._lock:
+            versions = self._schemas.get(report_type)
+            if versions is None:
+                raise ValueError(f'Unknown report type {report_type}')
+            return sorted(versions, key=_version_sort_key)
+
+    def get_schema_paths(self):
+        """
+        :return: set of the root XSD paths of every registered report version
+        """
+        with self._lock:
+            return {schema_path for versions in self._schemas.values() for schema_path in versions.values()}
+
+    def get_schema_path(self, report_type, version=None):
+        """
+        :param version: (optional) the latest registered version when omitted
+        :return: path of the root XSD of the report version
+        """
+        if version is None:
+            version = self.get_versions(report_type)[-1]
+        with self._lock:
+            schema_path = self._schemas.get(report_type, {}).get(str(version))
+        if schema_path is None:
+            raise ValueError(f'Unknown version {version} of report type {report_type}')
+        return schema_path
+
+    def get(self, report_type, version=None):
+        """
+        :return: CompiledSchema of the report version, see get_schema_path
+        """
+        return self.load(self.get_schema_path(report_type, version))
+
+    def get_entry(self, schema_path):
+        """
+        :return: an object with the schema_path and a load_or_compile method, for Pipeline's schema_compiler
+        """
+        return _RegistryEntry(self, schema_path)
+
+    def load(self, schema_path):
+        """
+        :param schema_path: any root XSD, registered or not
+        :return: its CompiledSchema, from memory while the input documents are unchanged
+        """
+        with self._lock:
+            path_lock = self._path_locks.setdefault(schema_path, threading.Lock())
+
+        with path_lock:
+            with self._lock:
+                cached = self._compilers.get(schema_path)
+                if cached is not None:
+                    self._compilers.move_to_end(schema_path)
+            if cached is None:
+                get_instrumentation().count('schema_registry_misses')
+                compiler = SchemaCompiler(schema_path, self._schema_cache, self._model_dir, self._verbose,
+                                          document_pool=self._document_pool)
+            else:
+                get_instrumentation().count('schema_registry_hits')
+                compiler = cached[0]
+
+            # A kept compiler checks the recorded input digests and returns its last model when they are unchanged
+            compiled = compiler.load_or_compile()
+            if cached is None or cached[2] is not compiled:
+                self._store(schema_path, compiler, compiled)
+        return compiled
+
+    def _store(self, schema_path, compiler, compiled):
+        size = compiled.get_estimated_size()
+        with self._lock:
+            previous = self._compilers.pop(schema_path, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._compilers[schema_path] = (compiler, size, compiled)
+            self._size += size
+            # Evicting a model frees no pooled documents, the pool keeps itself within its own share. The schema
+            # just loaded stays even when it alone is larger than the models' share.
+            while self._size > self._max_bytes - self._document_pool_bytes and len(self._compilers) > 1:
+                evicted_path, (_, evicted_size, _) = self._compilers.popitem(last=False)
+                self._size -= evicted_size
+                path_lock = self._path_locks.get(evicted_path)
+                if path_lock is not None and not path_lock.locked():
+                    del self._path_locks[evicted_path]
+                get_instrumentation().count('schema_registry_evictions')
+                if self._verbose:
+                    print(f'Dropped compiled schema {evicted_path} from memory')
+
+    def get_stats(self):
+        with self._lock:
+            return {'loaded': list(self._compilers), 'estimated_bytes': self._size,
+                    'document_pool_bytes': self._document_pool.get_estimated_size(), 'max_bytes': self._max_bytes}
+
+
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+
+def get_default_registry():
+    """
+    Process-wide registry configured from the environment, created on first use
+    """
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = SchemaRegistry.from_env()
+    return _default_registry
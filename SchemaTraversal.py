@@ -0,0 +1,54 @@
+from Instrumentation import get_instrumentation
+from SchemaIndex import XSD_TAG_PREFIX
+
+SKIP_CHILDREN = ()
+
+
+class SchemaTraversal:
+    """
+    Explicit-stack walker over lxml schema trees, so nesting depth is bounded by memory rather than the recursion
+    limit. Handlers are looked up once per node in a dict keyed on the full namespaced tag; no string splitting.
+
+    A handler is called as handler(element, context) and returns either
+      None - visit every child of element with the same context
+      a sequence of (node, context) pairs - visit exactly those, in order. SKIP_CHILDREN stops the descent.
+    Returning explicit pairs is how handlers pass a new context down or splice in nodes from another document, such
+    as the base type of an extension.
+    """
+    def __init__(self, handlers, descend_unhandled=True):
+        """
+        :param handlers: dict of xsd tag suffix (e.g. 'element') -> handler
+        :param descend_unhandled: visit the children of nodes without a handler, or skip them
+        """
+        self._dispatch = {XSD_TAG_PREFIX + suffix: handler for suffix, handler in handlers.items()}
+        self._descend_unhandled = descend_unhandled
+        self.nodes_visited = 0
+
+    def walk(self, root, context=None):
+        dispatch_get = self._dispatch.get
+        descend_unhandled = self._descend_unhandled
+        stack = [(root, context)]
+        pop = stack.pop
+        extend = stack.extend
+        visited = 0
+
+        while stack:
+            element, element_context = pop()
+            visited += 1
+            handler = dispatch_get(element.tag)
+            if handler is None:
+                if not descend_unhandled:
+                    continue
+                children = None
+            else:
+                children = handler(element, element_context)
+
+            if children is None:
+                if len(element):
+                    extend([(child, element_context) for child in reversed(element)])
+            elif children:
+                extend(reversed(children))
+
+        self.nodes_visited += visited
+        get_instrumentation().count('schema_nodes_visited', visited)
+        return visited
@@ -0,0 +1,103 @@
+import os
+import threading
+
+from lxml import etree
+
+from Instrumentation import get_instrumentation
+from SchemaCache import get_default_cache
+
+MAX_REPORTED_ERRORS = 100
+
+
+class LocalStoreResolver(etree.Resolver):
+    """
+    Serves every document a schema includes or imports from the SchemaCache instead of letting libxml2 open it, so
+    compiling a validator reads the local store and at most revalidates it.
+    """
+    def __init__(self, schema_cache):
+        super().__init__()
+        self._schema_cache = schema_cache
+
+    def resolve(self, system_url, public_id, context):
+        location = system_url[len('file://'):] if system_url.startswith('file://') else system_url
+        return self.resolve_string(self._schema_cache.get(location), context, base_url=system_url)
+
+
+def _error_from_log_entry(entry):
+    return {
+        'line': entry.line,
+        'column': entry.column,
+        'path': entry.path,
+        'message': entry.message,
+        'level': entry.level_name,
+    }
+
+
+class SchemaValidator:
+    """
+    Validates generated documents against a compiled etree.XMLSchema. Compiling is the expensive part, so use
+    get_validator, which compiles each schema version once per process and hands the same validator to every
+    caller and thread.
+    """
+    def __init__(self, schema_path='FunduszInwestycyjny_v1-6.xsd', schema_cache=None):
+        """
+        :param schema_path: root XSD, either a local file or an URL
+        :param schema_cache: store the root and its imports are read from, defaults to the process-wide cache
+        """
+        schema_cache = schema_cache if schema_cache is not None else get_default_cache()
+        parser = etree.XMLParser(no_network=True)
+        parser.resolvers.add(LocalStoreResolver(schema_cache))
+        base_url = schema_path if '://' in schema_path else os.path.abspath(schema_path)
+
+        with get_instrumentation().phase('compile_validator'):
+            schema_document = etree.fromstring(schema_cache.get(schema_path), parser, base_url=base_url)
+            self._schema = etree.XMLSchema(schema_document)
+        self._lock = threading.Lock()  # the schema keeps the error log of its last run
+
+    def validate(self, document):
+        """
+        :param document: ElementTree or root element of the document
+        :return: list of errors, each a dict of line, column, path, message and level; empty when the document is valid
+        """
+        with get_instrumentation().phase('validate_xml'), self._lock:
+            if self._schema.validate(document):
+                return []
+            errors = [_error_from_log_entry(entry) for entry in self._schema.error_log]
+        get_instrumentation().count('validation_errors', len(errors))
+        return errors[:MAX_REPORTED_ERRORS]
+
+    def validate_file(self, path):
+        """
+        :param path: XML document, gzip compressed or not
+        :return: see validate; a document that is not well-formed yields its syntax errors
+        """
+        parser = etree.XMLParser(no_network=True, huge_tree=True)
+        try:
+            document = etree.parse(path, parser)
+        except etree.XMLSyntaxError:
+            return [_error_from_log_entry(entry) for entry in parser.error_log][:MAX_REPORTED_ERRORS]
+        return self.validate(document)
+
+
+_validators = {}
+_validators_lock = threading.Lock()
+
+
+def get_validator(schema_path='FunduszInwestycyjny_v1-6.xsd', key=None, schema_cache=None):
+    """
+    Process-wide validator for one schema version, compiled on first use
+    :param schema_path: root XSD
+    :param key: identifies the schema version, e.g. CompiledSchema.get_key(); defaults to the digest of the root XSD
+    :param schema_cache: store the schema documents are read from, defaults to the process-wide cache
+    :return: SchemaValidator
+    """
+    schema_cache = schema_cache if schema_cache is not None else get_default_cache()
+    if key is None:
+        key = schema_cache.digest(schema_path) or schema_path
+    with _validators_lock:
+        validator = _validators.get((schema_path, key))
+        if validator is None:
+            validator = _validators[(schema_path, key)] = SchemaValidator(schema_path, schema_cache)
+        else:
+            get_instrumentation().count('validator_cache_hits')
+    return validator
@@ -1,17 +1,9 @@
-import requests as req
 from lxml import etree
 
-
-def get_tag_suffix(element):
-    return element.tag.split('}')[1]
-
-
-def find_by_name(import_root, base_name):
-    for child_elem in import_root:
-        if child_elem.get('name') == base_name:
-            return child_elem
-
-    return None
+from Instrumentation import get_instrumentation
+from SchemaCache import get_default_cache
+from SchemaIndex import ComponentIndex, TYPE_KINDS
+from SchemaTraversal import SchemaTraversal, SKIP_CHILDREN
 
 
 class SchemaWalker:
@@ -23,8 +15,8 @@ class SchemaWalker:
             element.get('type', 'No type specified')
         ]
 
-    def __init__(self, schema_path='FunduszInwestycyjny_v1-6.xsd', verbose=True):
-        
+    def __init__(self, schema_path='FunduszInwestycyjny_v1-6.xsd', verbose=True, schema_cache=None):
+
         with open(schema_path) as file:
             self._schema_doc = etree.parse(file)
 
@@ -33,88 +25,84 @@ class SchemaWalker:
         self._tag_prefix = '{' + self._schema.nsmap.get('xsd') + '}'  # All tags are prefixed with this xsd namespace
         self._result = []
         self._verbose = verbose
-
-    def _process_tree_element(self, element):
-        """
-        Each element is processed differently and can be nested under each other element.
-        Choosing to go with recursive approach and switch on element type.
-        """
-        tag_suffix = get_tag_suffix(element)
-
-        if tag_suffix == 'element':
-            self._process_element_tag(element)
-        elif tag_suffix == 'complexType':
-            self._process_complex_type_tag(element)
-        elif tag_suffix == 'complexContent':
-            self._process_complex_content_tag(element)
-        elif tag_suffix == 'sequence':
-            for sequence_child in element.iterchildren():
-                self._process_tree_element(sequence_child)
-        else:
-            pass
-
-    def _process_element_tag(self, element):
+        self._schema_cache = schema_cache if schema_cache is not None else get_default_cache()
+        self._import_indexes = {}  # schemaLocation -> ComponentIndex of the imported namespace
+        self._annotation_tag = self._tag_prefix + 'annotation'
+        self._traversal = self._build_traversal()
+
+    def _build_traversal(self):
+        return SchemaTraversal({
+            'element': self._process_element_tag,
+            'annotation': self._process_annotation_tag,
+            'complexType': self._process_complex_type_tag,
+            'complexContent': self._process_complex_content_tag,
+            'sequence': self._process_sequence_tag,
+        }, descend_unhandled=False)
+
+    def _process_element_tag(self, element, row=None):
         """
         Element tags are the ones we're most interested in. They define the tags that need to be in the xml in question.
         Usually have 1 annotation + doccumentation child tag with additional info.
-        Might have other children tags
+        Might have other children tags. The annotation child receives the row so it can complete and append it.
         """
         row = self._initiate_row(element)
-        if len(list(element)) < 1:
+        if len(element) < 1:
             row.extend(['No documentation'])
             self._result.append(row)
-        else:
-            for child in element.iterchildren():
-                if get_tag_suffix(child) == 'annotation':
-                    docstring = child[0].text
-                    row.append(docstring)
-                    self._result.append(row)
-                else:
-                    self._process_tree_element(child)
-    
-    def _process_complex_type_tag(self, element):
+            return SKIP_CHILDREN
+
+        return [(child, row if child.tag == self._annotation_tag else None) for child in element]
+
+    def _process_annotation_tag(self, element, row):
+        if row is not None:
+            docstring = element[0].text
+            row.append(docstring)
+            self._result.append(row)
+        return SKIP_CHILDREN
+
+    def _process_complex_type_tag(self, element, row=None):
         """
         ComplexType tag usually just has 1 child, the sequence tag.
         """
-        elem_children = list(element)
-        if len(elem_children) > 1:
+        if len(element) > 1:
             # If the complexType tag has multiple children and not just the sequence, it must have an annotation & a
             # sequence tags. Therefore, treat it as an element tag
-            self._process_element_tag(element)
-        else:
-            child_tag = elem_children[0]
-            self._process_tree_element(child_tag)
+            return self._process_element_tag(element)
+
+        return [(element[0], None)]
 
-    def _process_complex_content_tag(self, element):
+    def _process_complex_content_tag(self, element, row=None):
         """
         Complex content tag appears once, has an extension tag and a sequence tag as children. Need to make network
         requests to process the extension
         """
         extension_tag = element[0]
-        self._process_extension_tag(extension_tag)
         sequence_tag = extension_tag[0]
-        self._process_tree_element(sequence_tag)
-    
+        return [(self._process_extension_tag(extension_tag), None), (sequence_tag, None)]
+
+    def _process_sequence_tag(self, element, row=None):
+        return [(child, None) for child in element]
+
     def _process_extension_tag(self, element):
         """
         To process this tag we need to pull the element that is being extended from a different namespace.
         The root element has import tags that give web addresses for where to pull the namespace from.
         The namespace is a similar xml document with a bunch of elements besides what we actually need.
+        :return: The base element, to be walked in place of the extension
         """
 
-        base_element = self.load_base_element(element)
-        self._process_tree_element(base_element)
+        return self.load_base_element(element)
 
     def parse_tree(self):
         """
-        Kick off the recursive tree walker function on root element
+        Kick off the tree walker on root element
         :return: The matrix intended to be passed to spreadsheets API for the client to fill in data
         """
-        self._process_tree_element(self._root_element)
+        with get_instrumentation().phase('parse_tree'):
+            self._traversal.walk(self._root_element)
         if self._verbose:
-            # for row in self._result:
-            #     print(row)
-            print(self._result)
+            print(f'{len(self._result)} rows from {self._traversal.nodes_visited} schema nodes, '
+                  f'{len(self._import_indexes)} imported namespaces')
 
         return self._result
 
@@ -144,16 +132,23 @@ class SchemaWalker:
         if import_namespace_url is None:
             raise ValueError('Import tag does not have *schemaLocation* attribute')
 
-        schema_response = req.get(import_namespace_url)
-        if not schema_response.ok:
-            raise RuntimeError('Request for imported namespace did not go through')
-        import_root = etree.fromstring(schema_response.content)
-        base_element = find_by_name(import_root, base_name)
+        base_element = self._load_import_index(import_namespace_url).find(base_name, TYPE_KINDS)
         if base_element is None:
             raise ValueError('Base element was not found in the imported namespace xml')
 
         return base_element
 
+    def _load_import_index(self, import_namespace_url):
+        """
+        Parse and index each imported namespace once per walker; the bytes come from the persistent schema cache
+        """
+        import_index = self._import_indexes.get(import_namespace_url)
+        if import_index is None:
+            import_index = ComponentIndex(etree.fromstring(self._schema_cache.get(import_namespace_url)))
+            self._import_indexes[import_namespace_url] = import_index
+
+        return import_index
+
     def get_root_name(self):
         return self._root_element.get('name')
 
@@ -1,10 +1,19 @@
+from array import array
+import csv
+import sys
+
 from lxml import etree
-import requests
-import tempfile
+
+from ImportGraph import ImportResolver
+from Instrumentation import get_instrumentation
+from SchemaCache import get_default_cache
+from SchemaIndex import SchemaIndex, TYPE_KINDS, XSD_NAMESPACE, split_qname
+from SchemaTraversal import SKIP_CHILDREN, SchemaTraversal
 
 
 class SchemaWalker:
-    def __init__(self, schema_path= 'FunduszInwestycyjny_v1-6.xsd', verbose= False):
+    def __init__(self, schema_path= 'FunduszInwestycyjny_v1-6.xsd', verbose= False, schema_cache=None):
+        self._schema_path = schema_path
         with open(schema_path) as file:
             self._schema_doc = etree.parse(file)
 
@@ -12,50 +21,23 @@ class SchemaWalker:
 
         self._tag_prefix = '{' + self._schema_root.nsmap.get('xsd') + '}'  # All tags are prefixed with this xsd namespace
         self._result = SchemaParseOutput()
-        self._imported_trees = {}
+        self._imported_index = SchemaIndex()  # namespace -> LazySchemaDocument of that imported document
+        self._import_graph = None
+        self._dependency_graph = None
+        self._unwalked_global_tags = {self._tag_prefix + 'import', self._tag_prefix + 'annotation'}
         self._verbose = verbose
-        self._temporary_files = []
+        self._schema_cache = schema_cache if schema_cache is not None else get_default_cache()
+        self._element_tag = self._tag_prefix + 'element'
+        self._type_templates = {}  # (namespace, name) -> _TypeTemplate of the rows the named type expands to
+        self._types_in_progress = set()
+        self._traversal = self._build_traversal()
         self._base_types = {
             'xsd:token', 'xsd:string', 'xsd:decimal', 'xsd:int', 'xsd:nonNegativeInteger', 'xsd:date', 'xsd:dateTime',
             'xsd:gYear', 'xsd:byte'
         }
 
-    def __del__(self):
-        for file in self._temporary_files:
-            file.close()
-        # Garbage collect temporary xsd files
-
-    @staticmethod
-    def _get_tag_suffix(element):
-        return element.tag.split('}')[1]
-
-    @staticmethod
-    def _find_import_tags(imported_tree_root):
-        import_tags = []
-        # import elements can only be found on the top-level. No need to dive into the tree
-        for child_elem in imported_tree_root.iter('import'):
-            if SchemaWalker._get_tag_suffix(child_elem) == 'import':
-                import_tags.append(child_elem)
-
-        return import_tags
-
-    def parse_tree(self):
-        """
-        Kick off the recursive tree walker function on root element
-        :return: The matrix intended to be passed to spreadsheets API for the client to fill in data
-        """
-        self._process_tree_element(self._schema_root)
-        if self._verbose:
-            print(self._result)
-
-        return self._result.to_list()
-
-    def _process_tree_element(self, element):
-        """
-        Each element is processed differently and can be nested under each other element.
-        Choosing to go with recursive approach and switch on element type.
-        """
-        tag_suffix_to_function_map = {
+    def _build_traversal(self):
+        return SchemaTraversal({
             'element': self._process_element_tag,
             'annotation': self._process_annotation_tag,
             'documentation': self._process_documentation_tag,
@@ -66,162 +48,334 @@ class SchemaWalker:
             'import': self._process_import_tag,
             'simpleType': self._process_simple_type,
             'restriction': self._process_restriction,
-        }
-        tag_suffix = self._get_tag_suffix(element)
+        })
 
-        elem_processing_function = tag_suffix_to_function_map.get(tag_suffix)
-        if elem_processing_function is None:
-            if self._verbose:
-                print(f'No function in map for element {tag_suffix}')
-        else:
-            elem_processing_function(element)
+    def parse_tree(self):
+        """
+        Kick off the tree walker on root element
+        :return: SchemaParseOutput; iter_matrix() streams it in the format passed to spreadsheets API for the client
+        to fill in data, write_csv() writes it to a file
+        """
+        self._result = SchemaParseOutput()
+        with get_instrumentation().phase('parse_tree'):
+            self._resolve_imports()
+            self._traversal.walk(self._schema_root)
+        if self._verbose:
+            print(f'{len(self._result)} rows from {self._traversal.nodes_visited} schema nodes, '
+                  f'{len(self._import_graph)} imported namespaces, '
+                  f'{sum(imported.document.get_materialized_count() for imported in self._import_graph)} '
+                  f'imported components parsed')
 
-        for child_elem in element:
-            self._process_tree_element(child_elem)
+        return self._result
 
-    def _process_element_tag(self, element):
+    def _process_element_tag(self, element, parent_row):
+        """
+        Every handler receives the row of the closest enclosing element; the element's own children, and then the
+        children of its named type, are walked with the new row as their parent
+        """
         element_type = element.get('type')
-        if element_type is not None:
-            element_type = self._extend_type(element_type)
-
-        self._result.append(SchemaParseOutputRow(
+        row = self._result.append(
             element.get('name'),
             element_type,
+            parent_row=parent_row,
             min_occurs=element.get('minOccurs'),
             max_occurs=element.get('maxOccurs')
-        ))
+        )
 
-    def _process_annotation_tag(self, element):
+        children = [(child, row) for child in element]
+        if element_type is not None:
+            type_element = self._extend_type(element_type)
+            if type_element is not None:
+                children.append((type_element, row))
+        return children
+
+    def _process_annotation_tag(self, element, parent_row):
         pass
 
-    def _process_documentation_tag(self, element):
-        parent_row = self._result.get_last_row()
-        parent_row.set_documentation(element.text)
+    def _process_documentation_tag(self, element, parent_row):
+        # Only the element's own annotation documents the row, not the annotation of the type it uses
+        if parent_row is not None and element.getparent().getparent().tag == self._element_tag:
+            parent_row.set_documentation(element.text)
 
-    def _process_complexType_tag(self, element):
-        pass
+    def _process_complexType_tag(self, element, parent_row):
+        """
+        A named type is expanded into rows once and every later use stamps out copies under its own parent row,
+        so shared types are walked once no matter how many elements refer to them
+        """
+        type_name = element.get('name')
+        if type_name is None:
+            return None
+
+        key = (element.getroottree().getroot().get('targetNamespace'), type_name)
+        template = self._type_templates.get(key)
+        if template is None:
+            if key in self._types_in_progress:
+                # The type contains itself; its rows are already being expanded further up, so stop here
+                get_instrumentation().count('schema_type_recursion_cuts')
+                if self._verbose:
+                    print(f'Recursive type {type_name} is not expanded again')
+                return SKIP_CHILDREN
+            template = self._type_templates[key] = self._expand_type(key, element)
+        else:
+            get_instrumentation().count('schema_type_template_reuses')
 
-    def _process_sequence_tag(self, element):
-        parent_row = self._result.get_last_row()
-        parent_row.set_is_sequence(True)
+        template.stamp(self._result, parent_row)
+        return SKIP_CHILDREN
 
-    def _process_complexContent_tag(self, element):
+    def _expand_type(self, key, type_element):
+        """
+        Walk a named type once, collecting its rows under a placeholder parent instead of the real result
+        """
+        get_instrumentation().count('schema_type_expansions')
+        template = _TypeTemplate()
+        outer_result = self._result
+        self._result = template.rows
+        self._types_in_progress.add(key)
+        try:
+            for child in type_element:
+                self._traversal.walk(child, template.placeholder)
+        finally:
+            self._types_in_progress.discard(key)
+            self._result = outer_result
+        return template
+
+    def _process_sequence_tag(self, element, parent_row):
+        if parent_row is not None:
+            parent_row.set_is_sequence(True)
+
+    def _process_complexContent_tag(self, element, parent_row):
         pass
 
-    def _process_extension_tag(self, element):
+    def _process_extension_tag(self, element, parent_row):
         base_tag_name = element.get('base')
         if base_tag_name in self._base_types:
-            self._result.get_last_row().set_type(base_tag_name)
-        else:
-            base_element = self._search_imports(base_tag_name)
-            self._process_tree_element(base_element)
-
-    def _process_import_tag(self, element):
-        remote_schema_url = element.get('schemaLocation')
-        remote_schema_namespace = element.get('namespace')
-        remote_schema_bytes = requests.get(remote_schema_url).content
-        imported_tree_root = etree.fromstring(remote_schema_bytes)
-        self._imported_trees[remote_schema_namespace] = imported_tree_root
-        self._save_tree_in_file(imported_tree_root, element)
-
-        nested_import_tags = self._find_import_tags(imported_tree_root)
-        for import_tag in nested_import_tags:
-            self._process_import_tag(import_tag)
-
-    def _save_tree_in_file(self, imported_tree, element):
-        file_save = tempfile.NamedTemporaryFile()
-        file_save.write(etree.tostring(imported_tree))
-        self._temporary_files.append(file_save)
-        element.attrib['schemaLocation'] = file_save.name
+            if parent_row is not None:
+                parent_row.set_type(base_tag_name)
+            return None
 
-    def _extend_type(self, base_tag_name):
         base_element = self._search_imports(base_tag_name)
-        self._process_tree_element(base_element)
+        if base_element is None:
+            return None
+        return [(base_element, parent_row)] + [(child, parent_row) for child in element]
+
+    def _resolve_imports(self):
+        """
+        Fetch only the imported documents the walk will reach: every global declaration of the root schema is
+        walked, so the dependency analysis starts from all of them. Imported documents are only scanned for their
+        top-level components; a component is parsed when the analysis first reaches it, so parse time and memory
+        follow what the report uses rather than the size of the libraries.
+        """
+        start_elements = [child for child in self._schema_root
+                          if isinstance(child.tag, str) and child.tag not in self._unwalked_global_tags]
+        self._dependency_graph = ImportResolver(self._schema_cache, verbose=self._verbose, lazy=True).resolve_reachable(
+            self._schema_root, self._schema_path, start_elements)
+        self._import_graph = self._dependency_graph.get_import_graph()
+        for imported_schema in self._import_graph:
+            self._imported_index.add_index(imported_schema.namespace, imported_schema.get_index())
+        if self._verbose:
+            print(self._import_graph.to_dict())
+            for from_key, key in self._dependency_graph.get_missing():
+                print(f'{key[2]} used by {from_key[2]} was not found in namespace {key[0]}')
+
+    def get_import_graph(self):
+        return self._import_graph
 
-    def _search_imports(self, base_tag):
+    def get_dependency_graph(self):
+        """
+        :return: DependencyGraph of the components and namespaces the last parse_tree reached
+        """
+        return self._dependency_graph
+
+    def _process_import_tag(self, element, parent_row):
+        # Imports are resolved up front by _resolve_imports
+        return SKIP_CHILDREN
+
+    def _extend_type(self, base_tag_name):
+        """
+        :return: The named type the element refers to, or None for built-in xsd types
+        """
+        namespace, _ = split_qname(self._schema_root, base_tag_name)
+        if namespace == XSD_NAMESPACE:
+            return None
+        return self._search_imports(base_tag_name)
+
+    def _search_imports(self, base_tag, kinds=TYPE_KINDS):
         namespace_shorthand, tag = base_tag.split(':')
         namespace = self._schema_root.nsmap.get(namespace_shorthand)
-        imported_tree = self._imported_trees.get(namespace)
-        if imported_tree is None:
+        if namespace not in self._imported_index:
             if self._verbose:
                 print('Namespace is not in imported_tree keys. Cannot search imports')
         else:
-            for element in imported_tree.iter():
-                if element.get('name') == tag:
-                    return element
+            return self._imported_index.find(namespace, tag, kinds)
 
-    def _process_simple_type(self, element):
+    def _process_simple_type(self, element, parent_row):
         pass
 
-    def _process_restriction(self, element):
+    def _process_restriction(self, element, parent_row):
         pass
 
 
+class _TypeTemplate:
+    """
+    Rows a named type expands to, parented to a placeholder (row 0) that stands in for the row of the element using
+    the type
+    """
+    def __init__(self):
+        self.rows = SchemaParseOutput()
+        self.placeholder = self.rows.append('', None)
+
+    def stamp(self, result, parent_row):
+        """
+        Append a copy of every row to result, with the placeholder replaced by parent_row
+        """
+        result.extend_from_template(self.rows, parent_row)
+
+        # Effects the type has on the element using it
+        if parent_row is not None:
+            if self.placeholder.is_sequence():
+                parent_row.set_is_sequence(True)
+            if self.placeholder.get_type() != SchemaParseOutputRow.NO_TYPE:
+                parent_row.set_type(self.placeholder.get_type())
+
+
+def _parse_occurs(value):
+    if value is None:
+        return 0
+    if value == 'unbounded':
+        return -1
+    return int(value)
+
+
 class SchemaParseOutput:
+    """
+    Column store of the walker's rows: one list or typed array per field instead of an object per row. Names and
+    types are interned, flags and occurrence bounds are machine integers, parents are row indexes (-1 for none) and
+    documentation is only stored for the rows that have it. SchemaParseOutputRow is a view of one row.
+    """
+    HEADERS = ('Name', 'Type', 'Documentation', 'Is sequence', 'Parent row', 'Min occurs', 'Max occurs')
+
     def __init__(self):
-        self._rows = []
+        self._names = []
+        self._types = []
+        self._documentation = {}  # row index -> text
+        self._is_sequence = bytearray()
+        self._parents = array('l')
+        self._min_occurs = array('l')
+        self._max_occurs = array('l')
+
+    def append(self, tag_name, tag_type, parent_row=None, min_occurs=None, max_occurs=None):
+        """
+        :return: SchemaParseOutputRow view of the new row
+        """
+        if tag_name is None:
+            raise RuntimeError('Element tag with no name')
+        index = len(self._names)
+        self._names.append(sys.intern(tag_name))
+        self._types.append(SchemaParseOutputRow.NO_TYPE if tag_type is None else sys.intern(tag_type))
+        self._is_sequence.append(0)
+        self._parents.append(-1 if parent_row is None else parent_row.get_index())
+        self._min_occurs.append(_parse_occurs(min_occurs))
+        self._max_occurs.append(_parse_occurs(max_occurs))
+        return SchemaParseOutputRow(self, index)
+
+    def extend_from_template(self, template, parent_row):
+        """
+        Append every row of template but its first, which stands for parent_row
+        """
+        offset = len(self._names) - 1  # template row i becomes row offset + i
+        parent_index = -1 if parent_row is None else parent_row.get_index()
+        self._names.extend(template._names[1:])
+        self._types.extend(template._types[1:])
+        self._is_sequence.extend(template._is_sequence[1:])
+        self._parents.extend(parent_index if parent == 0 else offset + parent for parent in template._parents[1:])
+        self._min_occurs.extend(template._min_occurs[1:])
+        self._max_occurs.extend(template._max_occurs[1:])
+        for index, documentation in template._documentation.items():
+            if index:
+                self._documentation[offset + index] = documentation
+
+    def get_row_values(self, index):
+        parent = self._parents[index]
+        return [
+            self._names[index],
+            self._types[index],
+            self._documentation.get(index, ''),
+            bool(self._is_sequence[index]),
+            '' if parent < 0 else parent,
+            self._min_occurs[index],
+            self._max_occurs[index],
+        ]
+
+    def iter_matrix(self, headers=True):
+        """
+        Stream the rows in the Spreadsheets matrix format, one list at a time
+        :param headers: start with the header row
+        """
+        if headers:
+            yield list(self.HEADERS)
+        for index in range(len(self._names)):
+            yield self.get_row_values(index)
 
     def to_list(self):
-        headers = self._rows.get_headers()
-        rows = [row.to_list() for row in self._rows]
-        headers.extend(rows)
+        return list(self.iter_matrix())
+
+    def write_csv(self, file):
+        """
+        :param file: text file opened for writing with newline=''
+        """
+        csv.writer(file).writerows(self.iter_matrix())
 
-        return headers
+    def __len__(self):
+        return len(self._names)
 
-    def append(self, out_row):
-        self._rows.append(out_row)
+    def __iter__(self):
+        return (SchemaParseOutputRow(self, index) for index in range(len(self._names)))
 
     def get_last_row(self):
-        if len(self._rows):
-            return self._rows[-1]
+        if len(self._names):
+            return SchemaParseOutputRow(self, len(self._names) - 1)
         else:
             raise RuntimeError('Trying to get parent row with no rows set')
 
 
 class SchemaParseOutputRow:
-    def __init__(self, tag_name, tag_type, tag_docstring='', is_sequence=False,
-                 parent_row=None, min_occurs=None, max_occurs=None):
-        if tag_name is None:
-            raise RuntimeError('Element tag with no name')
-        self._tag_name = tag_name
-
-        if tag_type is None:
-            tag_type = 'No type specified'
-        self._tag_type = tag_type
+    """
+    View of one row of a SchemaParseOutput
+    """
+    __slots__ = ('_output', '_index')
+    NO_TYPE = 'No type specified'
 
-        self._tag_docstring = tag_docstring
-        self._is_sequence = is_sequence
-        self._parent_row = parent_row
+    def __init__(self, output, index):
+        self._output = output
+        self._index = index
 
-        if min_occurs is None:
-            min_occurs = 0
-        self._min_occurs = min_occurs
+    def get_index(self):
+        return self._index
 
-        if max_occurs is None:
-            max_occurs = 0
-        elif max_occurs == 'unbounded':
-            max_occurs = -1
-        self._max_occurs = max_occurs
+    def get_name(self):
+        return self._output._names[self._index]
 
     def set_documentation(self, documentation_string):
-        self._tag_docstring = documentation_string
+        self._output._documentation[self._index] = documentation_string or ''
 
     def set_is_sequence(self, is_sequence):
-        self._is_sequence = is_sequence
+        self._output._is_sequence[self._index] = 1 if is_sequence else 0
+
+    def is_sequence(self):
+        return bool(self._output._is_sequence[self._index])
 
     def set_type(self, tag_type):
-        self._tag_type = tag_type
+        self._output._types[self._index] = sys.intern(tag_type)
+
+    def get_type(self):
+        return self._output._types[self._index]
+
+    def get_parent_row(self):
+        parent = self._output._parents[self._index]
+        return None if parent < 0 else SchemaParseOutputRow(self._output, parent)
 
     def to_list(self):
-        return [
-            self._tag_name,
-            self._tag_type,
-            self._tag_docstring,
-            self._is_sequence,
-            self._parent_row,
-            self._min_occurs,
-            self._max_occurs,
-        ]
+        return self._output.get_row_values(self._index)
 
 
 if __name__ == '__main__':
@@ -229,7 +383,6 @@ if __name__ == '__main__':
         schema_path='FunduszInwestycyjny_v1-6.xsd',
         verbose=True
     )
-    result_list = sw.parse_tree()
-    with open('schema_walker_result.csv') as res:
-        for row in result_list:
-            res.write(','.join(row))
+    result = sw.parse_tree()
+    with open('schema_walker_result.csv', 'w', newline='', encoding='utf-8') as res:
+        result.write_csv(res)
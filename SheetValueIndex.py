@@ -0,0 +1,150 @@
+import re
+from itertools import chain
+
+PATH_SEPARATOR = '/'
+NAME_HEADER = 'Name'
+PATH_HEADER = 'Path'
+VALUE_HEADER = 'Value'
+
+_OCCURRENCE = re.compile(r'^(.*)\[(\d+)\]$')
+
+
+def child_path(parent_path, name, occurrence=1):
+    """
+    Canonical path of an element: names from the root joined by '/', with [n] after every repeated occurrence
+    past the first, i.e. Raport/Pozycja[2]/Opis
+    """
+    segment = name if occurrence == 1 else f'{name}[{occurrence}]'
+    return segment if parent_path is None else parent_path + PATH_SEPARATOR + segment
+
+
+def _split_segment(segment):
+    match = _OCCURRENCE.match(segment)
+    if match is None:
+        return segment, 1
+    return match.group(1), int(match.group(2))
+
+
+class SheetValueIndex:
+    """
+    Values the client entered, keyed by schema path and occurrence so that equally named elements in different
+    branches, and every occurrence of a repeated element, keep their own value. Values given by bare element name
+    are kept as a fallback for maps and sheets without a path column. Built in one pass; lookups are dict hits.
+    """
+    def __init__(self):
+        self._by_path = {}  # canonical path -> value
+        self._by_name = {}  # element name -> value
+        self._occurrences = {}  # (canonical parent path, name) -> highest occurrence with a value
+        self._filled_paths = None  # every canonical path with a value at or below it, built on first use
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        :param rows: sheet rows. When the first row is the header written by CompiledSchema.to_matrix, values are
+        read from its Value column and keyed by its Path column; otherwise the first cell is the element name and
+        the last cell its value.
+        """
+        index = cls()
+        rows = iter(rows)
+        header = next(rows, None)
+        if header is None:
+            return index
+
+        if header and header[0] == NAME_HEADER and PATH_HEADER in header:
+            name_column = 0
+            path_column = header.index(PATH_HEADER)
+            value_column = header.index(VALUE_HEADER) if VALUE_HEADER in header else None
+            for row in rows:
+                if value_column is None:
+                    value = row[-1] if len(row) > path_column + 1 else None
+                else:
+                    value = row[value_column] if len(row) > value_column else None
+                if value is None or value == '':
+                    continue
+                path = row[path_column] if len(row) > path_column else ''
+                if path:
+                    index.add_path(path, value)
+                elif row:
+                    index.add_name(row[name_column], value)
+        else:
+            for row in chain([header], rows):
+                if row:
+                    index.add_name(row[0], row[-1])
+        return index
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        """
+        :param mapping: key -> value, where a key containing '/' is a path and any other key an element name
+        """
+        index = cls()
+        for key, value in mapping.items():
+            if PATH_SEPARATOR in key:
+                index.add_path(key, value)
+            else:
+                index.add_name(key, value)
+        return index
+
+    def add_path(self, path, value):
+        parent_path = None
+        for segment in path.strip(PATH_SEPARATOR).split(PATH_SEPARATOR):
+            name, occurrence = _split_segment(segment.strip())
+            if occurrence > 1:
+                key = (parent_path, name)
+                if occurrence > self._occurrences.get(key, 1):
+                    self._occurrences[key] = occurrence
+            parent_path = child_path(parent_path, name, occurrence)
+        self._by_path[parent_path] = value
+        self._filled_paths = None
+
+    def add_name(self, name, value):
+        self._by_name[name] = value
+
+    def get(self, path, name, default=None):
+        """
+        :return: the value at path, else the value given for the bare element name, else default
+        """
+        value = self._by_path.get(path)
+        if value is None:
+            value = self._by_name.get(name, default)
+        return value
+
+    def has_values_under(self, path, names=()):
+        """
+        :param names: element names below path, checked against the values given by bare name
+        :return: whether a value was given for path or any element below it
+        """
+        if self._filled_paths is None:
+            filled_paths = set()
+            for value_path in self._by_path:
+                while value_path not in filled_paths:
+                    filled_paths.add(value_path)
+                    separator = value_path.rfind(PATH_SEPARATOR)
+                    if separator < 0:
+                        break
+                    value_path = value_path[:separator]
+            self._filled_paths = filled_paths
+        return path in self._filled_paths or any(name in self._by_name for name in names)
+
+    def get_occurrences(self, parent_path, name):
+        """
+        :return: how many occurrences of element name under parent_path have values, at least 1
+        """
+        return self._occurrences.get((parent_path, name), 1)
+
+    def get_occurrence_signature(self):
+        """
+        :return: sorted list of every repeated element and its occurrence count; documents built from indexes with
+        equal signatures have the same structure
+        """
+        return sorted([parent_path or '', name, count] for (parent_path, name), count in self._occurrences.items())
+
+    def items(self):
+        """
+        :return: every (canonical path or element name, value)
+        """
+        yield from self._by_path.items()
+        yield from self._by_name.items()
+
+    def __len__(self):
+        return len(self._by_path) + len(self._by_name)
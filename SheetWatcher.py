@@ -0,0 +1,206 @@
+#!/usr/local/bin/python3
+import argparse
+import hashlib
+import json
+import os
+import signal
+import threading
+import time
+
+from IncrementalGenerator import IncrementalGenerator
+from Instrumentation import get_instrumentation
+from SchemaCache import get_default_cache
+from SchemaValidator import get_validator
+
+
+def get_value_digest(sheet_values):
+    '''
+    :param sheet_values: a SheetValueIndex
+
+    :return digest: sha256 of the values and the occurrences of repeated elements, equal for sheets that generate
+    the same document
+    '''
+    content = json.dumps([sorted([str(key), str(value)] for key, value in sheet_values.items()),
+                          sheet_values.get_occurrence_signature()], ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class SheetWatcher:
+    '''
+    Keeps an XML document in step with a sheet and its schema. The sheet is polled every interval seconds; a
+    response whose body hashes to the previous one is not even parsed, and a value map that equals the previous one
+    generates nothing. The schema is checked on every poll too, which costs a manifest lookup while its documents
+    are unchanged: local schema files are hashed on every poll, remote imports are revalidated with the server
+    every import_interval seconds. Only a real change of either regenerates the document, through
+    IncrementalGenerator, so just the changed fragments are rendered again. While nothing changes the interval
+    grows by backoff up to max_interval, and it drops back to interval on the next change. Failed polls back off
+    the same way.
+    '''
+
+    def __init__(self, spreadsheets_api, schema_compiler, spreadsheet_id, sheet_id, output_path='XML_from_schema.xml',
+                 region=':', interval=10.0, max_interval=300.0, backoff=2.0, validate_schema_path=None, verbose=True,
+                 schema_cache=None, import_interval=300.0):
+        '''
+        :param spreadsheets_api: the SpreadsheetsApi to read the sheet with, authenticated through a TokenProvider
+        so the token is refreshed only when it expires
+        :param schema_compiler: a SchemaCompiler, or anything else with load_or_compile, e.g. a SchemaRegistry entry
+        :param spreadsheet_id: the spreadsheet holding the client's values
+        :param sheet_id: the sheet holding the client's values
+        :param output_path: document path, gzip compressed when it ends in .gz
+        :param region: the sheet region to read
+        :param interval: seconds between polls after a change
+        :param max_interval: longest wait between polls while the sheet is idle
+        :param backoff: factor the wait grows by after every poll without a change
+        :param validate_schema_path: (optional) root XSD to validate every regenerated document against
+        :param verbose: print a line per regeneration and per failed poll
+        :param schema_cache: the SchemaCache schema_compiler fetches imports through, the default one when omitted
+        :param import_interval: seconds between revalidations of the remote imports of the schema
+        '''
+        self._spreadsheets_api = spreadsheets_api
+        self._schema_compiler = schema_compiler
+        self._spreadsheet_id = spreadsheet_id
+        self._sheet_id = sheet_id
+        self._output_path = output_path
+        self._region = region
+        self._interval = interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._validate_schema_path = validate_schema_path
+        self._verbose = verbose
+        self._body_digest = None
+        self._value_digest = None
+        self._schema_key = None
+        self._schema_inputs = ()  # input documents of the last compiled schema
+        self._schema_cache = schema_cache if schema_cache is not None else get_default_cache()
+        self._import_interval = import_interval
+        self._imports_checked = time.monotonic()
+        self._current_interval = interval
+        self._stopped = threading.Event()
+
+    def poll(self):
+        '''
+        Fetch the sheet once and regenerate the document when its values or the schema changed
+
+        :return result: a dict with *changed*, the *generation* summary of IncrementalGenerator (None when nothing
+        was generated), the *validation_errors* (None when not validated) and the seconds until the next poll
+        '''
+
+        instrumentation = get_instrumentation()
+        instrumentation.count('sheet_watch_polls')
+        result = {'changed': False, 'generation': None, 'validation_errors': None}
+        if not os.path.exists(self._output_path):
+            self._body_digest = self._value_digest = None  # Regenerate a document that was removed meanwhile
+        if time.monotonic() - self._imports_checked >= self._import_interval:
+            # Fetched imports are otherwise served from memory and the local store for the life of the process
+            with instrumentation.phase('sheet_watch_revalidate_imports'):
+                self._schema_cache.revalidate(self._schema_inputs)
+            self._imports_checked = time.monotonic()
+        compiled_schema = self._schema_compiler.load_or_compile()
+        self._schema_inputs = list(compiled_schema.get_inputs())
+        schema_key = compiled_schema.get_key()
+        if schema_key != self._schema_key:
+            self._body_digest = None  # The unchanged sheet is generated again, so its values are needed
+        body_digest, sheet_values = self._spreadsheets_api.get_sheet_data_if_changed(
+            self._spreadsheet_id, self._sheet_id, self._region, self._body_digest)
+
+        if sheet_values is not None:
+            value_digest = get_value_digest(sheet_values)
+            if value_digest != self._value_digest or schema_key != self._schema_key:
+                with instrumentation.phase('sheet_watch_regenerate'):
+                    result['generation'] = IncrementalGenerator(compiled_schema, self._output_path).generate(
+                        sheet_values)
+                    if self._validate_schema_path:
+                        result['validation_errors'] = get_validator(
+                            self._validate_schema_path, compiled_schema.get_key()).validate_file(self._output_path)
+                self._value_digest = value_digest
+                self._schema_key = schema_key
+                result['changed'] = True
+                instrumentation.count('sheet_watch_regenerations')
+        # Remembered only once the document is written, so a failed generation is retried on the next poll
+        self._body_digest = body_digest
+
+        if result['changed']:
+            self._current_interval = self._interval
+        else:
+            self._current_interval = min(self._current_interval * self._backoff, self._max_interval)
+        result['next_poll'] = self._current_interval
+        return result
+
+    def run(self, max_polls=None):
+        '''
+        Poll until stop() is called, or max_polls polls were made. A failed poll is reported and retried after
+        the backed off interval, the watcher keeps running.
+
+        :param max_polls: (optional) number of polls to make
+        '''
+
+        polls = 0
+        while not self._stopped.is_set() and (max_polls is None or polls < max_polls):
+            polls += 1
+            try:
+                result = self.poll()
+            except Exception as error:
+                get_instrumentation().count('sheet_watch_errors')
+                self._current_interval = min(self._current_interval * self._backoff, self._max_interval)
+                if self._verbose:
+                    print(f'Polling the sheet failed, retrying in {self._current_interval:.0f}s: '
+                          f'{type(error).__name__}: {error}')
+            else:
+                if self._verbose and result['changed']:
+                    generation = result['generation']
+                    print(f"{time.strftime('%H:%M:%S')} regenerated {self._output_path}: "
+                          f"{generation['rendered']}/{generation['fragments']} fragments rendered")
+                    for error in result['validation_errors'] or ():
+                        print(f"{self._output_path}:{error['line']}:{error['column']} {error['path']}: "
+                              f"{error['message']}")
+            if max_polls is None or polls < max_polls:
+                self._stopped.wait(self._current_interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    from ApiAuth import ApiAuth
+    from SchemaRegistry import get_default_registry
+    from SpreadsheetsApi import SpreadsheetsApi
+    from TokenProvider import TokenProvider
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description='Regenerate the XML whenever the sheet values change')
+    parser.add_argument('--spreadsheet-id', default=os.getenv('SPREADSHEET_ID'))
+    parser.add_argument('--sheet-id', default=os.getenv('SHEET_ID'))
+    parser.add_argument('--output', default='XML_from_schema.xml')
+    parser.add_argument('--region', default=':')
+    parser.add_argument('--interval', type=float, default=float(os.getenv('SHEET_WATCH_INTERVAL', '10')),
+                        help='seconds between polls after a change')
+    parser.add_argument('--max-interval', type=float, default=float(os.getenv('SHEET_WATCH_MAX_INTERVAL', '300')),
+                        help='longest wait between polls while the sheet is idle')
+    parser.add_argument('--import-interval', type=float,
+                        default=float(os.getenv('SHEET_WATCH_IMPORT_INTERVAL', '300')),
+                        help='seconds between checks of the remote schema imports for new versions')
+    parser.add_argument('--report-type', default=os.getenv('REPORT_TYPE', 'FunduszInwestycyjny'))
+    parser.add_argument('--report-version', default=os.getenv('REPORT_VERSION'))
+    parser.add_argument('--no-validate', action='store_true')
+    args = parser.parse_args()
+    if not (args.spreadsheet_id and args.sheet_id):
+        parser.error('the spreadsheet and sheet IDs are needed, from the arguments or SPREADSHEET_ID and SHEET_ID')
+
+    api_url = os.getenv('API_URL')
+    token_provider = TokenProvider(ApiAuth(api_url), os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET'))
+    schema_registry = get_default_registry()
+    schema_path = schema_registry.get_schema_path(args.report_type, args.report_version)
+    watcher = SheetWatcher(SpreadsheetsApi(api_url, token_provider), schema_registry.get_entry(schema_path),
+                           args.spreadsheet_id, args.sheet_id, args.output, args.region, args.interval,
+                           args.max_interval, validate_schema_path=None if args.no_validate else schema_path,
+                           import_interval=args.import_interval)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+
+    print(f'Watching sheet {args.sheet_id}, writing {args.output}')
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
@@ -1,14 +1,39 @@
 #!/usr/local/bin/python3
+import hashlib
 import json
-from pprint import pprint
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
-import requests
+from HttpTransport import get_default_transport
+from Instrumentation import get_instrumentation
+from SheetValueIndex import SheetValueIndex
+
+RETRYABLE_CHUNK_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+
+def _column_letter(column_number):
+    '''
+    1 -> A, 26 -> Z, 27 -> AA
+    '''
+    letters = ''
+    while column_number > 0:
+        column_number, remainder = divmod(column_number - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
 
 
 class SpreadsheetsApi:
-    def __init__(self, url, access_token):
+    def __init__(self, url, access_token, transport=None):
+        '''
+        :param url: the API base URL
+        :param access_token: a token string, or a TokenProvider that is asked for a current token on every request
+        :param transport: (optional) the HttpTransport to send requests with
+        '''
         self._url = url
         self._access_token = access_token
+        self._transport = transport if transport is not None else get_default_transport()
 
     def _get_headers(self):
         '''
@@ -19,8 +44,11 @@ class SpreadsheetsApi:
             "Authorization":  "Bearer {token}"}
         '''
 
-        if self._access_token:
-            return {'Content-Type': 'application/json', 'Accept': 'application/json', "Authorization":  "Bearer " + self._access_token}
+        access_token = self._access_token
+        if hasattr(access_token, 'get_token'):
+            access_token = access_token.get_token()
+        if access_token:
+            return {'Content-Type': 'application/json', 'Accept': 'application/json', "Authorization":  "Bearer " + access_token}
         raise ValueError(
             'Access token is not set. Must authenticate() first.')
 
@@ -34,7 +62,7 @@ class SpreadsheetsApi:
         '''
 
         url = self._url + path
-        resp = requests.get(url, headers=self._get_headers())
+        resp = self._transport.get(url, headers=self._get_headers())
         return json.loads(resp.text)
 
     def _post(self, path, data=None, body=None, headers=None):
@@ -50,7 +78,7 @@ class SpreadsheetsApi:
         '''
 
         url = self._url + path
-        resp = requests.post(url, data=data, headers=headers, json=body)
+        resp = self._transport.post(url, data=data, headers=headers, json=body)
         return resp.json()
 
     def _put(self, path, data):
@@ -64,40 +92,64 @@ class SpreadsheetsApi:
         '''
 
         url = self._url + path
-        resp = requests.put(url, data=json.dumps(data),
+        resp = self._transport.put(url, data=json.dumps(data),
                             headers=self._get_headers())
         return resp.status_code
 
     def _process_sheet_data(self, sheet_values):
         '''
-        This function process the retrieved sheet data and change it from json format into hashmap with key, value formats
+        This function process the retrieved sheet data and index it by element path, see SheetValueIndex.from_rows
 
         :param sheet_values: A python object of the sheet values
 
-        :return sheet_values_map: A map with key value pairs for the sheet values (key is the 1st cell and last non empty cell in the key's row)
+        :return sheet_value_index: A SheetValueIndex keyed by the Path column, or by the 1st cell of each row for sheets without one
         '''
 
-        sheet_values_map = {}
-        for row in sheet_values['data']['values']:
-            sheet_values_map[row[0]] = row[-1]
-        return sheet_values_map
+        return SheetValueIndex.from_rows(sheet_values['data']['values'])
 
     def get_sheet_data(self, spreadsheet_id, sheet_id, region):
         '''
-        This function rturns a map {key: value} where is the key is the first cell in the sheet,
-          and the value the last non empty cell in the key row.
+        This function rturns a SheetValueIndex of the values the client entered, keyed by element path
+          and occurrence, i.e. Raport/Pozycja[2]/Opis, with the element name in the first cell as a fallback.
 
         :param spreadsheet_id: the spreadsheet ID to use in the API
         :param sheet_id: the sheet ID that we want to retrieve all the data from.
         :param region: a string value that represent the region we want to read it is data, i,e. A1
 
-        "return data: A list for the retrieved data
+        "return data: A SheetValueIndex for the retrieved data
         '''
 
         path = '/spreadsheets/v1/spreadsheets/' + \
             spreadsheet_id + '/sheets/' + sheet_id + '/data/' + region
-        data = self._get(path)
-        return self._process_sheet_data(data)
+        with get_instrumentation().phase('get_sheet_data'):
+            data = self._get(path)
+            return self._process_sheet_data(data)
+
+    def get_sheet_data_if_changed(self, spreadsheet_id, sheet_id, region, previous_digest=None):
+        '''
+        Like get_sheet_data, but the response body is hashed before it is parsed, and when it is byte for byte the
+        one previous_digest was taken from, neither the JSON nor the value index are built
+
+        :param previous_digest: (optional) the digest returned by the previous call
+
+        :return (digest, data): sha256 of the response body, and a SheetValueIndex, or None when the body is unchanged
+        :raises RuntimeError: when the API refuses the request; a 401 invalidates a TokenProvider's token first
+        '''
+
+        path = '/spreadsheets/v1/spreadsheets/' + \
+            spreadsheet_id + '/sheets/' + sheet_id + '/data/' + region
+        with get_instrumentation().phase('get_sheet_data'):
+            response = self._transport.get(self._url + path, headers=self._get_headers())
+            if response.status_code == 401 and hasattr(self._access_token, 'invalidate'):
+                # Revoked or expired early; the next call authenticates again instead of failing the same way
+                self._access_token.invalidate()
+            if response.status_code >= 400:
+                raise RuntimeError(f'Reading sheet {sheet_id} failed with status {response.status_code}')
+            body = response.content
+            digest = hashlib.sha256(body).hexdigest()
+            if digest == previous_digest:
+                return digest, None
+            return digest, self._process_sheet_data(json.loads(body))
 
     def update_range(self, spreadsheet_id, sheet_id, region, values):
         '''
@@ -108,13 +160,91 @@ class SpreadsheetsApi:
         :param region: a string value that represent the region we want to modify, i,e. A1
         :param values: A list of list for each row value. i.e. [['Row1-Col1 Data', 'Row1-Col2 Data], ['Row2-Col1 Data', 'Row2-Col2 Data]]
 
-        :return just prints the status_code of the request
+        :return status_code: the request response status code
         '''
 
         path = '/spreadsheets/v1/spreadsheets/' + spreadsheet_id + \
             '/sheets/' + sheet_id + '/data/' + region
-        res = self._put(path, data=values)
-        pprint(res)
+        return self._put(path, data=values)
+
+    def _write_chunk(self, spreadsheet_id, sheet_id, chunk):
+        try:
+            status_code = self.update_range(spreadsheet_id, sheet_id, chunk['region'], {'values': chunk['values']})
+        except Exception as error:
+            chunk['error'] = f'{type(error).__name__}: {error}'
+            chunk['status_code'] = None
+        else:
+            chunk['error'] = None
+            chunk['status_code'] = status_code
+        chunk['attempts'] += 1
+        chunk['ok'] = chunk['status_code'] is not None and 200 <= chunk['status_code'] < 300
+        if chunk['ok']:
+            del chunk['values']  # Nothing left to send, the rows need not stay in memory
+        return chunk
+
+    @staticmethod
+    def _iter_chunks(values, chunk_size, start_row):
+        rows = iter(values)
+        first_row = start_row
+        while True:
+            chunk_rows = list(islice(rows, chunk_size))
+            if not chunk_rows:
+                return
+            last_row = first_row + len(chunk_rows) - 1
+            width = max(1, max(len(row) for row in chunk_rows))
+            yield {
+                'region': 'A' + str(first_row) + ':' + _column_letter(width) + str(last_row),
+                'rows': len(chunk_rows),
+                'values': chunk_rows,
+                'attempts': 0,
+            }
+            first_row = last_row + 1
+
+    def bulk_update_range(self, spreadsheet_id, sheet_id, values, chunk_size=500, max_workers=4, max_attempts=3,
+                          start_row=1, retry_delay=1.0):
+        '''
+        This function writes a large matrix as row-range chunks that are PUT concurrently, as they are read from
+        values. Chunks that failed with a connection error, 429 or a server error are retried on their own after a
+        growing delay; successful ones are never re-sent, and ones the API refused (e.g. 400, 401, 403) are not
+        retried.
+
+        :param spreadsheet_id: the spreadsheet ID to use in the API
+        :param sheet_id: the sheet ID that we want to update
+        :param values: an iterable of rows, consumed chunk by chunk: at most twice max_workers chunks are read
+        ahead of the requests, and rows of chunks that were written are released
+        :param chunk_size: number of rows sent in one request
+        :param max_workers: number of chunks in flight at the same time
+        :param max_attempts: attempts per chunk before giving up on it
+        :param start_row: sheet row the first row of values is written to
+        :param retry_delay: seconds before the first retry round, doubled for every further round
+
+        :return results: a list with one dict per chunk in sheet order: region, rows, status_code, attempts, ok, error
+        '''
+
+        def should_retry(chunk):
+            return not chunk['ok'] and chunk['attempts'] < max_attempts and \
+                (chunk['status_code'] is None or chunk['status_code'] in RETRYABLE_CHUNK_STATUS_CODES)
+
+        chunks = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            in_flight = deque()
+            for chunk in self._iter_chunks(values, chunk_size, start_row):
+                chunks.append(chunk)
+                in_flight.append(executor.submit(self._write_chunk, spreadsheet_id, sheet_id, chunk))
+                if len(in_flight) >= 2 * max_workers:
+                    in_flight.popleft().result()
+            for future in in_flight:
+                future.result()
+
+            pending = [chunk for chunk in chunks if should_retry(chunk)]
+            delay = retry_delay
+            while pending:
+                time.sleep(delay)
+                delay *= 2
+                list(executor.map(lambda chunk: self._write_chunk(spreadsheet_id, sheet_id, chunk), pending))
+                pending = [chunk for chunk in pending if should_retry(chunk)]
+
+        return [{key: value for key, value in chunk.items() if key != 'values'} for chunk in chunks]
 
     def create_spreadsheet(self, spreadsheet_name):
         '''
@@ -0,0 +1,122 @@
+#!/usr/local/bin/python3
+import fcntl
+import json
+import os
+import threading
+import time
+
+from AtomicFile import write_atomic
+from Instrumentation import get_instrumentation
+
+DEFAULT_TOKEN_CACHE_PATH = '.token_cache.json'
+DEFAULT_EXPIRES_IN = 3600
+
+# Tokens and refresh locks are per process, keyed by client id, so every provider for the same client shares them
+_memory_tokens = {}
+_refresh_locks = {}
+_refresh_locks_guard = threading.Lock()
+
+
+def _get_refresh_lock(client_id):
+    with _refresh_locks_guard:
+        lock = _refresh_locks.get(client_id)
+        if lock is None:
+            lock = _refresh_locks[client_id] = threading.Lock()
+        return lock
+
+
+class TokenProvider:
+    '''
+    Hands out a current access token for one client id. Tokens are cached in memory and in a lock-protected JSON
+    file shared by every process on the machine, and refreshed refresh_margin seconds before they expire. Only one
+    thread, and one process holding the file lock, requests a new token at a time; the others reuse its result.
+    '''
+
+    def __init__(self, api_auth, client_id, client_secret, cache_path=None, refresh_margin=60):
+        self._api_auth = api_auth
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._cache_path = cache_path or os.getenv('TOKEN_CACHE_PATH', DEFAULT_TOKEN_CACHE_PATH)
+        self._refresh_margin = refresh_margin
+
+    def _is_fresh(self, token):
+        return token is not None and token['expires_at'] - self._refresh_margin > time.time()
+
+    def get_token(self):
+        '''
+        :return access_token: a token valid for at least refresh_margin more seconds
+        '''
+
+        token = _memory_tokens.get(self._client_id)
+        if self._is_fresh(token):
+            get_instrumentation().count('token_cache_hits')
+            return token['access_token']
+
+        with _get_refresh_lock(self._client_id):
+            token = _memory_tokens.get(self._client_id)
+            if not self._is_fresh(token):
+                token = self._load_or_refresh()
+                _memory_tokens[self._client_id] = token
+        return token['access_token']
+
+    def __call__(self):
+        return self.get_token()
+
+    def invalidate(self):
+        '''
+        Forget the current token, i.e. after the API rejected it
+        '''
+
+        _memory_tokens.pop(self._client_id, None)
+        with self._file_lock():
+            tokens = self._read_tokens()
+            if tokens.pop(self._client_id, None) is not None:
+                self._write_tokens(tokens)
+
+    def _load_or_refresh(self):
+        with self._file_lock():
+            tokens = self._read_tokens()
+            token = tokens.get(self._client_id)
+            if self._is_fresh(token):
+                get_instrumentation().count('token_cache_hits')
+                return token
+
+            get_instrumentation().count('token_refreshes')
+            requested_at = time.time()
+            token_data = self._api_auth.request_token(self._client_id, self._client_secret)
+            token = {
+                'access_token': token_data['access_token'],
+                'expires_at': requested_at + float(token_data.get('expires_in') or DEFAULT_EXPIRES_IN),
+            }
+            tokens[self._client_id] = token
+            self._write_tokens(tokens)
+            return token
+
+    def _file_lock(self):
+        return _FileLock(self._cache_path + '.lock')
+
+    def _read_tokens(self):
+        try:
+            with open(self._cache_path) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_tokens(self, tokens):
+        # Readable by the owner only, the file holds access tokens
+        write_atomic(self._cache_path, json.dumps(tokens).encode('utf-8'), mode=0o600)
+
+
+class _FileLock:
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._path, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
@@ -1,23 +1,42 @@
+import gzip
+import io
+
 from lxml import etree
 from SchemaWalker import SchemaWalker
+from Instrumentation import get_instrumentation
+from ModelTraversal import SKIP_CHILDREN, ModelTraversal, ModelVisitor
+from SchemaTraversal import SchemaTraversal
+from SheetValueIndex import SheetValueIndex
+
+NO_USER_INPUT = 'No user input'
 
 
 class XMLBuilder:
     """
-    Builds on top of the SchemaWalker to use client data and generate an XML file that would satisfy the schema
+    Builds on top of the SchemaWalker to use client data and generate an XML file that would satisfy the schema.
+    A CompiledSchema can be passed instead of the walker, in which case construct_xml_from_model builds the document
+    from the pre-resolved model without touching the XSD. Values are looked up by element path first and bare name
+    second, and repeatable elements are written once for every occurrence the values mention.
     """
     def __init__(self, schema_walker, tag_text_map):
+        """
+        :param schema_walker: SchemaWalker or CompiledSchema
+        :param tag_text_map: SheetValueIndex, or a dict of element path or name -> value
+        """
         self._schema_walker = schema_walker
         self._xml_root = etree.Element(self._schema_walker.get_root_name())
-        self._tag_text_map = tag_text_map
+        if not isinstance(tag_text_map, SheetValueIndex):
+            tag_text_map = SheetValueIndex.from_mapping(tag_text_map)
+        self._values = tag_text_map
+        self._traversal = self._build_traversal()
 
     def get_root(self):
         return self._xml_root
 
     def construct_xml_from_element(self, schema_element=None, xml_parent=None):
         """
-        Recursive function to walk the schema while simultaniously building up the xml tree with element that will
-        satisfy the schema requirements.
+        Walk the schema while simultaniously building up the xml tree with element that will satisfy the schema
+        requirements. The xml parent travels down the walk as the traversal context.
         :param schema_element: The current tree node in the schema
         :param xml_parent: The xml tag that should be a parent of newly generated tree nodes
         :return: None
@@ -25,20 +44,96 @@ class XMLBuilder:
         if schema_element is None:
             schema_element = self._schema_walker.get_root()
 
-        tag_suffix = schema_element.tag.split('}')[1]
-        if tag_suffix == 'element':
-            xml_parent = self._construct_on_element(schema_element, xml_parent)
-        elif tag_suffix == 'complexType':
-            if schema_element.get('name') is not None and len(schema_element) > 1:
-                xml_parent = self._construct_on_element(schema_element, xml_parent)
-        elif tag_suffix == 'extension':
-            self._construct_on_extension(schema_element, xml_parent)
-        else:
-            pass
+        with get_instrumentation().phase('construct_xml'):
+            self._traversal.walk(schema_element, xml_parent)
+
+    def _build_traversal(self):
+        return SchemaTraversal({
+            'element': self._construct_on_element_tag,
+            'complexType': self._construct_on_complex_type_tag,
+            'extension': self._construct_on_extension,
+        })
+
+    def _construct_on_element_tag(self, schema_element, xml_parent):
+        xml_parent = self._construct_on_element(schema_element, xml_parent)
+        return [(schema_child, xml_parent) for schema_child in schema_element]
+
+    def _construct_on_complex_type_tag(self, schema_element, xml_parent):
+        if schema_element.get('name') is not None and len(schema_element) > 1:
+            return self._construct_on_element_tag(schema_element, xml_parent)
+        return None
+
+    def construct_xml_from_model(self, node=None, xml_parent=None):
+        """
+        Build the xml tree from a CompiledSchema. Elements are namespace-qualified as declared in the schema and only
+        leaf elements carry text.
+        :param node: The current SchemaNode, defaults to the model root
+        :param xml_parent: The xml tag that should be a parent of the tag constructed for node
+        :return: None
+        """
+        with get_instrumentation().phase('construct_xml'):
+            if node is None:
+                node = self._schema_walker.get_root()
+                self._xml_root = etree.Element(etree.QName(node.namespace, node.name),
+                                               nsmap=self._schema_walker.get_nsmap())
+                visitor = XMLTreeVisitor(self._values, self._xml_root)
+            else:
+                visitor = XMLTreeVisitor(self._values, xml_parent=xml_parent)
+            ModelTraversal(self._schema_walker, self._values).run([visitor], node)
+
+    def write_xml_stream(self, output_file, compress=False, pretty_print=True, visitors=()):
+        """
+        Streaming alternative to construct_xml_from_model: elements are written to output_file with lxml's incremental
+        writer as the model is walked, so no tree of the document is ever held in memory.
+        :param output_file: binary file handle the UTF-8 encoded document is written to
+        :param compress: gzip the document on the fly
+        :param pretty_print: indent nested elements with tabs
+        :param visitors: further ModelVisitors, e.g. a MatrixVisitor, run in the same walk as the document
+        :return: list of what each of visitors finished with
+        """
+        gzip_file = gzip.GzipFile(fileobj=output_file, mode='wb') if compress else None
+        try:
+            with get_instrumentation().phase('construct_xml'), \
+                    etree.xmlfile(gzip_file or output_file, encoding='utf-8') as xml_file:
+                xml_file.write_declaration()
+                results = self._stream_model(xml_file, pretty_print, visitors=visitors)
+        finally:
+            if gzip_file is not None:
+                gzip_file.close()
+        return results
+
+    def write_xml_fragments(self, fragment_depth=1, pretty_print=True, reuse=None, visitors=()):
+        """
+        Stream the document in segments so that parts of it can be reused by a later run. Every element at
+        fragment_depth, and every leaf above it, is a fragment; the bytes between fragments only hold structure.
+        :param fragment_depth: depth of the fragment roots below the document root
+        :param pretty_print: indent nested elements with tabs
+        :param reuse: fragment indexes that are not rendered because the caller already has their bytes
+        :param visitors: further ModelVisitors run in the same walk; reused fragments are still walked for them
+        :return: list of (fragment index, bytes, value keys read) in document order. Structure segments have index
+        None, reused fragments have bytes None.
+        """
+        buffer = io.BytesIO()
+        segments = []
+
+        def cut(index, keys):
+            xml_file.flush()
+            segments.append((index, None if keys is None else buffer.getvalue(), keys))
+            buffer.seek(0)
+            buffer.truncate()
+
+        with get_instrumentation().phase('construct_xml'):
+            with etree.xmlfile(buffer, encoding='utf-8') as xml_file:
+                xml_file.write_declaration()
+                self._stream_model(xml_file, pretty_print, fragment_depth, reuse or (), cut, visitors)
+            segments.append((None, buffer.getvalue(), ()))
+        return segments
+
+    def _stream_model(self, xml_file, pretty_print, fragment_depth=None, reuse=(), cut=None, visitors=()):
+        visitor = XMLStreamVisitor(xml_file, self._values, self._schema_walker.get_nsmap(), pretty_print,
+                                   fragment_depth, reuse, cut)
+        return ModelTraversal(self._schema_walker, self._values).run([visitor] + list(visitors))[1:]
 
-        for schema_child in schema_element:
-            self.construct_xml_from_element(schema_child, xml_parent)
-    
     def _construct_on_element(self, schema_element, xml_parent):
         """
         Element node is the main one we're looking at, since it describes the tag that need to be in the xml.
@@ -49,10 +144,10 @@ class XMLBuilder:
         """
         if xml_parent is None:
             xml_parent = self._xml_root  # xml_parent should only be None at the top of the tree
-            xml_parent.text = str(self._tag_text_map.get(schema_element.get('name'), 'No user input'))
+            xml_parent.text = str(self._values.get(None, schema_element.get('name'), NO_USER_INPUT))
         else:
             xml_child = etree.SubElement(xml_parent, schema_element.get('name'))
-            xml_child.text = str(self._tag_text_map.get(schema_element.get('name'), 'No user input'))
+            xml_child.text = str(self._values.get(None, schema_element.get('name'), NO_USER_INPUT))
             xml_parent = xml_child
         
         return xml_parent
@@ -62,11 +157,104 @@ class XMLBuilder:
         Taking advantage of schema walker functionality to get the base element from remote namespace
         :param schema_element: The extension tree node in the schema that has the name of the element to be looked up
         :param xml_parent: The tree node of xml that is being constructed, that this element will be child of
-        :return: None
+        :return: The base element followed by the extension's own children, all under xml_parent
         """
 
         base_element = self._schema_walker.load_base_element(schema_element)
-        self.construct_xml_from_element(base_element, xml_parent)
+        return [(base_element, xml_parent)] + [(schema_child, xml_parent) for schema_child in schema_element]
+
+
+class XMLTreeVisitor(ModelVisitor):
+    """
+    Builds the document as an lxml tree. Elements are namespace-qualified as declared in the schema and only leaf
+    elements carry text.
+    """
+    def __init__(self, values, xml_root=None, xml_parent=None):
+        """
+        :param xml_root: element already created for the first node visited
+        :param xml_parent: element the first node visited is created under, when xml_root is not given
+        """
+        self._values = values
+        self._xml_root = xml_root
+        self._open_elements = [xml_parent]
+
+    def enter(self, node, path, depth, primary):
+        if depth == 0 and self._xml_root is not None:
+            xml_element = self._xml_root
+        else:
+            xml_element = etree.SubElement(self._open_elements[-1], etree.QName(node.namespace, node.name))
+        if node.is_leaf():
+            xml_element.text = str(self._values.get(path, node.name, NO_USER_INPUT))
+        self._open_elements.append(xml_element)
+        return None
+
+    def leave(self, node, path, depth):
+        self._open_elements.pop()
+
+
+class XMLStreamVisitor(ModelVisitor):
+    """
+    Writes the document to an lxml incremental writer. With a cut callback the output is split into fragments at
+    fragment_depth (see XMLBuilder.write_xml_fragments), and fragments in reuse are neither rendered nor descended
+    into.
+    """
+    _REUSED = -1
+
+    def __init__(self, xml_file, values, nsmap, pretty_print=True, fragment_depth=None, reuse=(), cut=None):
+        self._xml_file = xml_file
+        self._values = values
+        self._nsmap = nsmap
+        self._pretty_print = pretty_print
+        self._fragment_depth = fragment_depth
+        self._reuse = reuse
+        self._cut = cut
+        self._open_elements = []
+        self._fragments = []  # fragment index, None or _REUSED for every element entered and not left yet
+        self._fragment_count = 0
+        self._fragment_keys = None
+
+    def enter(self, node, path, depth, primary):
+        if self._fragments and self._fragments[-1] == self._REUSED:
+            # Other visitors asked to walk into a reused fragment, which has nothing to write
+            self._fragments.append(self._REUSED)
+            return SKIP_CHILDREN
+
+        xml_file = self._xml_file
+        fragment = None
+        if self._cut is not None and (depth == self._fragment_depth or depth < self._fragment_depth and node.is_leaf()):
+            fragment = self._fragment_count
+            self._fragment_count += 1
+            self._cut(None, ())
+            if fragment in self._reuse:
+                self._cut(fragment, None)
+                self._fragments.append(self._REUSED)
+                return SKIP_CHILDREN
+            self._fragment_keys = set()
+
+        if self._pretty_print and depth:
+            xml_file.write('\n' + '\t' * depth)
+        element_writer = xml_file.element(etree.QName(node.namespace, node.name),
+                                          nsmap=self._nsmap if depth == 0 else None)
+        element_writer.__enter__()
+        self._open_elements.append(element_writer)
+        if node.is_leaf():
+            xml_file.write(str(self._values.get(path, node.name, NO_USER_INPUT)))
+            if self._fragment_keys is not None:
+                self._fragment_keys.add(path)
+                self._fragment_keys.add(node.name)
+        self._fragments.append(fragment)
+        return None
+
+    def leave(self, node, path, depth):
+        fragment = self._fragments.pop()
+        if fragment == self._REUSED:
+            return
+        if self._pretty_print and node.children:
+            self._xml_file.write('\n' + '\t' * depth)
+        self._open_elements.pop().__exit__(None, None, None)
+        if fragment is not None:
+            self._cut(fragment, self._fragment_keys)
+            self._fragment_keys = None
 
 
 if __name__ == '__main__':
@@ -0,0 +1,199 @@
+import gzip
+import io
+import re
+
+from lxml import etree
+
+from Instrumentation import get_instrumentation
+from ModelTraversal import ModelTraversal, ModelVisitor
+from SheetValueIndex import SheetValueIndex, child_path
+from XMLBuilder import NO_USER_INPUT, XMLStreamVisitor
+
+_SLOT = 0
+_SECTION = 1
+_SENTINEL = '\ue000'  # private use character standing in for every value while the skeleton is written
+_INVALID_TEXT = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+_ESCAPED_TEXT = re.compile('[&<>\r]')
+_SPECIAL_TEXT = re.compile('[&<>\r\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '\r': '&#13;'}
+
+
+def _escape_text(text):
+    """
+    Escape text content the way lxml's incremental writer does, so a rendered document is byte for byte the one
+    XMLBuilder.write_xml_stream writes
+    """
+    if _SPECIAL_TEXT.search(text) is None:
+        return text  # Most values, a single scan
+    if _INVALID_TEXT.search(text) is not None:
+        raise ValueError('All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters')
+    return _ESCAPED_TEXT.sub(lambda match: _ESCAPES[match.group()], text)
+
+
+class _SlotValues:
+    """
+    Stands in for a SheetValueIndex while the skeleton is written: every leaf gets the sentinel as its value
+    """
+    def get(self, path, name, default=None):
+        return _SENTINEL
+
+
+class _OffsetRecorder(ModelVisitor):
+    """
+    Records how far the document was written when every element is entered and left. Run once before and once
+    after the XMLStreamVisitor, the four offsets of an element bound its start tag and its end tag.
+    """
+    def __init__(self, xml_file, buffer):
+        self._xml_file = xml_file
+        self._buffer = buffer
+        self.enter_offsets = {}
+        self.leave_offsets = {}
+
+    def _tell(self):
+        self._xml_file.flush()
+        return self._buffer.tell()
+
+    def enter(self, node, path, depth, primary):
+        self.enter_offsets[path] = self._tell()
+        return None
+
+    def leave(self, node, path, depth):
+        self.leave_offsets[path] = self._tell()
+
+
+class XMLTemplate:
+    """
+    The document XMLBuilder writes for a CompiledSchema, compiled once into a skeleton: the markup between values
+    is kept as literal text and only the values are filled in per document. Repeatable elements and, optionally,
+    optional elements are sections of the skeleton that are written once for every occurrence the values mention,
+    or left out. Rendering a document is a walk over the skeleton's few operations, no schema model is traversed
+    and no element is created, so generating many documents of one schema costs little more than escaping and
+    writing their values.
+
+    The skeleton is the output of XMLStreamVisitor itself, recorded with a placeholder for every value, so the
+    rendered bytes are exactly those of XMLBuilder.write_xml_stream.
+    """
+    def __init__(self, compiled_schema, pretty_print=True):
+        """
+        :param compiled_schema: CompiledSchema the skeleton is compiled from
+        :param pretty_print: indent nested elements with tabs
+        """
+        self._compiled_schema = compiled_schema
+        self._pretty_print = pretty_print
+        with get_instrumentation().phase('compile_xml_template'):
+            self._header, self._ops, self._optional_ops, self._footer = self._compile()
+        get_instrumentation().count('xml_templates_compiled')
+
+    def _compile(self):
+        buffer = io.BytesIO()
+        with etree.xmlfile(buffer, encoding='utf-8') as xml_file:
+            xml_file.write_declaration()
+            before = _OffsetRecorder(xml_file, buffer)
+            after = _OffsetRecorder(xml_file, buffer)
+            writer = XMLStreamVisitor(xml_file, _SlotValues(), self._compiled_schema.get_nsmap(), self._pretty_print)
+            ModelTraversal(self._compiled_schema).run([before, writer, after])
+        content = buffer.getvalue()
+
+        def text(start, end):
+            return content[start:end].decode('utf-8')
+
+        def build(node, path, base, optional_sections):
+            """
+            :param optional_sections: make optional elements sections, otherwise they are written like required ones
+            :return: operations writing the element at path, with paths relative to base, the section it is in
+            """
+            start = before.enter_offsets[path]
+            if node.is_leaf():
+                # The start tag, the sentinel, then nothing up to the end tag
+                prefix, suffix = text(start, after.enter_offsets[path]).split(_SENTINEL)
+                ops = [prefix, (_SLOT, path[len(base):], node.name), suffix]
+            else:
+                ops = [text(start, after.enter_offsets[path])]
+            for child in node.children:
+                child_key = child_path(path, child.name)
+                if child.is_repeatable() or optional_sections and child.min_occurs == 0:
+                    leaf_names = tuple(sorted({leaf.name for leaf in _iter_leaves(child)}))
+                    ops.append((_SECTION, path[len(base):], child.name, child.max_occurs, child.is_repeatable(),
+                                child.min_occurs == 0,
+                                _merge_literals(build(child, child_key, child_key, optional_sections)), leaf_names))
+                else:
+                    ops.extend(build(child, child_key, base, optional_sections))
+            ops.append(text(before.leave_offsets[path], after.leave_offsets[path]))
+            return ops
+
+        root = self._compiled_schema.get_root()
+        # Optional elements are written unless asked otherwise, so the usual skeleton has them inline and stays flat
+        return (text(0, before.enter_offsets[root.name]), _merge_literals(build(root, root.name, '', False)),
+                _merge_literals(build(root, root.name, '', True)), text(after.leave_offsets[root.name], len(content)))
+
+    def render(self, values, omit_empty_optional=False):
+        """
+        :param values: SheetValueIndex, or a dict of element path or name -> value
+        :param omit_empty_optional: leave out optional elements without any value at or below them, rather than
+        writing them with the placeholder text as XMLBuilder does
+        :return: the UTF-8 encoded document
+        """
+        if not isinstance(values, SheetValueIndex):
+            values = SheetValueIndex.from_mapping(values)
+        with get_instrumentation().phase('render_xml_template'):
+            parts = [self._header]
+            stack = [(iter(self._optional_ops if omit_empty_optional else self._ops), '')]
+            while stack:
+                ops, base = stack[-1]
+                for op in ops:
+                    if op.__class__ is str:
+                        parts.append(op)
+                    elif op[0] == _SLOT:
+                        parts.append(_escape_text(str(values.get(base + op[1], op[2], NO_USER_INPUT))))
+                    else:
+                        _, suffix, name, max_occurs, repeatable, optional, section_ops, leaf_names = op
+                        parent_path = base + suffix
+                        occurrences = 1
+                        if repeatable:
+                            occurrences = values.get_occurrences(parent_path, name)
+                            if max_occurs > 0:
+                                occurrences = min(occurrences, max_occurs)
+                        paths = [child_path(parent_path, name, occurrence) for occurrence in range(1, occurrences + 1)]
+                        if optional and omit_empty_optional:
+                            paths = [path for path in paths if values.has_values_under(path, leaf_names)]
+                        # The first occurrence ends up on top; the rest of ops continues once they are all written
+                        stack.extend((iter(section_ops), path) for path in reversed(paths))
+                        break
+                else:
+                    stack.pop()
+            parts.append(self._footer)
+            document = ''.join(parts).encode('utf-8')
+        get_instrumentation().count('xml_template_renders')
+        return document
+
+    def write(self, output_file, values, compress=False, omit_empty_optional=False):
+        """
+        Drop-in for XMLBuilder.write_xml_stream
+        :param output_file: binary file handle the document is written to
+        :param compress: gzip the document
+        """
+        document = self.render(values, omit_empty_optional)
+        if compress:
+            with gzip.GzipFile(fileobj=output_file, mode='wb') as gzip_file:
+                gzip_file.write(document)
+        else:
+            output_file.write(document)
+
+
+def _iter_leaves(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node.is_leaf():
+            yield node
+        stack.extend(node.children)
+
+
+def _merge_literals(ops):
+    merged = []
+    for op in ops:
+        if op.__class__ is str and merged and merged[-1].__class__ is str:
+            merged[-1] += op
+        elif op != '':
+            merged.append(op)
+    return merged
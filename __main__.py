@@ -1,14 +1,15 @@
 #!/usr/local/bin/python3
+import logging
 import os
-from pprint import pprint
 
 from dotenv import load_dotenv
-from lxml import etree
 
 from ApiAuth import ApiAuth
+from Instrumentation import get_instrumentation
+from Pipeline import Pipeline
+from SchemaRegistry import get_default_registry
 from SpreadsheetsApi import SpreadsheetsApi
-from SchemaWalker import SchemaWalker
-from XMLBuilder import XMLBuilder
+from TokenProvider import TokenProvider
 
 # Load the environment variables
 load_dotenv()
@@ -18,18 +19,11 @@ CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
 SHEET_ID = os.getenv('SHEET_ID')
-
-
-def get_schema_values(schema_walker):
-    return schema_walker.parse_tree()
-
-
-def create_spreadsheet_with_schema_values(spreadsheets_api, schema_walker):
-    spreadsheet_id = spreadsheets_api.create_spreadsheet('Test From Local 9')
-    sheet_id = spreadsheets_api.create_sheet(spreadsheet_id, 'Schema Sheet')
-    spreadsheets_api.update_range(spreadsheet_id, sheet_id, ':',
-                                  {"values": get_schema_values(schema_walker)})
-    write_spreadsheet_ids_to_env(spreadsheet_id, sheet_id)
+INSTRUMENTATION_REPORT = os.getenv('INSTRUMENTATION_REPORT')
+XML_INCREMENTAL = os.getenv('XML_INCREMENTAL')
+XML_VALIDATE = os.getenv('XML_VALIDATE', '1') not in ('0', 'false', 'no')
+REPORT_TYPE = os.getenv('REPORT_TYPE', 'FunduszInwestycyjny')
+REPORT_VERSION = os.getenv('REPORT_VERSION')
 
 
 def write_spreadsheet_ids_to_env(spreadsheet_id, sheet_id):
@@ -40,24 +34,39 @@ def write_spreadsheet_ids_to_env(spreadsheet_id, sheet_id):
         ])
 
 
-def generate_xml(spreadsheets_api, schema_walker):
-    sheet_data = spreadsheets_api.get_sheet_data(SPREADSHEET_ID, SHEET_ID, ':')
-    xmlb = XMLBuilder(schema_walker, sheet_data)
-    xmlb.construct_xml_from_element()
-
-    with open('XML_from_schema.xml', 'w') as new_xml:
-        string_xml = etree.tostring(
-            xmlb.get_root(), pretty_print=True, xml_declaration=True).decode('ASCII')
-        new_xml.write(string_xml)
+def print_validation_errors(output_path, errors):
+    for error in errors:
+        # Value checks run while the document is written and carry no line
+        location = output_path if error['line'] is None else f"{output_path}:{error['line']}:{error['column']}"
+        print(f"{location} {error['path']}: {error['message']}")
 
 
 if __name__ == "__main__":
+    instrumentation = get_instrumentation()
+    if instrumentation.is_logging():
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+
     api_auth = ApiAuth(API_URL)
-    access_token = api_auth.authenticate(CLIENT_ID, CLIENT_SECRET)
-    spreadsheets_api = SpreadsheetsApi(API_URL, access_token)
-    schema_walker = SchemaWalker(verbose=False)
+    token_provider = TokenProvider(api_auth, CLIENT_ID, CLIENT_SECRET)
+    spreadsheets_api = SpreadsheetsApi(API_URL, token_provider)
+    schema_registry = get_default_registry()
+    schema_path = schema_registry.get_schema_path(REPORT_TYPE, REPORT_VERSION)
+    pipeline = Pipeline(spreadsheets_api, token_provider, schema_path, schema_registry.get_entry(schema_path))
 
     if SPREADSHEET_ID == None and SHEET_ID == None:
-        create_spreadsheet_with_schema_values(spreadsheets_api, schema_walker)
+        with instrumentation.phase('export_schema'):
+            write_spreadsheet_ids_to_env(*pipeline.export_schema('Test From Local 9'))
     else:
-        generate_xml(spreadsheets_api, schema_walker)
+        with instrumentation.phase('generate_xml'):
+            summary = pipeline.generate_xml(SPREADSHEET_ID, SHEET_ID, incremental=bool(XML_INCREMENTAL),
+                                            validate=XML_VALIDATE)
+        # Missing required values and repeats past maxOccurs, found while the document was written
+        if summary.get('value_errors'):
+            print_validation_errors(summary['output'], summary['value_errors'])
+        if summary['validation_errors']:
+            print_validation_errors(summary['output'], summary['validation_errors'])
+
+    if instrumentation.is_logging():
+        instrumentation.log_summary()
+    if INSTRUMENTATION_REPORT:
+        instrumentation.write_json(INSTRUMENTATION_REPORT)
@@ -0,0 +1,251 @@
+#!/usr/local/bin/python3
+"""
+Benchmarks of the schema walkers, the sheet fetch and the XML builders against synthetic schemas and a local mock
+of gov.pl and the Workiva APIs. Every phase runs in a fresh spawned process so its peak RSS is its own.
+
+    python benchmarks/Benchmark.py --depth 4 --breadth 5 --imports 4 --output results.json
+    python benchmarks/Benchmark.py --compare results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPOSITORY_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from MockServer import MockServer  # noqa: E402
+from SyntheticSchema import generate_schemas  # noqa: E402
+
+PHASES = ('walk_v1', 'walk_v2', 'compile', 'auth', 'sheet_fetch', 'xml_build', 'xml_stream')
+
+
+def _get_server_stats(server_url):
+    import requests
+    return requests.get(server_url + '/__stats').json()
+
+
+def _prepare_phase(phase, config, work_dir):
+    """
+    Everything a phase needs that should not be timed. Returns the callable that is measured.
+    """
+    from ApiAuth import ApiAuth
+    from HttpTransport import HttpTransport
+    from SchemaCache import SchemaCache
+    from SchemaCompiler import SchemaCompiler
+    from SpreadsheetsApi import SpreadsheetsApi
+    from XMLBuilder import XMLBuilder
+    import SchemaWalker
+    import SchemaWalker2
+
+    transport = HttpTransport()
+    schema_cache = SchemaCache(os.path.join(work_dir, 'schema_cache'), transport=transport)
+    root_path = config['root_schema_path']
+    server_url = config['server_url']
+
+    if phase == 'walk_v1':
+        return SchemaWalker.SchemaWalker(root_path, verbose=False, schema_cache=schema_cache).parse_tree
+    if phase == 'walk_v2':
+        return SchemaWalker2.SchemaWalker(root_path, verbose=False, schema_cache=schema_cache).parse_tree
+    if phase == 'compile':
+        return SchemaCompiler(root_path, schema_cache=schema_cache, model_dir=work_dir).compile
+    if phase == 'auth':
+        api_auth = ApiAuth(server_url, transport)
+        return lambda: api_auth.authenticate('benchmark-client', 'benchmark-secret')
+    if phase == 'sheet_fetch':
+        spreadsheets_api = SpreadsheetsApi(server_url, 'benchmark-token', transport)
+        return lambda: spreadsheets_api.get_sheet_data('benchmark-spreadsheet', 'benchmark-sheet', ':')
+    if phase == 'xml_build':
+        from lxml import etree
+        walker = SchemaWalker.SchemaWalker(root_path, verbose=False, schema_cache=schema_cache)
+        values = config['sheet_map']
+
+        def build():
+            builder = XMLBuilder(walker, values)
+            builder.construct_xml_from_element()
+            return etree.tostring(builder.get_root(), xml_declaration=True, encoding='utf-8')
+        return build
+    if phase == 'xml_stream':
+        compiled = SchemaCompiler(root_path, schema_cache=schema_cache, model_dir=work_dir).compile()
+        values = config['sheet_map']
+
+        def stream():
+            with open(os.devnull, 'wb') as output_file:
+                XMLBuilder(compiled, values).write_xml_stream(output_file)
+        return stream
+    raise ValueError(f'Unknown phase {phase}')
+
+
+def _run_phase(phase, config):
+    """
+    Entry point of the spawned child process
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            measured = _prepare_phase(phase, config, work_dir)
+            baseline_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            stats_before = _get_server_stats(config['server_url'])
+            started = time.perf_counter()
+            measured()
+            seconds = time.perf_counter() - started
+            stats_after = _get_server_stats(config['server_url'])
+        except Exception as error:
+            return {'error': f'{type(error).__name__}: {error}'}
+
+    routes = {route: count - stats_before['routes'].get(route, 0)
+              for route, count in stats_after['routes'].items() if count != stats_before['routes'].get(route, 0)}
+    return {
+        'seconds': seconds,
+        'baseline_rss_kb': baseline_rss_kb,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'requests': stats_after['requests'] - stats_before['requests'],
+        'bytes_received': stats_after['bytes_sent'] - stats_before['bytes_sent'],
+        'routes': routes,
+    }
+
+
+def _summarize(runs):
+    errors = [run['error'] for run in runs if 'error' in run]
+    if errors:
+        return {'error': errors[0]}
+
+    return {
+        'seconds': statistics.median(run['seconds'] for run in runs),
+        'seconds_min': min(run['seconds'] for run in runs),
+        'baseline_rss_kb': max(run['baseline_rss_kb'] for run in runs),
+        'peak_rss_kb': max(run['peak_rss_kb'] for run in runs),
+        'requests': runs[0]['requests'],
+        'bytes_received': runs[0]['bytes_received'],
+        'routes': runs[0]['routes'],
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(parameters, phases=PHASES, repeat=3, verbose=True):
+    """
+    :param parameters: keyword arguments of SyntheticSchema.generate_schemas except base_url
+    :return: JSON-serialisable result document
+    """
+    with MockServer() as server, tempfile.TemporaryDirectory() as schema_dir:
+        root_schema, libraries = generate_schemas(server.get_schema_base_url(), **parameters)
+        server.schemas.update(libraries)
+        root_schema_path = os.path.join(schema_dir, 'root.xsd')
+        with open(root_schema_path, 'wb') as file:
+            file.write(root_schema)
+
+        # The sheet holds one filled-in row per schema element, as a client would return it
+        from SchemaCache import SchemaCache
+        from SchemaCompiler import SchemaCompiler
+        compiled = SchemaCompiler(root_schema_path, schema_cache=SchemaCache(os.path.join(schema_dir, 'cache')),
+                                  model_dir=schema_dir).compile()
+        matrix = compiled.to_matrix()
+        server.sheet_values = matrix[:1] + [row + ['value %d' % number] for number, row in enumerate(matrix[1:])]
+
+        config = {
+            'root_schema_path': root_schema_path,
+            'server_url': server.get_base_url(),
+            'sheet_map': {row[3]: row[-1] for row in server.sheet_values[1:]},
+        }
+        context = multiprocessing.get_context('spawn')
+        results = {}
+        for phase in phases:
+            runs = []
+            for _ in range(repeat):
+                with context.Pool(1) as pool:
+                    runs.append(pool.apply(_run_phase, (phase, config)))
+            results[phase] = _summarize(runs)
+            if verbose:
+                summary = results[phase]
+                if 'error' in summary:
+                    print(f'{phase:12} ERROR {summary["error"]}')
+                else:
+                    print(f'{phase:12} {summary["seconds"] * 1000:10.2f} ms  {summary["peak_rss_kb"]:8d} KB peak  '
+                          f'{summary["requests"]:5d} requests')
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'repeat': repeat,
+        'schema': {
+            'root_bytes': len(root_schema),
+            'imported_bytes': sum(len(content) for content in libraries.values()),
+            'elements': len(server.sheet_values),
+        },
+        'phases': results,
+    }
+
+
+def compare(previous, current, max_slowdown):
+    """
+    Print per-phase ratios against a previous result document
+    :return: names of phases that got slower than max_slowdown or started making more requests
+    """
+    regressions = []
+    for phase, result in current['phases'].items():
+        before = previous['phases'].get(phase)
+        if before is None or 'error' in before or 'error' in result:
+            continue
+        ratio = result['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+        print(f'{phase:12} time x{ratio:5.2f}  rss x{result["peak_rss_kb"] / before["peak_rss_kb"]:5.2f}  '
+              f'requests {before["requests"]} -> {result["requests"]}')
+        if ratio > max_slowdown or result['requests'] > before['requests']:
+            regressions.append(phase)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark schema walking, sheet fetch and XML generation')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--breadth', type=int, default=4)
+    parser.add_argument('--extension-chain', type=int, default=3)
+    parser.add_argument('--imports', type=int, default=3)
+    parser.add_argument('--types-per-library', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--phases', default=','.join(PHASES), help='comma separated subset of ' + ','.join(PHASES))
+    parser.add_argument('--output', help='result JSON path, defaults to benchmark_results/<timestamp>.json')
+    parser.add_argument('--compare', help='previous result JSON to compare against')
+    parser.add_argument('--max-slowdown', type=float, default=1.5)
+    args = parser.parse_args()
+
+    if args.compare:
+        # Re-run with the parameters of the previous result so the numbers are comparable
+        with open(args.compare) as previous_file:
+            previous_result = json.load(previous_file)
+        benchmark_parameters = previous_result['parameters']
+    else:
+        previous_result = None
+        benchmark_parameters = {
+            'depth': args.depth,
+            'breadth': args.breadth,
+            'extension_chain': args.extension_chain,
+            'imports': args.imports,
+            'types_per_library': args.types_per_library,
+        }
+
+    result = run_benchmarks(benchmark_parameters, args.phases.split(','), args.repeat)
+    output_path = args.output or os.path.join('benchmark_results', time.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w') as output_file:
+        json.dump(result, output_file, indent=1)
+    print(f'Results written to {output_path}')
+
+    if previous_result is not None and compare(previous_result, result, args.max_slowdown):
+        sys.exit(1)
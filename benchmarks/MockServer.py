@@ -0,0 +1,119 @@
+import hashlib
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SHEET_DATA_PATH = re.compile(r'^/spreadsheets/v1/spreadsheets/([^/]+)/sheets/([^/]+)/data/(.+)$')
+
+
+class MockServer:
+    """
+    Local stand-in for gov.pl schema hosting and the Workiva IAM and Spreadsheets APIs. Schemas are served with
+    ETag validators, the sheet endpoint returns a fixed value matrix, and every request is counted per route.
+    GET /__stats returns the counters without being counted itself.
+    """
+    def __init__(self, schemas=None, sheet_values=None, host='127.0.0.1', port=0):
+        self.schemas = schemas or {}  # file name -> bytes, served under /schemas/
+        self.sheet_values = sheet_values or []
+        self._stats = {'requests': 0, 'bytes_sent': 0, 'routes': {}}
+        self._stats_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def get_base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def get_schema_base_url(self):
+        return self.get_base_url() + '/schemas/'
+
+    def get_stats(self):
+        with self._stats_lock:
+            return json.loads(json.dumps(self._stats))
+
+    def _count(self, route, bytes_sent):
+        with self._stats_lock:
+            self._stats['requests'] += 1
+            self._stats['bytes_sent'] += bytes_sent
+            self._stats['routes'][route] = self._stats['routes'].get(route, 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _make_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, route, status, body=b'', content_type='application/json', headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+                if route is not None:
+                    mock._count(route, len(body))
+
+            def _read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def do_GET(self):
+                if self.path == '/__stats':
+                    self._send(None, 200, json.dumps(mock.get_stats()).encode('utf-8'))
+                elif self.path.startswith('/schemas/'):
+                    content = mock.schemas.get(self.path[len('/schemas/'):])
+                    if content is None:
+                        self._send('schema', 404)
+                        return
+                    etag = '"' + hashlib.sha256(content).hexdigest()[:16] + '"'
+                    if self.headers.get('If-None-Match') == etag:
+                        self._send('schema_not_modified', 304, headers={'ETag': etag})
+                    else:
+                        self._send('schema', 200, content, 'application/xml', {'ETag': etag})
+                elif SHEET_DATA_PATH.match(self.path):
+                    body = json.dumps({'data': {'values': mock.sheet_values}}).encode('utf-8')
+                    self._send('sheet_data', 200, body)
+                else:
+                    self._send('not_found', 404)
+
+            def do_POST(self):
+                self._read_body()
+                if self.path == '/iam/v1/oauth2/token':
+                    body = {'access_token': 'benchmark-token', 'expires_in': 3600, 'token_type': 'bearer'}
+                    self._send('token', 200, json.dumps(body).encode('utf-8'))
+                elif self.path == '/spreadsheets/v1/spreadsheets':
+                    self._send('create_spreadsheet', 200, b'{"data": {"id": "benchmark-spreadsheet"}}')
+                elif self.path.endswith('/sheets'):
+                    self._send('create_sheet', 200, b'{"data": {"id": "benchmark-sheet"}}')
+                else:
+                    self._send('not_found', 404)
+
+            def do_PUT(self):
+                self._read_body()
+                if SHEET_DATA_PATH.match(self.path):
+                    self._send('sheet_update', 204)
+                else:
+                    self._send('not_found', 404)
+
+        return Handler
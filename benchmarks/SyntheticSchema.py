@@ -0,0 +1,124 @@
+XSD_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+XSD_NAMESPACE = 'http://www.w3.org/2001/XMLSchema'
+
+
+def _library_namespace(library_number):
+    return f'urn:bench:lib{library_number}'
+
+
+def _documentation(text, indent):
+    return (f'{indent}<xsd:annotation>\n'
+            f'{indent}\t<xsd:documentation>{text}</xsd:documentation>\n'
+            f'{indent}</xsd:annotation>\n')
+
+
+def _library_schema(library_number, imports, base_url, breadth, extension_chain, types_per_library):
+    """
+    One imported type library: a simple text type, a chain of complex types each extending the previous one and a
+    set of flat record types. Library n imports library n + 1 so nested imports are exercised as well.
+    """
+    prefix = f'l{library_number}'
+    declarations = [f'xmlns:xsd="{XSD_NAMESPACE}"', f'xmlns:{prefix}="{_library_namespace(library_number)}"']
+    import_tags = []
+    if library_number + 1 < imports:
+        next_prefix = f'l{library_number + 1}'
+        declarations.append(f'xmlns:{next_prefix}="{_library_namespace(library_number + 1)}"')
+        import_tags.append(f'\t<xsd:import namespace="{_library_namespace(library_number + 1)}" '
+                           f'schemaLocation="{base_url}lib{library_number + 1}.xsd"/>\n')
+
+    parts = [XSD_HEADER,
+             f'<xsd:schema {" ".join(declarations)} targetNamespace="{_library_namespace(library_number)}" '
+             f'elementFormDefault="qualified">\n']
+    parts.extend(import_tags)
+    parts.append('\t<xsd:simpleType name="TText">\n'
+                 '\t\t<xsd:restriction base="xsd:string"><xsd:maxLength value="255"/></xsd:restriction>\n'
+                 '\t</xsd:simpleType>\n')
+
+    parts.append('\t<xsd:complexType name="TBase0">\n' + _documentation('Base 0', '\t\t') + '\t\t<xsd:sequence>\n')
+    for leaf in range(breadth):
+        parts.append(f'\t\t\t<xsd:element name="B0_{leaf}" type="{prefix}:TText"/>\n')
+    parts.append('\t\t</xsd:sequence>\n\t</xsd:complexType>\n')
+    for level in range(1, extension_chain + 1):
+        parts.append(f'\t<xsd:complexType name="TBase{level}">\n'
+                     + _documentation(f'Base {level}', '\t\t')
+                     + '\t\t<xsd:complexContent>\n'
+                     f'\t\t\t<xsd:extension base="{prefix}:TBase{level - 1}">\n'
+                     '\t\t\t\t<xsd:sequence>\n'
+                     f'\t\t\t\t\t<xsd:element name="B{level}" type="{prefix}:TText"/>\n'
+                     '\t\t\t\t</xsd:sequence>\n'
+                     '\t\t\t</xsd:extension>\n'
+                     '\t\t</xsd:complexContent>\n'
+                     '\t</xsd:complexType>\n')
+
+    for record in range(types_per_library):
+        parts.append(f'\t<xsd:complexType name="TRecord{record}">\n\t\t<xsd:sequence>\n')
+        for leaf in range(breadth):
+            parts.append(f'\t\t\t<xsd:element name="R{record}_{leaf}" type="{prefix}:TText" minOccurs="0"/>\n')
+        parts.append('\t\t</xsd:sequence>\n\t</xsd:complexType>\n')
+
+    parts.append('</xsd:schema>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def generate_schemas(base_url, depth=3, breadth=4, extension_chain=3, imports=3, types_per_library=20):
+    """
+    Generate a root schema and its imported libraries.
+    :param base_url: URL the library documents will be served from, ending with a slash
+    :param depth: nesting depth of sections under the root element
+    :param breadth: children per section and elements per library type
+    :param extension_chain: number of complexContent extensions stacked on top of each library's base type
+    :param imports: number of imported library namespaces (the import fan-out of the root schema)
+    :param types_per_library: flat record types defined in each library
+    :return: (root schema bytes, {library file name: bytes})
+    """
+    libraries = {
+        f'lib{number}.xsd': _library_schema(number, imports, base_url, breadth, extension_chain, types_per_library)
+        for number in range(imports)
+    }
+
+    declarations = [f'xmlns:xsd="{XSD_NAMESPACE}"', 'xmlns:r="urn:bench:root"']
+    declarations.extend(f'xmlns:l{number}="{_library_namespace(number)}"' for number in range(imports))
+    parts = [XSD_HEADER,
+             f'<xsd:schema {" ".join(declarations)} targetNamespace="urn:bench:root" elementFormDefault="qualified">\n']
+    parts.extend(f'\t<xsd:import namespace="{_library_namespace(number)}" schemaLocation="{base_url}lib{number}.xsd"/>\n'
+                 for number in range(imports))
+
+    counter = [0]
+
+    def leaf(name, indent):
+        kind = counter[0] % 3
+        library = (counter[0] // 3) % imports
+        counter[0] += 1
+        if kind == 0:
+            record = counter[0] % types_per_library
+            return (f'{indent}<xsd:element name="{name}" type="l{library}:TRecord{record}">\n'
+                    + _documentation(name, indent + '\t') + f'{indent}</xsd:element>\n')
+        if kind == 1:
+            return (f'{indent}<xsd:element name="{name}">\n'
+                    + _documentation(name, indent + '\t')
+                    + f'{indent}\t<xsd:complexType>\n'
+                    f'{indent}\t\t<xsd:complexContent>\n'
+                    f'{indent}\t\t\t<xsd:extension base="l{library}:TBase{extension_chain}">\n'
+                    f'{indent}\t\t\t\t<xsd:sequence>\n'
+                    f'{indent}\t\t\t\t\t<xsd:element name="{name}_Extra" type="l{library}:TText"/>\n'
+                    f'{indent}\t\t\t\t</xsd:sequence>\n'
+                    f'{indent}\t\t\t</xsd:extension>\n'
+                    f'{indent}\t\t</xsd:complexContent>\n'
+                    f'{indent}\t</xsd:complexType>\n'
+                    f'{indent}</xsd:element>\n')
+        return (f'{indent}<xsd:element name="{name}" type="l{library}:TText" maxOccurs="unbounded">\n'
+                + _documentation(name, indent + '\t') + f'{indent}</xsd:element>\n')
+
+    def section(name, level, indent):
+        if level == depth:
+            return leaf(name, indent)
+        children = ''.join(section(f'{name}_{child}', level + 1, indent + '\t\t\t') for child in range(breadth))
+        return (f'{indent}<xsd:element name="{name}">\n'
+                + _documentation(name, indent + '\t')
+                + f'{indent}\t<xsd:complexType>\n{indent}\t\t<xsd:sequence>\n'
+                + children
+                + f'{indent}\t\t</xsd:sequence>\n{indent}\t</xsd:complexType>\n{indent}</xsd:element>\n')
+
+    parts.append(section('Report', 0, '\t'))
+    parts.append('</xsd:schema>\n')
+    return ''.join(parts).encode('utf-8'), libraries